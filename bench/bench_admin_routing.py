@@ -0,0 +1,128 @@
+# Per-message routing cost through the real Dispatcher (Bot API calls are no-ops).
+#
+#   python bench/bench_admin_routing.py --messages 20000
+#   python bench/bench_admin_routing.py --baseline <git ref>
+#
+# "baseline" is the catch-all admin_router of the first commit (or --baseline),
+# loaded from git and wired the way its main() did: every private message
+# entered it, admins walked the if-chain, then read their state from the DB.
+# "router" is build_dispatcher() as shipped; "F filters" is the same wiring
+# with the router-level admin check written as magic filters. Updates are
+# mounted on the bot up front, so aiogram's re-validation of foreign updates
+# isn't measured; the cases run interleaved for --rounds and the best round
+# is kept.
+import argparse
+import asyncio
+import os
+import subprocess
+import tempfile
+import time
+import types
+
+from aiogram import Dispatcher, F, Router
+from aiogram.filters import Command
+from aiogram.types import Update
+
+from common import main, null_bot, use_db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_ID = next(iter(main.ADMIN_IDS))
+USER_ID = 500000001
+
+
+def git(*args: str) -> str:
+    return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+
+
+def load_baseline(ref: str) -> types.ModuleType:
+    module = types.ModuleType("baseline_main")
+    module.__file__ = f"{ref}:main.py"
+    exec(compile(git("show", module.__file__), module.__file__, "exec"), module.__dict__)
+    return module
+
+
+def baseline_dispatcher(old: types.ModuleType) -> Dispatcher:
+    dp = Dispatcher()
+    dp.errors.register(old.on_error)
+    dp.message.register(old.cmd_start, Command("start"))
+    dp.message.register(old.cmd_admin, Command("admin"))
+    dp.chat_join_request.register(old.on_join_request)
+    dp.message.register(old.admin_router)
+    return dp
+
+
+def magic_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=main.STATES)
+    dp.update.outer_middleware(main.metrics_middleware)
+    dp.message.register(main.cmd_start, Command("start"))
+    admin = Router(name="admin-magic")
+    admin.message.filter(F.chat.type == "private", F.from_user.id.in_(main.ADMIN_IDS))
+    admin.message.register(main.cmd_admin, Command("admin"))
+    admin.message.register(main.admin_dispatch, main.admin_action)
+    dp.include_router(admin)
+    return dp
+
+
+def message_update(n: int, user_id: int, text: str, bot) -> Update:
+    return Update.model_validate({
+        "update_id": n,
+        "message": {
+            "message_id": n,
+            "date": 1700000000,
+            "chat": {"id": user_id, "type": "private", "first_name": "Bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }, context={"bot": bot})
+
+
+async def measure(dp: Dispatcher, bot, update: Update, count: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(count):
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - t0) / count * 1e6
+
+
+async def amain() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=20000)
+    ap.add_argument("--rounds", type=int, default=5)
+    ap.add_argument("--baseline", default=None, help="git ref of the old main.py (default: the first commit)")
+    args = ap.parse_args()
+
+    old = load_baseline(args.baseline or git("rev-list", "--max-parents=0", "HEAD").split()[0])
+    old.DB_PATH = os.path.join(tempfile.gettempdir(), "bench_routing_baseline.db")
+    await old.db_init()
+    use_db(os.path.join(tempfile.gettempdir(), "bench_routing.db"))
+    await main.db_init()
+    await main.DB.open()
+    bot = null_bot()
+
+    dispatchers = {
+        "baseline": baseline_dispatcher(old),
+        "router": main.build_dispatcher(),
+        "F filters": magic_dispatcher(),
+    }
+    cases = [
+        ("non-admin text", message_update(1, USER_ID, "hello", bot)),
+        ("admin, last button", message_update(2, ADMIN_ID, "👀 Предпросмотр", bot)),
+        ("admin, free text", message_update(3, ADMIN_ID, "just text", bot)),
+    ]
+    best = {}
+    per_round = max(1, args.messages // args.rounds)
+    try:
+        for _ in range(args.rounds):
+            for name, update in cases:
+                for impl, dp in dispatchers.items():
+                    took = await measure(dp, bot, update, per_round)
+                    best[name, impl] = min(best.get((name, impl), took), took)
+    finally:
+        await main.DB.close()
+
+    print(f"{'case':<24}" + "".join(f"{impl + ' µs/msg':>20}" for impl in dispatchers))
+    for name, _ in cases:
+        print(f"{name:<24}" + "".join(f"{best[name, impl]:>20.1f}" for impl in dispatchers))
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
@@ -0,0 +1,66 @@
+# Broadcast throughput against a fake Bot with injected per-request latency.
+#
+#   python bench/bench_broadcast.py --users 300 --latency 0.15
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from common import FakeBot, main, run_broadcast_here, seed_users, use_db
+
+ADMIN_ID = 1
+
+
+# The pre-engine loop: one send at a time followed by a fixed sleep.
+async def legacy_broadcast(bot: FakeBot, targets, rps: float) -> None:
+    delay = 1.0 / max(1, rps)
+    for uid in targets:
+        await bot.send_message(uid, "bench")
+        await asyncio.sleep(delay)
+
+
+async def amain() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=300)
+    ap.add_argument("--latency", type=float, default=0.15, help="seconds per fake Bot API call")
+    ap.add_argument("--rps", type=float, default=main.BROADCAST_RPS)
+    ap.add_argument("--burst", type=int, default=main.BROADCAST_BURST)
+    ap.add_argument("--workers", type=int, default=main.BROADCAST_WORKERS)
+    ap.add_argument("--flood-every", type=int, default=0, help="inject a 429 every N-th call")
+    ap.add_argument("--skip-legacy", action="store_true")
+    args = ap.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), "bench_broadcast.db")
+    use_db(path)
+    await main.db_init()
+    targets = await seed_users(path, args.users)
+    await main.DB.open()
+    main.WRITES.start()
+    main.BROADCAST_RPS, main.BROADCAST_BURST, main.BROADCAST_WORKERS = args.rps, args.burst, args.workers
+
+    print(f"{args.users} users, {args.latency * 1000:.0f} ms/request, target {args.rps:g} msg/s")
+    try:
+        if not args.skip_legacy:
+            bot = FakeBot(args.latency, ADMIN_ID)
+            t0 = time.perf_counter()
+            await legacy_broadcast(bot, targets, args.rps)
+            elapsed = time.perf_counter() - t0
+            print(f"  sequential loop: {bot.sent} sent in {elapsed:.1f}s -> {bot.sent / elapsed:.1f} msg/s")
+
+        bot = FakeBot(args.latency, ADMIN_ID, flood_every=args.flood_every)
+        t0 = time.perf_counter()
+        await main.broadcast_job_create(ADMIN_ID, "text", None, "bench")
+        await run_broadcast_here(bot)
+        elapsed = time.perf_counter() - t0
+        print(
+            f"  engine ({args.workers} workers, burst {args.burst}): "
+            f"{bot.sent} sent in {elapsed:.1f}s -> {bot.sent / elapsed:.1f} msg/s"
+        )
+        print("  admin report:", " | ".join(m.replace("\n", " ") for m in bot.admin_messages))
+    finally:
+        await main.on_shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
@@ -0,0 +1,85 @@
+# Users import/export throughput and memory on a generated file.
+#
+#   python bench/bench_import.py --users 5000000 --format csv --chunk 50000
+#
+# Writes --users synthetic rows to a .jsonl/.csv file, imports them into an
+# empty DB through main.import_users (chunked transactions), imports them
+# again (every row now an update), then exports them back through
+# main.export_users. Peak RSS is reported after each phase; it stays flat
+# when both directions stream.
+import argparse
+import asyncio
+import csv
+import json
+import os
+import resource
+import tempfile
+import time
+
+from common import main, use_db
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_users_file(path: str, fmt: str, count: int) -> None:
+    now = int(time.time())
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer is not None:
+            writer.writerow(main.USER_EXPORT_COLUMNS)
+        for i in range(count):
+            row = (
+                1_000_000 + i, f"user{i}", "Имя", "" if i % 3 else "Фамилия",
+                now - i % 86400 * 30, -1001234567890 if i % 2 else "", now - i % 3600, int(i % 50 == 0),
+            )
+            if writer is not None:
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(dict(zip(main.USER_EXPORT_COLUMNS, [v if v != "" else None for v in row]))) + "\n")
+
+
+async def amain() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=1_000_000)
+    ap.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    ap.add_argument("--chunk", type=int, default=main.IMPORT_CHUNK_ROWS)
+    args = ap.parse_args()
+
+    tmp = tempfile.gettempdir()
+    path = os.path.join(tmp, "bench_import.db")
+    source = os.path.join(tmp, f"bench_import.{args.format}")
+    target = os.path.join(tmp, f"bench_export.{args.format}")
+    use_db(path)
+    await main.db_init()
+
+    t0 = time.perf_counter()
+    write_users_file(source, args.format, args.users)
+    print(f"{args.users} rows, {os.path.getsize(source) / 2**20:.0f} MB {args.format} "
+          f"written in {time.perf_counter() - t0:.1f}s; chunk {args.chunk} rows")
+
+    await main.DB.open()
+    try:
+        for phase in ("import (new)", "import (update)"):
+            t0 = time.perf_counter()
+            imported, skipped = await main.import_users(source, args.format, chunk_rows=args.chunk)
+            elapsed = time.perf_counter() - t0
+            print(f"  {phase:<16} {imported / elapsed:10.0f} rows/s   ({elapsed:.1f}s, "
+                  f"{skipped} skipped, peak RSS {peak_rss_mb():.0f} MB)")
+
+        t0 = time.perf_counter()
+        exported = await main.export_users(target, args.format)
+        elapsed = time.perf_counter() - t0
+        print(f"  {'export':<16} {exported / elapsed:10.0f} rows/s   ({elapsed:.1f}s, peak RSS {peak_rss_mb():.0f} MB)")
+
+        total, blocked, _, _ = await main.get_stats()
+        print(f"  counters: {total} users, {blocked} blocked")
+    finally:
+        await main.DB.close()
+        for f in (source, target):
+            os.remove(f)
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
@@ -0,0 +1,101 @@
+# Join-request handling throughput: connect-per-call helpers vs the shared DB pool.
+# Time covers enqueueing every request and draining the JOINS worker pool.
+#
+#   python bench/bench_join_requests.py --events 2000 --concurrency 50
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import aiosqlite
+
+from common import FakeBot, join_request, main, run_concurrent, use_db
+
+
+# The pre-pool helpers, kept here only as the "before" baseline.
+async def legacy_get_enabled() -> bool:
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("PRAGMA busy_timeout=5000;")
+        cur = await db.execute("SELECT is_enabled FROM settings WHERE id=1")
+        (v,) = await cur.fetchone()
+        return bool(v)
+
+
+async def legacy_upsert_user(user, source_chat_id=None) -> None:
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("PRAGMA busy_timeout=5000;")
+        await db.execute("""
+        INSERT INTO users (user_id, username, first_name, last_name, created_at, is_blocked)
+        VALUES (?, ?, ?, ?, strftime('%s','now'), 0)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username=excluded.username,
+            first_name=excluded.first_name,
+            last_name=excluded.last_name
+        """, (user.id, user.username, user.first_name, user.last_name))
+        await db.commit()
+
+
+async def legacy_get_welcome(chat_id=0):
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("PRAGMA busy_timeout=5000;")
+        cur = await db.execute("""
+            SELECT media_type, media_file_id, text, button_text, button_url
+            FROM welcome WHERE id=1
+        """)
+        row = await cur.fetchone()
+        return main.WelcomeConfig(row[0], row[1], row[2] or "", row[3] or "Открыть", row[4] or "https://t.me/")
+
+
+async def stats(path: str):
+    async with aiosqlite.connect(path) as db:
+        cur = await db.execute("SELECT COUNT(*), SUM(is_blocked) FROM users")
+        return await cur.fetchone()
+
+
+async def run(label: str, events: int, concurrency: int, legacy: bool) -> None:
+    path = os.path.join(tempfile.gettempdir(), f"bench_join_{label}.db")
+    use_db(path)
+    main.CHANNEL_IDS = set()
+    await main.db_init()
+
+    # the channel map is shared: loaded once, then served from memory either way
+    await main.DB.open()
+    saved = (main.get_enabled, main.upsert_user, main.get_welcome)
+    if legacy:
+        main.get_enabled, main.upsert_user, main.get_welcome = legacy_get_enabled, legacy_upsert_user, legacy_get_welcome
+    else:
+        main.WRITES.start()
+
+    bot = FakeBot()
+    main.JOINS.start(bot)
+    try:
+        t0 = time.perf_counter()
+        await run_concurrent(
+            (join_request(1_000_000 + i) for i in range(events)),
+            lambda ev: main.on_join_request(ev, bot),
+            concurrency,
+        )
+        await main.JOINS.queue.join()
+        elapsed = time.perf_counter() - t0
+    finally:
+        main.get_enabled, main.upsert_user, main.get_welcome = saved
+        await main.on_shutdown()
+        total, _ = await stats(path)
+        assert total == events, (total, events)
+
+    print(f"{label:>8}: {events} join requests in {elapsed:.2f}s -> {events / elapsed:,.0f} req/s")
+
+
+async def amain() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=50)
+    args = ap.parse_args()
+
+    await run("before", args.events, args.concurrency, legacy=True)
+    await run("after", args.events, args.concurrency, legacy=False)
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
@@ -0,0 +1,199 @@
+# End-to-end load test: the real Bot/Dispatcher polling a local fake Bot API.
+#
+#   python bench/bench_load.py --joins 2000 --users 5000 --latency 0.02 --rps 200
+#
+# Phase 1 replays --joins ChatJoinRequest updates through getUpdates and waits
+# for the JOINS pool to drain. Phase 2 plays the admin flow (📣 Рассылка,
+# 👥 Все, a text, "-" for no button) and waits for the broadcast to --users
+# seeded users (+ the joined ones) to finish. Knobs for Telegram's bad days:
+# --flood-every, --blocked-every.
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import List
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+
+from common import main, seed_users, use_db
+from fake_telegram import FakeTelegramServer
+
+ADMIN_ID = next(iter(main.ADMIN_IDS))
+CHANNEL_ID = next(iter(main.CHANNEL_IDS), -1001234567890)
+
+
+def join_update(uid: int) -> dict:
+    return {
+        "chat_join_request": {
+            "chat": {"id": CHANNEL_ID, "type": "channel", "title": "Load test"},
+            "from": {"id": uid, "is_bot": False, "first_name": "Load", "username": f"load{uid}"},
+            "user_chat_id": uid,
+            "date": int(time.time()),
+        }
+    }
+
+
+def admin_text(text: str) -> dict:
+    return {
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": ADMIN_ID, "type": "private", "first_name": "Admin"},
+            "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"},
+            "text": text,
+        }
+    }
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def db_commits() -> int:
+    entry = main.DB_SECONDS.values.get(("write",))
+    return sum(entry[0]) if entry else 0
+
+
+async def wait_for(predicate, timeout: float, what: str) -> None:
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"timed out waiting for {what}")
+        await asyncio.sleep(0.005)
+
+
+async def amain() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--joins", type=int, default=1000)
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds per Bot API send")
+    ap.add_argument("--flood-every", type=int, default=0, help="every N-th send gets 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--blocked-every", type=int, default=0, help="chat ids divisible by N get 403")
+    ap.add_argument("--rps", type=float, default=main.BROADCAST_RPS, help="broadcast rate limit")
+    ap.add_argument("--workers", type=int, default=main.BROADCAST_WORKERS)
+    ap.add_argument("--join-rps", type=float, default=main.JOIN_RPS, help="welcomes per second")
+    ap.add_argument("--approve-rps", type=float, default=main.JOIN_APPROVE_RPS, help="approvals per second")
+    ap.add_argument("--join-workers", type=int, default=main.JOIN_WORKERS)
+    ap.add_argument("--send-rps", type=float, default=0, help="bot-wide send rate, default --rps + --join-rps")
+    ap.add_argument("--auto-approve", action="store_true")
+    ap.add_argument("--timeout", type=float, default=600)
+    args = ap.parse_args()
+
+    main.AUTO_APPROVE = args.auto_approve
+    main.BROADCAST_RPS, main.BROADCAST_BURST = args.rps, max(main.BROADCAST_BURST, int(args.rps // 10))
+    main.BROADCAST_WORKERS = args.workers
+    send_rps = args.send_rps or args.rps + args.join_rps
+    main.SENDS = main.OutboundSender(rps=send_rps, burst=max(main.SEND_BURST, int(send_rps // 10)))
+
+    server = FakeTelegramServer(
+        latency=args.latency,
+        flood_every=args.flood_every,
+        retry_after=args.retry_after,
+        blocked_every=args.blocked_every,
+        admin_id=ADMIN_ID,
+    )
+    await server.start()
+
+    path = os.path.join(tempfile.gettempdir(), "bench_load.db")
+    use_db(path)
+    main.JOINS = main.JoinRequestQueue(
+        workers=args.join_workers, rps=args.join_rps, burst=max(1, int(args.join_rps)), approve_rps=args.approve_rps
+    )
+    await main.db_init()
+    await seed_users(path, args.users)
+    await main.DB.open()
+    main.WRITES.start()
+    # startup as in main(): hot caches are warm before the first update
+    await main.CHANNELS.load()
+    await main.get_enabled()
+
+    bot = Bot(
+        "42:LOAD",
+        session=AiohttpSession(api=TelegramAPIServer.from_base(server.url)),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    dp = main.build_dispatcher()
+
+    latencies: List[float] = []
+
+    async def record_latency(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    dp.update.outer_middleware(record_latency)
+
+    main.SENDS.start(bot)
+    main.JOINS.start(bot)
+    main.BROADCAST_WORKER.start(bot)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+    await wait_for(lambda: server.calls["getupdates"] > 0, 10, "polling to start")
+
+    print(
+        f"fake API at {server.url}: latency {args.latency * 1000:.0f} ms, "
+        f"429 every {args.flood_every or '-'}, 403 every {args.blocked_every or '-'}"
+    )
+    try:
+        # phase 1: join-request storm
+        commits0 = db_commits()
+        t0 = time.perf_counter()
+        for i in range(args.joins):
+            server.push_update(join_update(900_000_000 + i))
+        await wait_for(lambda: len(latencies) >= args.joins, args.timeout, "join updates")
+        t_handled = time.perf_counter() - t0
+        await wait_for(
+            lambda: main.JOINS.processed + main.JOINS.failed >= args.joins, args.timeout, "join workers"
+        )
+        await main.WRITES.flush()
+        t_joins = time.perf_counter() - t0
+        join_latencies = latencies[:]
+        commits = db_commits() - commits0
+        print(f"\njoin requests: {args.joins}")
+        print(f"  updates handled/s    {args.joins / t_handled:10.0f}")
+        print(f"  handler p50 / p99    {percentile(join_latencies, 0.5) * 1000:7.2f} / "
+              f"{percentile(join_latencies, 0.99) * 1000:.2f} ms")
+        print(f"  joins completed/s    {args.joins / t_joins:10.0f}   "
+              f"(processed {main.JOINS.processed}, failed {main.JOINS.failed}, lag max {main.JOINS.lag_max:.2f}s)")
+        print(f"  DB commits/s         {commits / t_joins:10.1f}   ({commits} commits)")
+
+        # phase 2: broadcast through the admin flow
+        sent0 = server.sent["copymessage"]
+        failed0 = int(sum(main.BROADCAST_FAILED.values.values()))
+        for text in ("📣 Рассылка", "👥 Все", "Load test broadcast"):
+            replies = len(server.admin_messages)
+            server.push_update(admin_text(text))
+            await wait_for(lambda: len(server.admin_messages) > replies, 10, "admin prompt")
+        commits0 = db_commits()
+        t0 = time.perf_counter()
+        server.push_update(admin_text("-"))
+        await wait_for(lambda: main.BROADCASTS.task is not None, 10, "broadcast start")
+        await main.BROADCASTS.task
+        elapsed = time.perf_counter() - t0
+        sent = server.sent["copymessage"] - sent0
+        failed = int(sum(main.BROADCAST_FAILED.values.values())) - failed0
+        commits = db_commits() - commits0
+        print(f"\nbroadcast: {sent + failed} targets, rate limit {args.rps:g} msg/s")
+        print(f"  sent / failed        {sent:>6} / {failed}   (429s {server.flooded}, 403s {server.forbidden})")
+        print(f"  broadcast msg/s      {sent / elapsed:10.1f}   ({elapsed:.1f}s)")
+        print(f"  DB commits/s         {commits / elapsed:10.1f}   ({commits} commits)")
+        print(f"  handler p99 overall  {percentile(latencies, 0.99) * 1000:10.2f} ms over {len(latencies)} updates")
+    finally:
+        await dp.stop_polling()
+        await polling
+        await main.SENDS.stop()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
@@ -0,0 +1,151 @@
+# Welcome and admin-reply latency while a full-speed broadcast runs.
+#
+#   python bench/bench_priority.py --users 3000 --join-rate 2 --latency 0.02
+#   python bench/bench_priority.py --no-layer      # same, sends not gated by main.SENDS
+#
+# The real Bot/Dispatcher polls the fake Bot API, which answers sends beyond
+# --limit msg/s with 429 like Telegram does. Phase 1 pushes join requests at
+# --join-rate for --seconds with nothing else going on. Phase 2 starts a
+# broadcast to --users seeded users through the admin flow and keeps pushing
+# join requests (and a 📊 Статистика from the admin every 1.5 s, under the
+# per-chat limit) until the broadcast is done. Welcome latency is from the
+# update being pushed to the welcome reaching the fake API; with the send layer
+# its p99 should hardly move between the phases.
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+
+from bench_load import ADMIN_ID, admin_text, join_update, percentile, wait_for
+from common import main, seed_users, use_db
+from fake_telegram import FakeTelegramServer
+
+
+def summary(samples: List[float]) -> str:
+    return (f"p50 {percentile(samples, 0.5) * 1000:7.1f}   p99 {percentile(samples, 0.99) * 1000:7.1f}   "
+            f"max {max(samples, default=0) * 1000:7.1f} ms   ({len(samples)})")
+
+
+async def push_joins(server: FakeTelegramServer, rate: float, first_uid: int, done) -> List[float]:
+    pushed: Dict[int, float] = {}
+    uid = first_uid
+    while not done():
+        pushed[uid] = time.perf_counter()
+        server.push_update(join_update(uid))
+        uid += 1
+        await asyncio.sleep(1 / rate)
+    await wait_for(lambda: all(u in server.delivered_at for u in pushed), 120, "welcomes")
+    return [server.delivered_at[u] - t for u, t in pushed.items()]
+
+
+async def admin_pings(server: FakeTelegramServer, done) -> List[float]:
+    latencies: List[float] = []
+    while not done():
+        replies = len(server.admin_messages)
+        started = time.perf_counter()
+        server.push_update(admin_text("📊 Статистика"))
+        await wait_for(
+            lambda: any(m.startswith("📊") for m in server.admin_messages[replies:]), 30, "admin reply"
+        )
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(1.5)
+    return latencies
+
+
+def send_waits() -> str:
+    out = []
+    for (queue,), (counts, total) in sorted(main.SEND_WAIT_SECONDS.values.items()):
+        out.append(f"{queue} {total / max(1, sum(counts)) * 1000:.1f} ms")
+    return ", ".join(out) or "-"
+
+
+async def amain() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=3000)
+    ap.add_argument("--join-rate", type=float, default=2, help="join requests per second")
+    ap.add_argument("--seconds", type=float, default=10, help="length of the idle phase")
+    ap.add_argument("--latency", type=float, default=0.02, help="seconds per Bot API send")
+    ap.add_argument("--limit", type=float, default=30, help="fake API flood limit, msg/s")
+    ap.add_argument("--rps", type=float, default=main.SEND_RPS, help="BROADCAST_RPS and SEND_RPS")
+    ap.add_argument("--no-layer", action="store_true", help="do not install main.SENDS")
+    args = ap.parse_args()
+
+    main.BROADCAST_RPS = args.rps
+    main.SENDS = main.OutboundSender(rps=args.rps)
+
+    server = FakeTelegramServer(latency=args.latency, admin_id=ADMIN_ID, rps_limit=args.limit)
+    await server.start()
+
+    path = os.path.join(tempfile.gettempdir(), "bench_priority.db")
+    use_db(path)
+    await main.db_init()
+    await seed_users(path, args.users)
+    await main.DB.open()
+    main.WRITES.start()
+    await main.CHANNELS.load()
+    await main.get_enabled()
+
+    bot = Bot(
+        "42:PRIORITY",
+        session=AiohttpSession(api=TelegramAPIServer.from_base(server.url)),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    dp = main.build_dispatcher()
+    if not args.no_layer:
+        main.SENDS.start(bot)
+    main.JOINS.start(bot)
+    main.BROADCAST_WORKER.start(bot)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+    await wait_for(lambda: server.calls["getupdates"] > 0, 10, "polling to start")
+
+    print(f"fake API: {args.latency * 1000:.0f} ms/send, flood limit {args.limit:g} msg/s; "
+          f"broadcast {args.rps:g} msg/s, joins {args.join_rate:g}/s, "
+          f"send layer {'off' if args.no_layer else 'on'}")
+    try:
+        deadline = time.perf_counter() + args.seconds
+        idle_welcome, idle_admin = await asyncio.gather(
+            push_joins(server, args.join_rate, 900_000_000, lambda: time.perf_counter() > deadline),
+            admin_pings(server, lambda: time.perf_counter() > deadline),
+        )
+        flooded0 = server.flooded
+
+        for text in ("📣 Рассылка", "👥 Все", "Priority test broadcast"):
+            replies = len(server.admin_messages)
+            server.push_update(admin_text(text))
+            await wait_for(lambda: len(server.admin_messages) > replies, 10, "admin prompt")
+        sent0 = server.sent["copymessage"]
+        server.push_update(admin_text("-"))
+        await wait_for(lambda: main.BROADCASTS.task is not None, 10, "broadcast start")
+        t0 = time.perf_counter()
+        busy_welcome, busy_admin = await asyncio.gather(
+            push_joins(server, args.join_rate, 910_000_000, lambda: main.BROADCASTS.task.done()),
+            admin_pings(server, lambda: main.BROADCASTS.task.done()),
+        )
+        elapsed = time.perf_counter() - t0
+        sent = server.sent["copymessage"] - sent0
+
+        print(f"\nidle:       welcome {summary(idle_welcome)}")
+        print(f"            admin   {summary(idle_admin)}")
+        print(f"broadcast:  welcome {summary(busy_welcome)}")
+        print(f"            admin   {summary(busy_admin)}")
+        print(f"  {sent} broadcast sends in {elapsed:.1f}s ({sent / elapsed:.1f} msg/s), "
+              f"{server.flooded - flooded0} answered with 429")
+        print(f"  mean send-slot wait: {send_waits()}")
+    finally:
+        await dp.stop_polling()
+        await polling
+        await main.JOINS.stop()
+        await main.SENDS.stop()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
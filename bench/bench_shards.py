@@ -0,0 +1,122 @@
+# Sharded broadcast across worker processes sharing one SQLite file.
+#
+#   python bench/bench_shards.py --users 3000 --shards 8 --processes 4 --rps 200 --latency 0.02
+#   python bench/bench_shards.py --kill-after 3     # SIGKILL one worker mid-run
+#
+# The parent seeds users and creates one job split into --shards ranges; each
+# child is a broadcast worker (own WORKER_ID, FakeBot) that leases shards until
+# the job is done. BROADCAST_RPS is the budget for all of them together. With
+# --kill-after, the killed worker's shard waits out its lease and is taken over
+# from the last checkpoint; sends since that checkpoint are repeated.
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+
+from common import FakeBot, main, run_broadcast_here, seed_users, use_db
+
+ADMIN_ID = 1
+
+
+async def worker(path: str, latency: float) -> None:
+    main.DB = main.SqliteStorage(path)
+    await main.DB.open()
+    bot = FakeBot(latency, ADMIN_ID)
+    t0 = time.perf_counter()
+    try:
+        while True:
+            await run_broadcast_here(bot)
+            job = await main.broadcast_job_last()
+            if job.status != "running":
+                break
+            # the rest is leased by others; one of those leases may yet expire
+            await asyncio.sleep(0.2)
+    finally:
+        await main.DB.close()
+    print(json.dumps({
+        "worker": main.WORKER_ID, "sent": bot.sent, "seconds": time.perf_counter() - t0,
+        "admin": bot.admin_messages,
+    }), flush=True)
+
+
+async def amain() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=3000)
+    ap.add_argument("--shards", type=int, default=8)
+    ap.add_argument("--processes", type=int, default=4)
+    ap.add_argument("--rps", type=float, default=200, help="global budget for all workers")
+    ap.add_argument("--latency", type=float, default=0.02, help="seconds per fake Bot API call")
+    ap.add_argument("--lease-ttl", type=float, default=3.0)
+    ap.add_argument("--kill-after", type=float, default=0, help="SIGKILL worker 0 after N seconds")
+    ap.add_argument("--worker", metavar="DB", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        return await worker(args.worker, args.latency)
+
+    path = os.path.join(tempfile.gettempdir(), "bench_shards.db")
+    use_db(path)
+    await main.db_init()
+    await seed_users(path, args.users)
+    await main.DB.open()
+    try:
+        job = await main.broadcast_job_create(ADMIN_ID, "text", None, "bench", shards=args.shards)
+    finally:
+        await main.DB.close()
+
+    env = dict(
+        os.environ,
+        BROADCAST_RPS=str(args.rps),
+        BROADCAST_BURST=str(max(1, int(args.rps // 20))),
+        BROADCAST_LEASE_TTL=str(args.lease_ttl),
+        BROADCAST_CHECKPOINT_INTERVAL=str(min(0.5, args.lease_ttl / 4)),
+    )
+    print(f"job #{job.id}: {job.total} targets in {args.shards} shards, {args.processes} workers, "
+          f"{args.rps:g} msg/s budget, {args.latency * 1000:.0f} ms/request")
+    t0 = time.perf_counter()
+    procs = [
+        await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--worker", path, "--latency", str(args.latency),
+            env=dict(env, WORKER_ID=f"bench-{i}"), stdout=asyncio.subprocess.PIPE,
+        )
+        for i in range(args.processes)
+    ]
+    if args.kill_after:
+        await asyncio.sleep(args.kill_after)
+        procs[0].send_signal(signal.SIGKILL)
+        print(f"  killed bench-0 after {args.kill_after:g}s")
+    outputs = [await p.communicate() for p in procs]
+    wall = time.perf_counter() - t0
+
+    # aggregate rate over the workers' own run time (imports take seconds)
+    sent, elapsed = 0, 0.0
+    for (out, _), p in zip(outputs, procs):
+        for line in out.decode().splitlines():
+            r = json.loads(line)
+            sent += r["sent"]
+            elapsed = max(elapsed, r["seconds"])
+            print(f"  {r['worker']}: {r['sent']:>6} sent in {r['seconds']:.1f}s")
+            for text in r["admin"]:
+                print("    admin:", text.replace("\n", " "))
+        if p.returncode:
+            print(f"  worker exited with {p.returncode}")
+
+    await main.DB.open()
+    try:
+        job = await main.broadcast_job_last()
+        reached = (await main.DB.db.fetchone(
+            "SELECT COUNT(DISTINCT user_id) FROM broadcast_deliveries WHERE broadcast_id=? AND status='sent'",
+            (job.id,),
+        ))[0]
+    finally:
+        await main.DB.close()
+    print(f"  job status {job.status}: {reached}/{job.total} users reached ({wall:.1f}s wall clock)")
+    print(f"  surviving workers: {sent} sent, {sent / elapsed:.1f} msg/s together (budget {args.rps:g})")
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
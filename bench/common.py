@@ -0,0 +1,143 @@
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Iterable, List, Tuple
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+os.environ.setdefault("BOT_TOKEN", "42:BENCH")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeBot:
+    # Stand-in for aiogram.Bot: every send sleeps `latency` seconds and succeeds,
+    # except every `flood_every`-th call, which fails with a flood-wait.
+    def __init__(self, latency: float = 0.0, admin_id: int = 0, flood_every: int = 0, retry_after: int = 1):
+        self.latency = latency
+        self.admin_id = admin_id
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.calls = 0
+        self.sent = 0
+        self.admin_messages: List[str] = []
+
+    async def _call(self, chat_id: int) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls += 1
+        if self.flood_every and self.calls % self.flood_every == 0:
+            raise TelegramRetryAfter(
+                SendMessage(chat_id=chat_id, text=""), "Too Many Requests", retry_after=self.retry_after
+            )
+        self.sent += 1
+
+    async def __call__(self, method, request_timeout=None):
+        # prebuilt requests from main.broadcast_sender
+        if method.chat_id == self.admin_id:
+            self.admin_messages.append(getattr(method, "text", ""))
+            return
+        await self._call(method.chat_id)
+
+    async def send_message(self, chat_id, text=None, *args, **kwargs):
+        if chat_id == self.admin_id:
+            self.admin_messages.append(text)
+            return
+        await self._call(chat_id)
+
+    async def send_photo(self, chat_id, *args, **kwargs):
+        await self._call(chat_id)
+
+    async def send_video(self, chat_id, *args, **kwargs):
+        await self._call(chat_id)
+
+    async def approve_chat_join_request(self, chat_id, user_id, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return True
+
+
+class NullSession(BaseSession):
+    # Bot API session that answers every method instantly with True.
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    async def close(self) -> None:
+        pass
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+
+def null_bot() -> Bot:
+    # a real aiogram Bot (so dispatcher/handlers run unchanged) without network
+    return Bot(main.BOT_TOKEN, session=NullSession(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+
+def use_db(path: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    main.DB_PATH = path
+    main.DB = main.SqliteStorage(path)
+    main.SETTINGS = main.SettingsCache()
+    main.CHANNELS = main.ChannelRegistry()
+    # no Bot API pacing in benchmarks unless a script sets one
+    main.JOINS = main.JoinRequestQueue(rps=1_000_000, burst=1_000_000)
+
+
+async def run_broadcast_here(bot) -> None:
+    # work every shard of every running job in this process, as
+    # main.BroadcastWorker does, then return
+    while True:
+        lease = await main.DB.broadcast_shard_lease(main.WORKER_ID, main.BROADCAST_LEASE_TTL)
+        if lease is None:
+            return
+        job_row, shard_row, leases = lease
+        job, shard = main.broadcast_job_from_row(job_row), main.broadcast_shard_from_row(shard_row)
+        await main.BROADCASTS.start(main.run_broadcast(bot, job, shard, leases))
+
+
+async def seed_users(path: str, count: int, first_id: int = 1_000_000) -> List[int]:
+    ids = list(range(first_id, first_id + count))
+    async with aiosqlite.connect(path) as db:
+        await db.executemany(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, created_at, is_blocked) "
+            "VALUES (?, ?, 'Bench', strftime('%s','now'), 0)",
+            [(uid, f"user{uid}") for uid in ids],
+        )
+        await db.commit()
+    return ids
+
+
+def join_request(uid: int, chat_id: int = -100):
+    user = SimpleNamespace(id=uid, username=f"user{uid}", first_name="Bench", last_name=None)
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id, title="Bench"), from_user=user, user_chat_id=uid)
+
+
+async def run_concurrent(
+    items: Iterable, worker: Callable[..., Awaitable], concurrency: int
+) -> float:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(item):
+        async with sem:
+            await worker(item)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in items))
+    return time.perf_counter() - t0
@@ -0,0 +1,180 @@
+# Local stand-in for the Telegram Bot API, good enough for aiogram polling and
+# the calls the bot makes. Point a Bot at it with:
+#
+#   Bot(token, session=AiohttpSession(api=TelegramAPIServer.from_base(server.url)))
+#
+# Every send* call sleeps `latency` seconds. Every `flood_every`-th send fails
+# with 429 (retry_after), and chats whose id divides by `blocked_every` get 403.
+# With `rps_limit`, sends beyond that bot-wide rate (a token bucket with
+# rps_limit / 5 burst) get 429 too, the way Telegram's flood control answers.
+# The admin chat is never throttled or blocked.
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+SEND_METHODS = {"sendmessage", "sendphoto", "sendvideo", "sendanimation", "senddocument", "copymessage", "copymessages"}
+
+
+class FakeTelegramServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        flood_every: int = 0,
+        retry_after: int = 1,
+        blocked_every: int = 0,
+        admin_id: int = 0,
+        rps_limit: float = 0.0,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.blocked_every = blocked_every
+        self.admin_id = admin_id
+        self.rps_limit = rps_limit
+
+        self.calls: Counter = Counter()
+        self.sent: Counter = Counter()
+        self.flooded = 0
+        self.forbidden = 0
+        self.admin_messages: List[str] = []
+        self.last_send_at = 0.0
+        # chat_id -> perf_counter() of the first message delivered there
+        self.delivered_at: Dict[int, float] = {}
+
+        self._updates: List[Dict[str, Any]] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._sends = 0
+        self._burst = max(1.0, rps_limit / 5)
+        self._tokens = self._burst
+        self._refilled = time.perf_counter()
+        self._new_updates = asyncio.Event()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def push_update(self, update: Dict[str, Any]) -> int:
+        # update_id is assigned here so replayed fixtures never collide
+        update = dict(update, update_id=next(self._update_ids))
+        self._updates.append(update)
+        self._new_updates.set()
+        return update["update_id"]
+
+    @staticmethod
+    def _ok(result: Any) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def _error(code: int, description: str, **parameters) -> web.Response:
+        body: Dict[str, Any] = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        self.calls[method] += 1
+        if method == "getupdates":
+            return await self._get_updates(data)
+        if method == "getme":
+            return self._ok({"id": 42, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+        if method in SEND_METHODS:
+            return await self._send(method, data)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._ok(True)
+
+    async def _get_updates(self, data) -> web.Response:
+        offset = int(data.get("offset") or 0)
+        timeout = float(data.get("timeout") or 0)
+        if offset:
+            # Telegram forgets everything below the confirmed offset
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(data.get("limit") or 100)
+        return self._ok(self._updates[:limit])
+
+    async def _send(self, method: str, data) -> web.Response:
+        chat_id = int(data["chat_id"])
+        if chat_id == self.admin_id:
+            self.admin_messages.append(data.get("text") or data.get("caption") or "")
+            return self._ok(self._message(chat_id, data))
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._sends += 1
+        if self.flood_every and self._sends % self.flood_every == 0 or not self._take_token():
+            self.flooded += 1
+            return self._error(
+                429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after
+            )
+        if self.blocked_every and chat_id % self.blocked_every == 0:
+            self.forbidden += 1
+            return self._error(403, "Forbidden: bot was blocked by the user")
+        self.sent[method] += 1
+        self.last_send_at = time.perf_counter()
+        self.delivered_at.setdefault(chat_id, self.last_send_at)
+        if method == "copymessage":
+            return self._ok({"message_id": next(self._message_ids)})
+        if method == "copymessages":
+            return self._ok([{"message_id": next(self._message_ids)} for _ in json.loads(data["message_ids"])])
+        return self._ok(self._message(chat_id, data))
+
+    def _take_token(self) -> bool:
+        if not self.rps_limit:
+            return True
+        now = time.perf_counter()
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled) * self.rps_limit)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _message(self, chat_id: int, data) -> Dict[str, Any]:
+        message: Dict[str, Any] = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        if data.get("text"):
+            message["text"] = data["text"]
+        if data.get("caption"):
+            message["caption"] = data["caption"]
+        if data.get("reply_markup"):
+            markup = json.loads(data["reply_markup"])
+            if "inline_keyboard" in markup:
+                message["reply_markup"] = markup
+        return message
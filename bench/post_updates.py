@@ -0,0 +1,68 @@
+# POST recorded Update JSON to a locally running bot in webhook mode.
+#
+#   BOT_MODE=webhook WEBHOOK_SECRET=s3cret python main.py
+#   python bench/post_updates.py --secret s3cret                     # every fixture once
+#   python bench/post_updates.py --secret s3cret --repeat 500 fixtures/updates/chat_join_request.json
+#
+# With --repeat, update_id and the user ids are shifted per copy so every
+# join request looks like a different person.
+import argparse
+import asyncio
+import copy
+import glob
+import json
+import os
+import time
+
+import aiohttp
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "updates")
+
+
+def variant(update: dict, n: int) -> dict:
+    if n == 0:
+        return update
+    update = copy.deepcopy(update)
+    update["update_id"] += n
+    jr = update.get("chat_join_request")
+    if jr:
+        jr["from"]["id"] += n
+        jr["user_chat_id"] += n
+    return update
+
+
+async def amain() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("files", nargs="*", help="fixture files (default: all in fixtures/updates)")
+    ap.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8080')}{os.getenv('WEBHOOK_PATH', '/webhook')}")
+    ap.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--concurrency", type=int, default=20)
+    args = ap.parse_args()
+
+    paths = args.files or sorted(glob.glob(os.path.join(FIXTURES, "*.json")))
+    updates = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            base = json.load(f)
+        updates += [variant(base, n) for n in range(args.repeat)]
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    sem = asyncio.Semaphore(args.concurrency)
+    statuses: dict = {}
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(update: dict) -> None:
+            async with sem:
+                async with session.post(args.url, json=update) as resp:
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post(u) for u in updates))
+        elapsed = time.perf_counter() - t0
+
+    print(f"{len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:,.0f}/s), HTTP status: {statuses}")
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
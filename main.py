@@ -1,17 +1,40 @@
+import argparse
 import asyncio
+import bisect
+import csv
+import heapq
+import json
 import os
 import re
+import signal
+import socket
+import sys
+import tempfile
+import time
 import logging
-from dataclasses import dataclass
-from typing import Optional, List, Tuple
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from collections import deque
+from datetime import datetime, timedelta, tzinfo
+from typing import Optional, List, Tuple, Dict, Deque, Any, AsyncIterator, Awaitable, Callable, Mapping, FrozenSet
+from zoneinfo import ZoneInfo
 
 import aiosqlite
+from aiohttp import web
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import DataNotDictLikeError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.filters import Command
+from aiogram.methods import CopyMessage, CopyMessages, SendMessage, SendPhoto, SendVideo, TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     Message,
     ChatJoinRequest,
@@ -20,6 +43,8 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ErrorEvent,
+    FSInputFile,
+    Update,
 )
 
 # =========================
@@ -29,6 +54,11 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 CHANNEL_ID = int(os.getenv("CHANNEL_ID")) if os.getenv("CHANNEL_ID") else None
+# Channels this process serves (CHANNEL_ID kept for old configs);
+# empty = every channel the bot receives join requests from
+CHANNEL_IDS = set(int(x) for x in os.getenv("CHANNEL_IDS", "").split(",") if x.strip())
+if CHANNEL_ID is not None:
+    CHANNEL_IDS.add(CHANNEL_ID)
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is missing (set it in ENV, not in code).")
@@ -40,8 +70,109 @@ DEFAULT_ADMINS = {
 
 ADMIN_IDS = set(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()) or DEFAULT_ADMINS
 
-DB_PATH = "bot.db"
-BROADCAST_RPS = 20
+# "polling" (default), "webhook", or "worker" (broadcast shards only, no updates)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Public base URL registered with Telegram on startup; leave empty to only
+# serve locally (e.g. behind a proxy that is already configured, or for tests)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+# Join requests are queued and handled by a bounded worker pool
+AUTO_APPROVE = os.getenv("AUTO_APPROVE", "0") == "1"
+JOIN_WORKERS = int(os.getenv("JOIN_WORKERS", "8"))
+JOIN_QUEUE_SIZE = int(os.getenv("JOIN_QUEUE_SIZE", "10000"))
+# JOIN_RPS: welcome messages per second sent by the join workers. With
+# AUTO_APPROVE the approvals are paced separately by JOIN_APPROVE_RPS: they
+# are not messages, so they don't eat into the welcome rate.
+JOIN_RPS = float(os.getenv("JOIN_RPS", "20"))
+JOIN_BURST = int(os.getenv("JOIN_BURST", "10"))
+JOIN_APPROVE_RPS = float(os.getenv("JOIN_APPROVE_RPS", "30"))
+JOIN_DRAIN_TIMEOUT = float(os.getenv("JOIN_DRAIN_TIMEOUT", "10"))
+
+# "sqlite" (default): one bot.db file, one process. "postgres": DATABASE_URL,
+# shared by several bot processes (webhook replicas); needs asyncpg
+STORAGE = os.getenv("STORAGE", "sqlite").strip().lower()
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+# user/delivery batches at least this big are loaded with COPY instead of executemany
+PG_COPY_MIN_ROWS = 1000
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_STATEMENT_CACHE = 256
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "1.0"))
+# users import: rows per transaction; export: rows per cursor fetch
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "50000"))
+EXPORT_BATCH_ROWS = 10000
+# Bot API file limits: bots upload up to 50 MB and download up to 20 MB;
+# bigger files go through the CLI (python main.py import-users/export-users)
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+# 0 = cached settings live until an admin edit invalidates them; set a TTL
+# when several processes share one DB and may edit it behind our back.
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "0"))
+# Every outgoing message (welcomes, broadcasts, handler replies, sweep probes)
+# waits for a slot in one send layer: SEND_RPS for the whole process, and
+# SEND_CHAT_RPS per chat (Telegram allows about 1 msg/s into one chat, with
+# short bursts). Slots go to handler replies first, then welcomes, then
+# broadcasts, then the liveness sweep.
+SEND_RPS = float(os.getenv("SEND_RPS", "30"))
+SEND_BURST = int(os.getenv("SEND_BURST", "5"))
+SEND_CHAT_RPS = float(os.getenv("SEND_CHAT_RPS", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+# per-chat state is dropped once it is this big (only chats still inside
+# their spacing window are kept)
+SEND_CHAT_STATE_MAX = 10000
+# Telegram allows roughly 30 msg/s per bot across all chats
+BROADCAST_RPS = float(os.getenv("BROADCAST_RPS", "30"))
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", "5"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "10"))
+# AIMD on flood-wait: halve the rate on 429, then win back BROADCAST_RATE_STEP
+# of the full rate per clean second (0.05: from half to full in ~10 s)
+BROADCAST_MIN_RPS = 1.0
+BROADCAST_RATE_STEP = 0.05
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_PAGE_SIZE = 1000
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", "2.0"))
+# per-recipient status/error/latency rows, written together with each checkpoint
+BROADCAST_DELIVERY_LOG = os.getenv("BROADCAST_DELIVERY_LOG", "1") == "1"
+# A job is split into this many user_id ranges (shards). Every bot process
+# (polling, webhook replicas, BOT_MODE=worker) leases shards through the DB and
+# renews the lease at each checkpoint; a shard whose lease runs out (crashed
+# worker) is taken over by someone else. BROADCAST_RPS is shared by all of them.
+BROADCAST_SHARDS = int(os.getenv("BROADCAST_SHARDS", "1"))
+BROADCAST_LEASE_TTL = float(os.getenv("BROADCAST_LEASE_TTL", "30"))
+# the lease is renewed at each checkpoint: leave room for a couple of slow ones
+if BROADCAST_CHECKPOINT_INTERVAL * 3 >= BROADCAST_LEASE_TTL:
+    raise RuntimeError("BROADCAST_CHECKPOINT_INTERVAL must be under a third of BROADCAST_LEASE_TTL.")
+# idle processes look for shards to lease this often
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+WORKER_ID = os.getenv("WORKER_ID", "").strip() or f"{socket.gethostname()}:{os.getpid()}"
+# Liveness sweep: walk the broadcast targets with sendChatAction (the user
+# sees "typing…" for a moment) and flag the chats that are gone, so
+# broadcasts stop spending sends on them. Seconds between full passes, 0 = off;
+# turn it on in one process only.
+LIVENESS_SWEEP_INTERVAL = float(os.getenv("LIVENESS_SWEEP_INTERVAL", "0"))
+LIVENESS_RPS = float(os.getenv("LIVENESS_RPS", "1"))
+LIVENESS_PAGE_SIZE = 100
+# Scheduled broadcasts: times and cron expressions are read in SCHEDULE_TZ
+# (e.g. Europe/Moscow); empty = the server's local time, like segment dates
+SCHEDULE_TZ: Optional[tzinfo] = ZoneInfo(os.getenv("SCHEDULE_TZ")) if os.getenv("SCHEDULE_TZ") else None
+# a run that finds another broadcast going tries again this much later
+SCHEDULE_RETRY = 60
+# re-read the schedules table this often, for schedules added by other processes
+SCHEDULE_RESYNC_INTERVAL = 300
+# an album arrives as one update per item; wait this long for the rest of it
+MEDIA_GROUP_DELAY = 1.0
+
+# Prometheus text endpoint at http://METRICS_HOST:METRICS_PORT/metrics; empty port = off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
 
 WELCOME_DEFAULT_TEXT = "Привет! 👋\nСпасибо за заявку. Вот полезная информация:"
 WELCOME_DEFAULT_BUTTON_TEXT = "Открыть"
@@ -52,11 +183,188 @@ def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
 
+# =========================
+# Metrics
+# =========================
+# Small in-process registry rendered in the Prometheus text format, so the
+# bot needs no client library and nothing leaves the host. Label values are
+# passed positionally in the order of `labels`.
+def _metric_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = []
+    for k, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{k}="{v}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    @abstractmethod
+    def samples(self) -> List[str]: ...
+
+    def render(self) -> str:
+        head = f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+        return head + "".join(line + "\n" for line in self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_metric_labels(self.labels, k)} {v}" for k, v in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    # `fn` turns it into a callback gauge read at scrape time
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.fn = fn
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def samples(self) -> List[str]:
+        if self.fn is not None:
+            return [f"{self.name} {float(self.fn())}"]
+        return [f"{self.name}{_metric_labels(self.labels, k)} {v}" for k, v in self.values.items()]
+
+
+# seconds; covers a cached settings read up to a slow Telegram call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label set: [per-bucket counts (last one is +Inf), sum]
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> List[str]:
+        out = []
+        for k, (counts, total) in self.values.items():
+            acc = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                out.append(f"{self.name}_bucket{_metric_labels(self.labels, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_metric_labels(self.labels, k)} {total}")
+            out.append(f"{self.name}_count{_metric_labels(self.labels, k)} {acc}")
+        return out
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(m.render() for m in self.metrics)
+
+
+METRICS = MetricsRegistry()
+
+HANDLER_SECONDS = METRICS.register(Histogram("bot_handler_seconds", "Update handling time by update type.", ("update_type",)))
+HANDLER_ERRORS = METRICS.register(Counter("bot_handler_errors_total", "Updates whose handler raised, by update type.", ("update_type",)))
+DB_SECONDS = METRICS.register(Histogram("bot_db_query_seconds", "Time spent in one DB read or write block (a statement or a transaction).", ("op",)))
+DB_WAIT_SECONDS = METRICS.register(Histogram("bot_db_wait_seconds", "Time waiting for a reader connection or the writer lock.", ("op",)))
+BROADCAST_SENT = METRICS.register(Counter("bot_broadcast_sent_total", "Broadcast messages delivered."))
+BROADCAST_FAILED = METRICS.register(Counter("bot_broadcast_failed_total", "Broadcast messages given up on, by error type.", ("error",)))
+BROADCAST_RETRIES = METRICS.register(Counter("bot_broadcast_retries_total", "Broadcast sends retried after a flood-wait."))
+LIVENESS_CHECKED = METRICS.register(Counter("bot_liveness_checked_total", "Liveness-sweep probes, by result.", ("result",)))
+BROADCAST_SEND_SECONDS = METRICS.register(Histogram("bot_broadcast_send_seconds", "Telegram send time per broadcast message."))
+SEND_WAIT_SECONDS = METRICS.register(Histogram("bot_send_wait_seconds", "Time a message waited for a send slot, by queue.", ("queue",)))
+SEND_SECONDS = METRICS.register(Histogram("bot_send_seconds", "Time from queueing a message to Telegram's reply, by queue.", ("queue",)))
+SEND_QUEUE_DEPTH = METRICS.register(Gauge("bot_send_queue_depth", "Messages waiting for a send slot, by queue.", ("queue",)))
+CACHE_HITS = METRICS.register(Counter("bot_cache_hits_total", "In-process cache lookups answered from memory, by cache.", ("cache",)))
+CACHE_MISSES = METRICS.register(Counter("bot_cache_misses_total", "In-process cache lookups that had to load or build, by cache.", ("cache",)))
+
+
 # =========================
 # DB
 # =========================
-async def db_init():
-    async with aiosqlite.connect(DB_PATH) as db:
+async def db_add_column(db: aiosqlite.Connection, table: str, column: str, decl: str) -> bool:
+    # CREATE TABLE IF NOT EXISTS never touches old tables; add new columns by hand
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    if column in {r[1] for r in await cur.fetchall()}:
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+
+# is_blocked may be NULL in old rows, hence IS 1
+SQLITE_COUNTER_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS users_count_insert AFTER INSERT ON users BEGIN
+        UPDATE user_counters SET total=total+1, blocked=blocked+(NEW.is_blocked IS 1) WHERE id=1;
+        INSERT INTO user_joins (day, joined) SELECT NEW.created_at / 86400, 1 WHERE NEW.created_at IS NOT NULL
+            ON CONFLICT(day) DO UPDATE SET joined=joined+1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_count_block AFTER UPDATE OF is_blocked ON users
+    WHEN (OLD.is_blocked IS 1) <> (NEW.is_blocked IS 1) BEGIN
+        UPDATE user_counters SET blocked=blocked+(NEW.is_blocked IS 1)-(OLD.is_blocked IS 1) WHERE id=1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_count_joined AFTER UPDATE OF created_at ON users
+    WHEN OLD.created_at IS NOT NEW.created_at BEGIN
+        UPDATE user_joins SET joined=joined-1 WHERE day=OLD.created_at / 86400;
+        INSERT INTO user_joins (day, joined) SELECT NEW.created_at / 86400, 1 WHERE NEW.created_at IS NOT NULL
+            ON CONFLICT(day) DO UPDATE SET joined=joined+1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_count_delete AFTER DELETE ON users BEGIN
+        UPDATE user_counters SET total=total-1, blocked=blocked-(OLD.is_blocked IS 1) WHERE id=1;
+        UPDATE user_joins SET joined=joined-1 WHERE day=OLD.created_at / 86400;
+    END
+    """,
+)
+
+# full recount; runs inside the caller's write transaction
+SQLITE_COUNTERS_REBUILD = (
+    "DELETE FROM user_joins",
+    "INSERT INTO user_joins (day, joined) "
+    "SELECT created_at / 86400, COUNT(*) FROM users WHERE created_at IS NOT NULL GROUP BY 1",
+    "INSERT OR REPLACE INTO user_counters (id, total, blocked) "
+    "SELECT 1, COUNT(*), COUNT(CASE WHEN is_blocked=1 THEN 1 END) FROM users",
+)
+
+
+async def sqlite_init(path: str):
+    async with aiosqlite.connect(path) as db:
         await db.execute("PRAGMA journal_mode=WAL;")
         await db.execute("PRAGMA synchronous=NORMAL;")
         await db.execute("PRAGMA busy_timeout=5000;")
@@ -71,6 +379,10 @@ async def db_init():
             is_blocked INTEGER DEFAULT 0
         )
         """)
+        # segments: the channel a user first came from, and their last join/start
+        await db_add_column(db, "users", "source_chat_id", "INTEGER")
+        if await db_add_column(db, "users", "last_active_at", "INTEGER"):
+            await db.execute("UPDATE users SET last_active_at=created_at")
 
         await db.execute("""
         CREATE TABLE IF NOT EXISTS welcome (
@@ -86,16 +398,106 @@ async def db_init():
         await db.execute("""
         CREATE TABLE IF NOT EXISTS admin_state (
             admin_id INTEGER PRIMARY KEY,
-            state TEXT
+            state TEXT,
+            data TEXT
         )
         """)
+        await db_add_column(db, "admin_state", "data", "TEXT")
 
+        # cursor: every target with user_id <= cursor is processed;
+        # done_above: JSON list of processed ids past the cursor (out-of-order workers)
         await db.execute("""
-        CREATE TABLE IF NOT EXISTS broadcast_lock (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            is_running INTEGER NOT NULL
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            payload_type TEXT NOT NULL,
+            payload_file_id TEXT,
+            payload_caption TEXT,
+            status TEXT NOT NULL,
+            cursor INTEGER,
+            done_above TEXT,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+        """)
+
+        await db_add_column(db, "broadcast_jobs", "segment", "TEXT")
+        # payload_type "copy": copy message_ids (JSON) from source_chat_id, one
+        # id = copyMessage (+ optional button), several = copyMessages (album)
+        await db_add_column(db, "broadcast_jobs", "source_chat_id", "INTEGER")
+        await db_add_column(db, "broadcast_jobs", "message_ids", "TEXT")
+        await db_add_column(db, "broadcast_jobs", "button_text", "TEXT")
+        await db_add_column(db, "broadcast_jobs", "button_url", "TEXT")
+        await db_add_column(db, "broadcast_jobs", "total", "INTEGER")
+        await db_add_column(db, "broadcast_jobs", "paused", "INTEGER NOT NULL DEFAULT 0")
+
+        # A job's targets split into user_id ranges lo < user_id <= hi (NULL =
+        # unbounded), each worked by whichever process holds its lease.
+        # cursor/done_above/sent/failed are the shard's checkpoint.
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_shards (
+            broadcast_id INTEGER NOT NULL,
+            shard INTEGER NOT NULL,
+            lo INTEGER,
+            hi INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT,
+            lease_until REAL,
+            cursor INTEGER,
+            done_above TEXT,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            retries INTEGER NOT NULL DEFAULT 0,
+            wait REAL NOT NULL DEFAULT 0,
+            rate REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (broadcast_id, shard)
+        ) WITHOUT ROWID
+        """)
+        # lease lookups and live-lease counts only look at unfinished shards
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_shards_open ON broadcast_shards(broadcast_id) WHERE status='pending'"
+        )
+        # the running job, looked up at every launch and by idle workers
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_running ON broadcast_jobs(status) WHERE status='running'"
+        )
+
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            latency_ms INTEGER,
+            sent_at REAL,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        """)
+
+        # Broadcasts to start later: once at next_run_at, or on a cron
+        # `recurrence`. segment is the admin's choice as typed, parsed again
+        # at every run (so "new in 7 days" means the 7 days before that run).
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            source_chat_id INTEGER NOT NULL,
+            message_ids TEXT NOT NULL,
+            button_text TEXT,
+            button_url TEXT,
+            segment TEXT NOT NULL,
+            recurrence TEXT,
+            next_run_at INTEGER,
+            status TEXT NOT NULL DEFAULT 'active',
+            last_job_id INTEGER,
+            created_at INTEGER
         )
         """)
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_schedules_active ON broadcast_schedules(next_run_at) WHERE status='active'"
+        )
 
         await db.execute("""
         CREATE TABLE IF NOT EXISTS settings (
@@ -103,6 +505,55 @@ async def db_init():
             is_enabled INTEGER NOT NULL
         )
         """)
+        # last user_id the liveness sweep got to; NULL = start a new pass
+        await db_add_column(db, "settings", "sweep_cursor", "INTEGER")
+
+        # Keyset paging / counting of broadcast targets reads only this index
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(user_id) WHERE is_blocked=0")
+        # one per segment kind. Pages are read in user_id order, so the time
+        # segments key on user_id and check the time range as a residual: a
+        # created_at-first index made every keyset page sort the whole segment.
+        # Within one source_chat_id the rowid (user_id) already runs in order.
+        # is_blocked is carried along only so SQLite sees these as covering.
+        await db.execute("DROP INDEX IF EXISTS idx_users_created")
+        await db.execute("DROP INDEX IF EXISTS idx_users_last_active")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_created_id ON users(user_id, created_at, is_blocked) WHERE is_blocked=0"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_source ON users(source_chat_id) WHERE is_blocked=0"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_last_active_id ON users(user_id, last_active_at, is_blocked) WHERE is_blocked=0"
+        )
+
+        # Stats counters, kept by triggers on every write path. Tables,
+        # triggers and the first count go in one transaction so no write
+        # slips in between.
+        await db.commit()
+        await db.execute("BEGIN IMMEDIATE")
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total INTEGER NOT NULL,
+            blocked INTEGER NOT NULL
+        )
+        """)
+        # joins per UTC day (created_at / 86400)
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_joins (
+            day INTEGER PRIMARY KEY,
+            joined INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """)
+        for sql in SQLITE_COUNTER_TRIGGERS:
+            await db.execute(sql)
+        cur = await db.execute("SELECT COUNT(*) FROM user_counters")
+        (ccount,) = await cur.fetchone()
+        if ccount == 0:
+            for sql in SQLITE_COUNTERS_REBUILD:
+                await db.execute(sql)
+        await db.commit()
 
         # Ensure singleton welcome row
         cur = await db.execute("SELECT COUNT(*) FROM welcome WHERE id=1")
@@ -114,11 +565,24 @@ async def db_init():
                 (WELCOME_DEFAULT_TEXT, WELCOME_DEFAULT_BUTTON_TEXT, WELCOME_DEFAULT_BUTTON_URL),
             )
 
-        # Ensure broadcast lock row
-        cur = await db.execute("SELECT COUNT(*) FROM broadcast_lock WHERE id=1")
-        (lcount,) = await cur.fetchone()
-        if lcount == 0:
-            await db.execute("INSERT INTO broadcast_lock (id, is_running) VALUES (1, 0)")
+        # Per-channel welcome + enabled flag. Row 0 is the template a channel
+        # is copied from when it shows up; it starts as the old singleton.
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS channels (
+            chat_id INTEGER PRIMARY KEY,
+            title TEXT,
+            is_enabled INTEGER NOT NULL DEFAULT 1,
+            media_type TEXT,
+            media_file_id TEXT,
+            text TEXT,
+            button_text TEXT,
+            button_url TEXT
+        )
+        """)
+        await db.execute("""
+        INSERT OR IGNORE INTO channels (chat_id, media_type, media_file_id, text, button_text, button_url)
+        SELECT 0, media_type, media_file_id, text, button_text, button_url FROM welcome WHERE id=1
+        """)
 
         # Ensure settings row (enabled by default)
         cur = await db.execute("SELECT COUNT(*) FROM settings WHERE id=1")
@@ -129,479 +593,4006 @@ async def db_init():
         await db.commit()
 
 
-async def get_enabled() -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        cur = await db.execute("SELECT is_enabled FROM settings WHERE id=1")
-        (v,) = await cur.fetchone()
-        return bool(v)
+# Long-lived connections: one writer plus a small pool of read-only readers.
+class Database:
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._conns: List[aiosqlite.Connection] = []
 
+    async def _connect(self, read_only: bool) -> aiosqlite.Connection:
+        if read_only:
+            conn = await aiosqlite.connect(
+                f"file:{self.path}?mode=ro", uri=True, cached_statements=DB_STATEMENT_CACHE
+            )
+        else:
+            conn = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+        await conn.execute("PRAGMA busy_timeout=5000;")
+        await conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conns.append(conn)
+        return conn
 
-async def set_enabled(enabled: bool) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        await db.execute("UPDATE settings SET is_enabled=? WHERE id=1", (1 if enabled else 0,))
-        await db.commit()
+    async def open(self) -> None:
+        if self._writer is not None:
+            return
+        self._writer = await self._connect(read_only=False)
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect(read_only=True))
 
+    async def close(self) -> None:
+        async with self._write_lock:
+            conns, self._conns = self._conns, []
+            self._writer = None
+            self._readers = asyncio.Queue()
+            for conn in conns:
+                try:
+                    await conn.close()
+                except Exception:
+                    logging.exception("Failed to close DB connection")
 
-async def upsert_user(user) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        await db.execute("""
-        INSERT INTO users (user_id, username, first_name, last_name, created_at, is_blocked)
-        VALUES (?, ?, ?, ?, strftime('%s','now'), 0)
-        ON CONFLICT(user_id) DO UPDATE SET
-            username=excluded.username,
-            first_name=excluded.first_name,
-            last_name=excluded.last_name
-        """, (user.id, user.username, user.first_name, user.last_name))
-        await db.commit()
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        waited = time.perf_counter()
+        conn = await self._readers.get()
+        started = time.perf_counter()
+        DB_WAIT_SECONDS.observe(started - waited, "read")
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+            DB_SECONDS.observe(time.perf_counter() - started, "read")
 
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[aiosqlite.Connection]:
+        # single writer: statements of one block form one transaction
+        waited = time.perf_counter()
+        async with self._write_lock:
+            started = time.perf_counter()
+            DB_WAIT_SECONDS.observe(started - waited, "write")
+            if self._writer is None:
+                raise RuntimeError("Database is not open")
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - started, "write")
 
-async def mark_blocked(user_id: int, blocked: bool = True) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        await db.execute("UPDATE users SET is_blocked=? WHERE user_id=?", (1 if blocked else 0, user_id))
-        await db.commit()
+    async def fetchone(self, sql: str, params: Tuple = ()) -> Optional[tuple]:
+        async with self.read() as db:
+            async with db.execute(sql, params) as cur:
+                return await cur.fetchone()
 
+    async def fetchall(self, sql: str, params: Tuple = ()) -> List[tuple]:
+        async with self.read() as db:
+            async with db.execute(sql, params) as cur:
+                return list(await cur.fetchall())
 
-@dataclass
-class WelcomeConfig:
-    media_type: Optional[str]
-    media_file_id: Optional[str]
-    text: str
-    button_text: str
-    button_url: str
+    async def execute(self, sql: str, params: Tuple = ()) -> None:
+        async with self.write() as db:
+            await db.execute(sql, params)
 
 
-async def get_welcome() -> WelcomeConfig:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        cur = await db.execute("""
-            SELECT media_type, media_file_id, text, button_text, button_url
-            FROM welcome WHERE id=1
-        """)
-        row = await cur.fetchone()
-        return WelcomeConfig(
-            media_type=row[0],
-            media_file_id=row[1],
-            text=row[2] or "",
-            button_text=row[3] or "Открыть",
-            button_url=row[4] or "https://t.me/",
-        )
+UPSERT_USER_SQL = """
+INSERT INTO users (user_id, username, first_name, last_name, created_at, source_chat_id, last_active_at, is_blocked)
+VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+ON CONFLICT(user_id) DO UPDATE SET
+    username=excluded.username,
+    first_name=excluded.first_name,
+    last_name=excluded.last_name,
+    source_chat_id=COALESCE(users.source_chat_id, excluded.source_chat_id),
+    last_active_at=excluded.last_active_at
+"""
 
+USER_EXPORT_COLUMNS = (
+    "user_id", "username", "first_name", "last_name", "created_at", "source_chat_id", "last_active_at", "is_blocked"
+)
 
-async def set_welcome_text(text: str) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        await db.execute("UPDATE welcome SET text=? WHERE id=1", (text,))
-        await db.commit()
+# MIN()/MAX() of two values are NULL if either is; keep the other one then
+IMPORT_USER_SQL = f"""
+INSERT INTO users ({", ".join(USER_EXPORT_COLUMNS)})
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    username=excluded.username,
+    first_name=excluded.first_name,
+    last_name=excluded.last_name,
+    created_at=COALESCE(MIN(users.created_at, excluded.created_at), users.created_at, excluded.created_at),
+    source_chat_id=COALESCE(users.source_chat_id, excluded.source_chat_id),
+    last_active_at=COALESCE(MAX(users.last_active_at, excluded.last_active_at), users.last_active_at, excluded.last_active_at),
+    is_blocked=excluded.is_blocked
+"""
 
 
-async def set_welcome_button(btn_text: str, btn_url: str) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        await db.execute("UPDATE welcome SET button_text=?, button_url=? WHERE id=1", (btn_text, btn_url))
-        await db.commit()
+# Everything the bot persists goes through one of these; STORAGE picks the
+# backend. Rows come back as plain tuples in the column order of the SELECTs
+# (CHANNEL_COLUMNS, BROADCAST_JOB_COLUMNS), the helpers below build objects.
+class Storage(ABC):
+    @abstractmethod
+    async def open(self) -> None: ...
 
+    @abstractmethod
+    async def close(self) -> None: ...
 
-async def set_welcome_media(media_type: Optional[str], media_file_id: Optional[str]) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        await db.execute("UPDATE welcome SET media_type=?, media_file_id=? WHERE id=1", (media_type, media_file_id))
-        await db.commit()
+    # create missing tables/columns/rows; safe to run on every start
+    @abstractmethod
+    async def init(self) -> None: ...
 
+    # users: upserts are UPSERT_USER_SQL rows, blocked is (is_blocked, user_id);
+    # both go in one transaction
+    @abstractmethod
+    async def write_users(self, upserts: List[Tuple], blocked: List[Tuple[int, int]]) -> None: ...
 
-async def get_stats() -> Tuple[int, int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        cur = await db.execute("SELECT COUNT(*) FROM users")
-        (total,) = await cur.fetchone()
-        cur = await db.execute("SELECT COUNT(*) FROM users WHERE is_blocked=1")
-        (blocked,) = await cur.fetchone()
-        return total, blocked
+    # (total, blocked, joined on `day`, joined in the 7 days up to `day`),
+    # read from the counters; day is a UTC day number (unix time // 86400)
+    @abstractmethod
+    async def user_stats(self, day: int) -> Tuple[int, int, int, int]: ...
 
+    # Recount the counters from users with writes held off:
+    # (stats before, stats after) as user_stats() tuples
+    @abstractmethod
+    async def user_stats_rebuild(self, day: int) -> Tuple[Tuple[int, int, int, int], Tuple[int, int, int, int]]: ...
 
-async def get_broadcast_targets() -> List[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        cur = await db.execute("SELECT user_id FROM users WHERE is_blocked=0")
-        rows = await cur.fetchall()
-        return [r[0] for r in rows]
+    # Every user as USER_EXPORT_COLUMNS rows in user_id order, `batch` rows at a
+    # time off one DB cursor (one snapshot, nothing fetched ahead)
+    @abstractmethod
+    def users_dump(self, batch: int) -> AsyncIterator[List[tuple]]: ...
 
+    # Upsert USER_EXPORT_COLUMNS rows in one transaction. The imported row
+    # wins, except: the earliest created_at, the latest last_active_at, and
+    # a source_chat_id that is already set stay.
+    @abstractmethod
+    async def users_import(self, rows: List[Tuple]) -> None: ...
 
-async def admin_state_set(admin_id: int, state: Optional[str]) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        if state is None:
-            await db.execute("DELETE FROM admin_state WHERE admin_id=?", (admin_id,))
-        else:
-            await db.execute("INSERT OR REPLACE INTO admin_state (admin_id, state) VALUES (?,?)", (admin_id, state))
-        await db.commit()
+    # targets: not blocked, in the segment, after < user_id <= upto
+    @abstractmethod
+    async def target_page(
+        self, segment: "Segment", after: Optional[int], limit: int, upto: Optional[int] = None
+    ) -> List[int]: ...
 
+    @abstractmethod
+    async def target_count(self, segment: "Segment", after: Optional[int] = None, upto: Optional[int] = None) -> int: ...
 
-async def admin_state_get(admin_id: int) -> Optional[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        cur = await db.execute("SELECT state FROM admin_state WHERE admin_id=?", (admin_id,))
-        row = await cur.fetchone()
-        return row[0] if row else None
+    # user_id of the target `offset` places past `after`, for shard boundaries
+    @abstractmethod
+    async def target_nth(self, segment: "Segment", after: Optional[int], offset: int) -> Optional[int]: ...
 
+    @abstractmethod
+    async def target_sources(self) -> List[Tuple[int, int]]: ...
 
-async def broadcast_is_running() -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        cur = await db.execute("SELECT is_running FROM broadcast_lock WHERE id=1")
-        (v,) = await cur.fetchone()
-        return bool(v)
+    # settings
+    @abstractmethod
+    async def get_enabled(self) -> bool: ...
 
+    @abstractmethod
+    async def set_enabled(self, enabled: bool) -> None: ...
 
-async def broadcast_lock_set(running: bool) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA busy_timeout=5000;")
-        await db.execute("UPDATE broadcast_lock SET is_running=? WHERE id=1", (1 if running else 0,))
-        await db.commit()
+    @abstractmethod
+    async def sweep_cursor_load(self) -> Optional[int]: ...
 
+    @abstractmethod
+    async def sweep_cursor_save(self, cursor: Optional[int]) -> None: ...
 
-# =========================
-# UI (Reply keyboards only)
-# =========================
-async def kb_admin_main() -> ReplyKeyboardMarkup:
-    enabled = await get_enabled()
-    toggle_label = "🟢 Бот включен" if enabled else "🔴 Бот выключен"
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=toggle_label)],
-            [KeyboardButton(text="📌 Приветствие"), KeyboardButton(text="📊 Статистика")],
-            [KeyboardButton(text="📣 Рассылка"), KeyboardButton(text="⛔ Стоп рассылка")],
-            [KeyboardButton(text="❌ Отмена")],
-        ],
-        resize_keyboard=True,
-        is_persistent=True,
-    )
+    # channels + their welcome message
+    @abstractmethod
+    async def channels_load(self) -> List[tuple]: ...
 
+    @abstractmethod
+    async def channel_load(self, chat_id: int) -> Optional[tuple]: ...
 
-def kb_welcome_menu() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="✏️ Текст приветствия"), KeyboardButton(text="🖼/🎥 Медиа")],
-            [KeyboardButton(text="🔘 Кнопка"), KeyboardButton(text="🗑 Удалить медиа")],
-            [KeyboardButton(text="👀 Предпросмотр"), KeyboardButton(text="⬅️ Назад")],
-            [KeyboardButton(text="❌ Отмена")],
-        ],
-        resize_keyboard=True,
-        is_persistent=True,
-    )
+    # copy of the template row; False if the channel already had a row
+    @abstractmethod
+    async def channel_insert(self, chat_id: int, title: Optional[str], template_id: int) -> bool: ...
 
+    @abstractmethod
+    async def channel_update(self, chat_id: int, values: Dict[str, Any]) -> None: ...
 
-def welcome_inline_kb(cfg: WelcomeConfig) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=cfg.button_text, url=cfg.button_url)]])
+    # admin FSM; data is JSON, state and data both None = forget the admin
+    @abstractmethod
+    async def admin_state_save(self, admin_id: int, state: Optional[str], data: Optional[str]) -> None: ...
 
+    @abstractmethod
+    async def admin_state_load(self) -> List[Tuple[int, Optional[str], Optional[str]]]: ...
 
-async def show_admin_panel(message: Message):
-    await message.answer("Админ-панель 👇", reply_markup=await kb_admin_main())
+    # broadcasts. values: admin_id, payload_type, payload_file_id,
+    # payload_caption, source_chat_id, message_ids, button_text, button_url,
+    # segment, total; shards: (lo, hi) per shard, inserted with the job
+    @abstractmethod
+    async def broadcast_job_insert(self, values: Tuple, shards: List[Tuple[Optional[int], Optional[int]]]) -> int: ...
 
+    # values: broadcast_jobs column -> new value
+    @abstractmethod
+    async def broadcast_job_update(self, job_id: int, values: Dict[str, Any]) -> None: ...
 
-async def show_welcome_panel(message: Message):
-    await message.answer("Настройки приветствия 👇", reply_markup=kb_welcome_menu())
+    # one shard carrying the job's own checkpoint, for jobs from before shards
+    @abstractmethod
+    async def broadcast_job_adopt(self, job_id: int) -> None: ...
 
+    @abstractmethod
+    async def broadcast_jobs_running(self) -> List[tuple]: ...
 
-# =========================
-# Core: send welcome
-# =========================
-async def send_welcome(bot: Bot, chat_id: int, cfg: WelcomeConfig) -> None:
-    kb = welcome_inline_kb(cfg)
+    @abstractmethod
+    async def broadcast_job_last(self) -> Optional[tuple]: ...
 
-    if cfg.media_type == "photo" and cfg.media_file_id:
-        await bot.send_photo(chat_id, photo=cfg.media_file_id, caption=cfg.text, reply_markup=kb)
-        return
+    # (sent, failed, retries, flood-wait seconds, msg/s of the live leases) over all shards
+    @abstractmethod
+    async def broadcast_progress(self, job_id: int) -> Tuple[int, int, int, float, float]: ...
 
-    if cfg.media_type == "video" and cfg.media_file_id:
-        await bot.send_video(chat_id, video=cfg.media_file_id, caption=cfg.text, reply_markup=kb)
-        return
+    # Take a free or expired shard of a running job for `ttl` seconds:
+    # (job row, SHARD_COLUMNS row, live leases incl. this one), or None
+    @abstractmethod
+    async def broadcast_shard_lease(self, owner: str, ttl: float) -> Optional[Tuple[tuple, tuple, int]]: ...
 
-    await bot.send_message(chat_id, cfg.text, reply_markup=kb)
+    # Checkpoint a shard we hold and extend the lease by `ttl` (None =
+    # release it); values: status, cursor, done_above, sent, failed,
+    # retries, wait, rate.
+    # Deliveries go in the same transaction. Returns (job status, paused,
+    # live leases), or None when the lease was lost to another worker.
+    @abstractmethod
+    async def broadcast_shard_save(
+        self, job_id: int, shard: int, owner: str, values: Tuple, ttl: Optional[float], deliveries: List[Tuple] = ()
+    ) -> Optional[Tuple[str, bool, int]]: ...
 
+    # running -> done once every shard is done; True for the one caller that flipped it
+    @abstractmethod
+    async def broadcast_job_finish(self, job_id: int) -> bool: ...
 
-# =========================
-# Broadcast
-# =========================
-BROADCAST_STOP = False
+    @abstractmethod
+    async def broadcast_delivery_report(self, broadcast_id: int) -> "DeliveryReport": ...
 
+    # scheduled broadcasts. values: admin_id, source_chat_id, message_ids,
+    # button_text, button_url, segment, recurrence, next_run_at
+    @abstractmethod
+    async def schedule_insert(self, values: Tuple) -> int: ...
 
-async def run_broadcast(bot: Bot, admin_id: int, payload_type: str, payload_id: Optional[str], payload_caption: str):
-    global BROADCAST_STOP
-    BROADCAST_STOP = False
+    @abstractmethod
+    async def schedule_load(self, schedule_id: int) -> Optional[tuple]: ...
 
-    try:
-        await broadcast_lock_set(True)
+    @abstractmethod
+    async def schedules_active(self) -> List[tuple]: ...
 
-        targets = await get_broadcast_targets()
-        sent = 0
-        failed = 0
-        delay = 1.0 / max(1, BROADCAST_RPS)
+    # Take the run due at `run_at` and move the schedule on to `next_run_at`
+    # (None = it was the last one). True for the one process that got it.
+    @abstractmethod
+    async def schedule_claim(self, schedule_id: int, run_at: int, next_run_at: Optional[int]) -> bool: ...
 
-        for uid in targets:
-            if BROADCAST_STOP:
-                break
-            try:
-                if payload_type == "photo":
-                    await bot.send_photo(uid, photo=payload_id, caption=payload_caption)
-                elif payload_type == "video":
-                    await bot.send_video(uid, video=payload_id, caption=payload_caption)
-                else:
-                    await bot.send_message(uid, payload_caption)
-                sent += 1
-            except Exception as e:
-                failed += 1
-                msg = str(e).lower()
-                if "blocked" in msg or "forbidden" in msg:
-                    await mark_blocked(uid, True)
+    # values: broadcast_schedules column -> new value
+    @abstractmethod
+    async def schedule_update(self, schedule_id: int, values: Dict[str, Any]) -> None: ...
 
-            await asyncio.sleep(delay)
 
-        if BROADCAST_STOP:
-            await bot.send_message(admin_id, f"⛔ Рассылка остановлена.\nОтправлено: {sent}\nОшибок: {failed}")
-        else:
-            await bot.send_message(admin_id, f"✅ Рассылка завершена.\nОтправлено: {sent}\nОшибок: {failed}")
+USER_STATS_SQL = """
+SELECT total, blocked,
+    (SELECT COALESCE(SUM(joined), 0) FROM user_joins WHERE day=?),
+    (SELECT COALESCE(SUM(joined), 0) FROM user_joins WHERE day>?)
+FROM user_counters WHERE id=1
+"""
 
-    except Exception:
-        logging.exception("Broadcast crashed")
-        try:
-            await bot.send_message(admin_id, "⚠️ Рассылка упала с ошибкой. Смотрите консоль.")
-        except Exception:
-            pass
-    finally:
-        await broadcast_lock_set(False)
 
+class SqliteStorage(Storage):
+    def __init__(self, path: str = DB_PATH, readers: int = DB_READERS):
+        self.path = path
+        self.db = Database(path, readers)
 
-# =========================
-# Error handler (anti-crash)
-# =========================
-async def on_error(event: ErrorEvent):
-    logging.exception("Unhandled error: %s", event.exception)
-    return True
+    async def open(self) -> None:
+        await self.db.open()
 
+    async def close(self) -> None:
+        await self.db.close()
 
-# =========================
-# Handlers
-# =========================
-async def cmd_start(message: Message):
-    # store user anyway
-    try:
-        await upsert_user(message.from_user)
-    except Exception:
-        pass
+    async def init(self) -> None:
+        await sqlite_init(self.path)
 
-    # users -> silence
-    if not is_admin(message.from_user.id):
-        return
+    async def write_users(self, upserts: List[Tuple], blocked: List[Tuple[int, int]]) -> None:
+        async with self.db.write() as db:
+            # upserts first, so a flag for a brand-new user hits an existing row
+            if upserts:
+                await db.executemany(UPSERT_USER_SQL, upserts)
+            if blocked:
+                await db.executemany("UPDATE users SET is_blocked=? WHERE user_id=?", blocked)
 
-    await show_admin_panel(message)
+    async def user_stats(self, day: int) -> Tuple[int, int, int, int]:
+        return await self.db.fetchone(USER_STATS_SQL, (day, day - 7))
 
+    async def user_stats_rebuild(self, day: int) -> Tuple[Tuple[int, int, int, int], Tuple[int, int, int, int]]:
+        async with self.db.write() as db:
+            # take the write lock before reading, so "before" is what the recount replaces
+            await db.execute("BEGIN IMMEDIATE")
+            async with db.execute(USER_STATS_SQL, (day, day - 7)) as cur:
+                before = await cur.fetchone()
+            for sql in SQLITE_COUNTERS_REBUILD:
+                await db.execute(sql)
+            async with db.execute(USER_STATS_SQL, (day, day - 7)) as cur:
+                after = await cur.fetchone()
+        return before, after
 
-async def cmd_admin(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-    await admin_state_set(message.from_user.id, None)
-    await show_admin_panel(message)
+    async def users_dump(self, batch: int) -> AsyncIterator[List[tuple]]:
+        async with self.db.read() as db:
+            async with db.execute(f"SELECT {', '.join(USER_EXPORT_COLUMNS)} FROM users ORDER BY user_id") as cur:
+                while rows := await cur.fetchmany(batch):
+                    yield rows
 
+    async def users_import(self, rows: List[Tuple]) -> None:
+        async with self.db.write() as db:
+            await db.executemany(IMPORT_USER_SQL, rows)
 
-async def on_join_request(event: ChatJoinRequest, bot: Bot):
-    # if disabled -> do nothing
-    if not await get_enabled():
-        return
+    async def target_page(
+        self, segment: "Segment", after: Optional[int], limit: int, upto: Optional[int] = None
+    ) -> List[int]:
+        where, params = segment.where(after, upto)
+        rows = await self.db.fetchall(
+            f"SELECT user_id FROM users WHERE is_blocked=0{where} ORDER BY user_id LIMIT ?", params + (limit,)
+        )
+        return [uid for (uid,) in rows]
 
-    if CHANNEL_ID is not None and event.chat.id != CHANNEL_ID:
-        return
+    async def target_count(self, segment: "Segment", after: Optional[int] = None, upto: Optional[int] = None) -> int:
+        # one pass over the segment's partial index (or the table, if SQLite finds that cheaper)
+        where, params = segment.where(after, upto)
+        (n,) = await self.db.fetchone(f"SELECT COUNT(*) FROM users WHERE is_blocked=0{where}", params)
+        return n
 
-    await upsert_user(event.from_user)
-    cfg = await get_welcome()
+    async def target_nth(self, segment: "Segment", after: Optional[int], offset: int) -> Optional[int]:
+        where, params = segment.where(after)
+        row = await self.db.fetchone(
+            f"SELECT user_id FROM users WHERE is_blocked=0{where} ORDER BY user_id LIMIT 1 OFFSET ?",
+            params + (offset,),
+        )
+        return row[0] if row else None
 
-    try:
-        await send_welcome(bot, event.user_chat_id, cfg)
-    except Exception as e:
-        msg = str(e).lower()
-        if "blocked" in msg or "forbidden" in msg:
-            await mark_blocked(event.from_user.id, True)
+    async def target_sources(self) -> List[Tuple[int, int]]:
+        return await self.db.fetchall(
+            "SELECT source_chat_id, COUNT(*) FROM users WHERE is_blocked=0 AND source_chat_id IS NOT NULL "
+            "GROUP BY source_chat_id ORDER BY 2 DESC"
+        )
 
+    async def get_enabled(self) -> bool:
+        (v,) = await self.db.fetchone("SELECT is_enabled FROM settings WHERE id=1")
+        return bool(v)
 
-async def admin_router(message: Message, bot: Bot):
-    global BROADCAST_STOP
+    async def set_enabled(self, enabled: bool) -> None:
+        await self.db.execute("UPDATE settings SET is_enabled=? WHERE id=1", (1 if enabled else 0,))
 
-    # admin panel only in private chat
-    if message.chat.type != "private":
-        return
-    if not message.from_user or not is_admin(message.from_user.id):
-        return
+    async def sweep_cursor_load(self) -> Optional[int]:
+        (v,) = await self.db.fetchone("SELECT sweep_cursor FROM settings WHERE id=1")
+        return v
 
-    txt_raw = (message.text or "").strip()
-    txt = txt_raw.lower()
-
-    # Toggle bot enabled
-    if txt_raw in {"🟢 Бот включен", "🔴 Бот выключен"}:
-        cur = await get_enabled()
-        await set_enabled(not cur)
-        await admin_state_set(message.from_user.id, None)
-        status = "🟢 Включил" if not cur else "🔴 Выключил"
-        return await message.answer(f"{status}.", reply_markup=await kb_admin_main())
-
-    # Cancel
-    if txt_raw == "❌ Отмена" or txt in {"отмена", "/cancel"}:
-        await admin_state_set(message.from_user.id, None)
-        return await message.answer("Ок, отменено.", reply_markup=await kb_admin_main())
-
-    # Stop broadcast
-    if txt_raw == "⛔ Стоп рассылка" or txt in {"стоп рассылка", "stop"}:
-        if await broadcast_is_running():
-            BROADCAST_STOP = True
-            return await message.answer("⛔ Останавливаю рассылку…", reply_markup=await kb_admin_main())
-        return await message.answer("Сейчас рассылка не идёт.", reply_markup=await kb_admin_main())
+    async def sweep_cursor_save(self, cursor: Optional[int]) -> None:
+        await self.db.execute("UPDATE settings SET sweep_cursor=? WHERE id=1", (cursor,))
 
-    # Welcome menu
-    if txt in {"📌 приветствие", "приветствие"}:
-        await admin_state_set(message.from_user.id, None)
-        return await show_welcome_panel(message)
-
-    # Back
-    if txt_raw == "⬅️ Назад" or txt in {"назад"}:
-        await admin_state_set(message.from_user.id, None)
-        return await show_admin_panel(message)
-
-    # Stats
-    if txt in {"📊 статистика", "статистика"}:
-        await admin_state_set(message.from_user.id, None)
-        total, blocked = await get_stats()
-        enabled = await get_enabled()
-        st = "🟢 Включен" if enabled else "🔴 Выключен"
-        return await message.answer(
-            f"📊 Статистика\n\n"
-            f"Статус: <b>{st}</b>\n"
-            f"Всего пользователей: <b>{total}</b>\n"
-            f"Недоступны: <b>{blocked}</b>\n"
-            f"Доступны: <b>{max(0, total - blocked)}</b>",
-            reply_markup=await kb_admin_main(),
-        )
+    async def channels_load(self) -> List[tuple]:
+        return await self.db.fetchall(f"SELECT {CHANNEL_COLUMNS} FROM channels")
 
-    # Broadcast start
-    if txt in {"📣 рассылка", "рассылка"}:
-        if await broadcast_is_running():
-            return await message.answer(
-                "⏳ Рассылка уже идёт. Дождитесь завершения или нажмите ⛔ Стоп рассылка.",
-                reply_markup=await kb_admin_main(),
+    async def channel_load(self, chat_id: int) -> Optional[tuple]:
+        return await self.db.fetchone(f"SELECT {CHANNEL_COLUMNS} FROM channels WHERE chat_id=?", (chat_id,))
+
+    async def channel_insert(self, chat_id: int, title: Optional[str], template_id: int) -> bool:
+        async with self.db.write() as db:
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO channels (chat_id, title, is_enabled, media_type, media_file_id, "
+                "text, button_text, button_url) SELECT ?, ?, 1, media_type, media_file_id, text, "
+                "button_text, button_url FROM channels WHERE chat_id=?",
+                (chat_id, title, template_id),
             )
-        await admin_state_set(message.from_user.id, "broadcast_wait_message")
-        return await message.answer(
-            "📣 Пришлите сообщение для рассылки:\n— текст\n— или фото/видео с подписью\n\nОтмена: ❌ Отмена",
-            reply_markup=await kb_admin_main(),
+            return cur.rowcount == 1
+
+    async def channel_update(self, chat_id: int, values: Dict[str, Any]) -> None:
+        columns = ", ".join(f"{k}=?" for k in values)
+        await self.db.execute(f"UPDATE channels SET {columns} WHERE chat_id=?", (*values.values(), chat_id))
+
+    async def admin_state_save(self, admin_id: int, state: Optional[str], data: Optional[str]) -> None:
+        if state is None and data is None:
+            await self.db.execute("DELETE FROM admin_state WHERE admin_id=?", (admin_id,))
+        else:
+            await self.db.execute(
+                "INSERT OR REPLACE INTO admin_state (admin_id, state, data) VALUES (?,?,?)",
+                (admin_id, state, data),
+            )
+
+    async def admin_state_load(self) -> List[Tuple[int, Optional[str], Optional[str]]]:
+        return await self.db.fetchall("SELECT admin_id, state, data FROM admin_state")
+
+    async def broadcast_job_insert(self, values: Tuple, shards: List[Tuple[Optional[int], Optional[int]]]) -> int:
+        async with self.db.write() as db:
+            cur = await db.execute(
+                "INSERT INTO broadcast_jobs (admin_id, payload_type, payload_file_id, payload_caption, "
+                "source_chat_id, message_ids, button_text, button_url, segment, total, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'running', strftime('%s','now'), strftime('%s','now'))",
+                values,
+            )
+            job_id = cur.lastrowid
+            # a shard's checkpoint starts at its lower bound
+            await db.executemany(
+                "INSERT INTO broadcast_shards (broadcast_id, shard, lo, hi, cursor) VALUES (?, ?, ?, ?, ?)",
+                [(job_id, i, lo, hi, lo) for i, (lo, hi) in enumerate(shards)],
+            )
+            return job_id
+
+    async def broadcast_job_update(self, job_id: int, values: Dict[str, Any]) -> None:
+        columns = ", ".join(f"{k}=?" for k in values)
+        await self.db.execute(
+            f"UPDATE broadcast_jobs SET {columns}, updated_at=strftime('%s','now') WHERE id=?",
+            (*values.values(), job_id),
         )
 
-    # Welcome actions
-    if txt_raw == "✏️ Текст приветствия":
-        await admin_state_set(message.from_user.id, "welcome_wait_text")
-        return await message.answer("Пришлите новый текст приветствия (можно HTML).", reply_markup=kb_welcome_menu())
+    async def broadcast_job_adopt(self, job_id: int) -> None:
+        await self.db.execute(
+            "INSERT OR IGNORE INTO broadcast_shards (broadcast_id, shard, cursor, done_above, sent, failed) "
+            "SELECT id, 0, cursor, done_above, sent, failed FROM broadcast_jobs WHERE id=?",
+            (job_id,),
+        )
 
-    if txt_raw == "🖼/🎥 Медиа":
-        await admin_state_set(message.from_user.id, "welcome_wait_media")
-        return await message.answer("Пришлите ОДНО: фото или видео для приветствия.", reply_markup=kb_welcome_menu())
+    async def broadcast_jobs_running(self) -> List[tuple]:
+        return await self.db.fetchall(
+            f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE status='running' ORDER BY id"
+        )
 
-    if txt_raw == "🔘 Кнопка":
-        await admin_state_set(message.from_user.id, "welcome_wait_button")
-        return await message.answer(
-            "Пришлите кнопку в формате:\n\n<b>Текст</b> | <b>https://ссылка</b>\n\nПример:\nПравила | https://t.me/yourchannel/123",
-            reply_markup=kb_welcome_menu(),
+    async def broadcast_job_last(self) -> Optional[tuple]:
+        return await self.db.fetchone(
+            f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs ORDER BY id DESC LIMIT 1"
         )
 
-    if txt_raw == "🗑 Удалить медиа":
-        await set_welcome_media(None, None)
-        await admin_state_set(message.from_user.id, None)
-        return await message.answer("✅ Медиа удалено.", reply_markup=kb_welcome_menu())
+    async def broadcast_progress(self, job_id: int) -> Tuple[int, int, int, float, float]:
+        return await self.db.fetchone(
+            "SELECT COALESCE(SUM(sent), 0), COALESCE(SUM(failed), 0), COALESCE(SUM(retries), 0), "
+            "COALESCE(SUM(wait), 0), "
+            "COALESCE(SUM(CASE WHEN owner IS NOT NULL AND lease_until > ? THEN rate ELSE 0 END), 0) "
+            "FROM broadcast_shards WHERE broadcast_id=?",
+            (time.time(), job_id),
+        )
 
-    if txt_raw == "👀 Предпросмотр":
-        cfg = await get_welcome()
-        await admin_state_set(message.from_user.id, None)
-        await message.answer("Предпросмотр (как увидит пользователь):", reply_markup=kb_welcome_menu())
-        try:
-            await send_welcome(bot, message.from_user.id, cfg)
-        except Exception:
-            await message.answer("Не удалось отправить предпросмотр.")
-        return
+    @staticmethod
+    async def _live_leases(db: aiosqlite.Connection, now: float) -> int:
+        async with db.execute(
+            "SELECT COUNT(*) FROM broadcast_shards WHERE status='pending' AND owner IS NOT NULL AND lease_until > ?",
+            (now,),
+        ) as cur:
+            (n,) = await cur.fetchone()
+        return n
 
-    # State machine
-    state = await admin_state_get(message.from_user.id)
-    if not state:
-        return
+    async def broadcast_shard_lease(self, owner: str, ttl: float) -> Optional[Tuple[tuple, tuple, int]]:
+        async with self.db.write() as db:
+            # take the write lock before reading: a plain SELECT runs outside any
+            # transaction, and two processes could both lease the shard it found
+            await db.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            async with db.execute(
+                f"SELECT {SHARD_COLUMNS} FROM broadcast_shards "
+                "WHERE status='pending' AND (owner IS NULL OR lease_until < ?) "
+                "AND broadcast_id IN (SELECT id FROM broadcast_jobs WHERE status='running') "
+                "ORDER BY broadcast_id, shard LIMIT 1",
+                (now,),
+            ) as cur:
+                shard = await cur.fetchone()
+            if shard is None:
+                return None
+            await db.execute(
+                "UPDATE broadcast_shards SET owner=?, lease_until=? WHERE broadcast_id=? AND shard=?",
+                (owner, now + ttl, shard[0], shard[1]),
+            )
+            async with db.execute(f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE id=?", (shard[0],)) as cur:
+                job = await cur.fetchone()
+            return job, shard, await self._live_leases(db, now)
 
-    if state == "welcome_wait_text":
-        text_value = (message.html_text or message.text or "").strip()
-        if not text_value:
-            return await message.answer("Текст пустой. Пришлите ещё раз или нажмите ❌ Отмена.")
-        await set_welcome_text(text_value)
-        await admin_state_set(message.from_user.id, None)
-        return await message.answer("✅ Текст сохранён.", reply_markup=kb_welcome_menu())
-
-    if state == "welcome_wait_button":
-        raw = (message.text or "").strip()
-        m = re.match(r"^(.*?)\s*\|\s*(https?://\S+)\s*$", raw)
-        if not m:
-            return await message.answer("Формат неверный. Пример:\nПравила | https://t.me/yourchannel/123")
-        btn_text = m.group(1).strip()
-        btn_url = m.group(2).strip()
-        await set_welcome_button(btn_text, btn_url)
-        await admin_state_set(message.from_user.id, None)
-        return await message.answer("✅ Кнопка обновлена.", reply_markup=kb_welcome_menu())
-
-    if state == "welcome_wait_media":
-        if message.photo:
-            file_id = message.photo[-1].file_id
-            await set_welcome_media("photo", file_id)
-            await admin_state_set(message.from_user.id, None)
-            return await message.answer("✅ Фото сохранено.", reply_markup=kb_welcome_menu())
-        if message.video:
-            file_id = message.video.file_id
-            await set_welcome_media("video", file_id)
-            await admin_state_set(message.from_user.id, None)
-            return await message.answer("✅ Видео сохранено.", reply_markup=kb_welcome_menu())
-        return await message.answer("Нужно прислать фото или видео. Или нажмите ❌ Отмена.")
-
-    if state == "broadcast_wait_message":
-        if await broadcast_is_running():
-            await admin_state_set(message.from_user.id, None)
-            return await message.answer(
-                "⏳ Рассылка уже идёт. Дождитесь завершения или нажмите ⛔ Стоп рассылка.",
-                reply_markup=await kb_admin_main(),
+    async def broadcast_shard_save(
+        self, job_id: int, shard: int, owner: str, values: Tuple, ttl: Optional[float], deliveries: List[Tuple] = ()
+    ) -> Optional[Tuple[str, bool, int]]:
+        now = time.time()
+        lease = (owner, now + ttl) if ttl is not None else (None, None)
+        async with self.db.write() as db:
+            # sends that happened are logged even if the lease is gone
+            if deliveries:
+                await db.executemany(
+                    "INSERT OR REPLACE INTO broadcast_deliveries "
+                    "(broadcast_id, user_id, status, error, latency_ms, sent_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    deliveries,
+                )
+            cur = await db.execute(
+                "UPDATE broadcast_shards SET status=?, cursor=?, done_above=?, sent=?, failed=?, retries=?, wait=?, rate=?, "
+                "owner=?, lease_until=? WHERE broadcast_id=? AND shard=? AND owner=?",
+                (*values, *lease, job_id, shard, owner),
+            )
+            if cur.rowcount != 1:
+                return None
+            await db.execute(
+                "UPDATE broadcast_jobs SET "
+                "sent=(SELECT SUM(sent) FROM broadcast_shards WHERE broadcast_id=?), "
+                "failed=(SELECT SUM(failed) FROM broadcast_shards WHERE broadcast_id=?), "
+                "updated_at=strftime('%s','now') WHERE id=?",
+                (job_id, job_id, job_id),
             )
+            async with db.execute("SELECT status, paused FROM broadcast_jobs WHERE id=?", (job_id,)) as cur:
+                status, paused = await cur.fetchone()
+            return status, bool(paused), await self._live_leases(db, now)
 
-        targets_count = len(await get_broadcast_targets())
-        if targets_count == 0:
-            await admin_state_set(message.from_user.id, None)
-            return await message.answer("Нет пользователей для рассылки.", reply_markup=await kb_admin_main())
-
-        if message.photo:
-            payload_type = "photo"
-            payload_id = message.photo[-1].file_id
-            payload_caption = message.html_text or message.caption or ""
-        elif message.video:
-            payload_type = "video"
-            payload_id = message.video.file_id
-            payload_caption = message.html_text or message.caption or ""
-        else:
-            payload_type = "text"
-            payload_id = None
-            payload_caption = message.html_text or message.text or ""
+    async def broadcast_job_finish(self, job_id: int) -> bool:
+        async with self.db.write() as db:
+            cur = await db.execute(
+                "UPDATE broadcast_jobs SET status='done', updated_at=strftime('%s','now') "
+                "WHERE id=? AND status='running' "
+                "AND NOT EXISTS (SELECT 1 FROM broadcast_shards WHERE broadcast_id=? AND status!='done')",
+                (job_id, job_id),
+            )
+            return cur.rowcount == 1
 
-        await admin_state_set(message.from_user.id, None)
-        await message.answer(
-            f"✅ Принято. Запускаю рассылку в фоне.\nПользователей: {targets_count}\n(Бот продолжит работать)",
-            reply_markup=await kb_admin_main(),
-        )
-        asyncio.create_task(run_broadcast(bot, message.from_user.id, payload_type, payload_id, payload_caption))
-        return
+    async def broadcast_delivery_report(self, broadcast_id: int) -> "DeliveryReport":
+        # everything is aggregated in SQLite; Python only sees a handful of rows
+        async with self.db.read() as db:
+            async with db.execute("""
+                SELECT status, COALESCE(error, ''), COUNT(*) FROM broadcast_deliveries
+                WHERE broadcast_id=? GROUP BY 1, 2 ORDER BY 3 DESC
+            """, (broadcast_id,)) as cur:
+                outcomes = list(await cur.fetchall())
 
+            # nearest-rank percentiles: rank = ceil(p * n)
+            async with db.execute("""
+                SELECT
+                    MAX(CASE WHEN rn = MAX(1, CAST(n * 0.50 + 0.999999 AS INTEGER)) THEN latency_ms END),
+                    MAX(CASE WHEN rn = MAX(1, CAST(n * 0.95 + 0.999999 AS INTEGER)) THEN latency_ms END),
+                    MAX(CASE WHEN rn = MAX(1, CAST(n * 0.99 + 0.999999 AS INTEGER)) THEN latency_ms END)
+                FROM (
+                    SELECT latency_ms,
+                           ROW_NUMBER() OVER (ORDER BY latency_ms) AS rn,
+                           COUNT(*) OVER () AS n
+                    FROM broadcast_deliveries WHERE broadcast_id=? AND status='sent'
+                )
+            """, (broadcast_id,)) as cur:
+                p50, p95, p99 = await cur.fetchone()
 
+            async with db.execute("""
+                SELECT MIN(sent_at), MAX(sent_at) FROM broadcast_deliveries WHERE broadcast_id=? AND status='sent'
+            """, (broadcast_id,)) as cur:
+                first, last = await cur.fetchone()
+
+            # ~12 timeline rows whatever the broadcast length, never finer than 10 s
+            bucket = max(10, int(((last or 0) - (first or 0)) / 12) + 1)
+            async with db.execute("""
+                SELECT CAST(sent_at / ? AS INTEGER) * ?, COUNT(*) FROM broadcast_deliveries
+                WHERE broadcast_id=? AND status='sent' GROUP BY 1 ORDER BY 1
+            """, (bucket, bucket, broadcast_id)) as cur:
+                timeline = list(await cur.fetchall())
+
+        return DeliveryReport(outcomes, p50, p95, p99, bucket, timeline)
+
+    async def schedule_insert(self, values: Tuple) -> int:
+        async with self.db.write() as db:
+            cur = await db.execute(
+                "INSERT INTO broadcast_schedules (admin_id, source_chat_id, message_ids, button_text, button_url, "
+                "segment, recurrence, next_run_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, strftime('%s','now'))",
+                values,
+            )
+            return cur.lastrowid
+
+    async def schedule_load(self, schedule_id: int) -> Optional[tuple]:
+        return await self.db.fetchone(f"SELECT {SCHEDULE_COLUMNS} FROM broadcast_schedules WHERE id=?", (schedule_id,))
+
+    async def schedules_active(self) -> List[tuple]:
+        return await self.db.fetchall(
+            f"SELECT {SCHEDULE_COLUMNS} FROM broadcast_schedules WHERE status='active' ORDER BY next_run_at"
+        )
+
+    async def schedule_claim(self, schedule_id: int, run_at: int, next_run_at: Optional[int]) -> bool:
+        async with self.db.write() as db:
+            cur = await db.execute(
+                "UPDATE broadcast_schedules SET next_run_at=?, status=CASE WHEN ? IS NULL THEN 'done' ELSE status END "
+                "WHERE id=? AND status='active' AND next_run_at=?",
+                (next_run_at, next_run_at, schedule_id, run_at),
+            )
+            return cur.rowcount == 1
+
+    async def schedule_update(self, schedule_id: int, values: Dict[str, Any]) -> None:
+        columns = ", ".join(f"{k}=?" for k in values)
+        await self.db.execute(f"UPDATE broadcast_schedules SET {columns} WHERE id=?", (*values.values(), schedule_id))
+
+
+def pg_placeholders(sql: str) -> str:
+    # "?" (SQLite style, as Segment.where() builds them) -> $1, $2, ...
+    parts = sql.split("?")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+
+
+PG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    created_at BIGINT,
+    is_blocked INTEGER NOT NULL DEFAULT 0,
+    source_chat_id BIGINT,
+    last_active_at BIGINT
+);
+CREATE INDEX IF NOT EXISTS idx_users_active ON users(user_id) WHERE is_blocked=0;
+-- user_id first, as the keyset pages are ordered (see db_init)
+DROP INDEX IF EXISTS idx_users_created;
+DROP INDEX IF EXISTS idx_users_last_active;
+CREATE INDEX IF NOT EXISTS idx_users_created_id ON users(user_id, created_at) WHERE is_blocked=0;
+CREATE INDEX IF NOT EXISTS idx_users_source ON users(source_chat_id) INCLUDE (user_id) WHERE is_blocked=0;
+CREATE INDEX IF NOT EXISTS idx_users_last_active_id ON users(user_id, last_active_at) WHERE is_blocked=0;
+
+CREATE TABLE IF NOT EXISTS settings (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    is_enabled INTEGER NOT NULL
+);
+ALTER TABLE settings ADD COLUMN IF NOT EXISTS sweep_cursor BIGINT;
+INSERT INTO settings (id, is_enabled) VALUES (1, 1) ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS channels (
+    chat_id BIGINT PRIMARY KEY,
+    title TEXT,
+    is_enabled INTEGER NOT NULL DEFAULT 1,
+    media_type TEXT,
+    media_file_id TEXT,
+    text TEXT,
+    button_text TEXT,
+    button_url TEXT
+);
+
+CREATE TABLE IF NOT EXISTS admin_state (
+    admin_id BIGINT PRIMARY KEY,
+    state TEXT,
+    data TEXT
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    admin_id BIGINT NOT NULL,
+    payload_type TEXT NOT NULL,
+    payload_file_id TEXT,
+    payload_caption TEXT,
+    status TEXT NOT NULL,
+    cursor BIGINT,
+    done_above TEXT,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at BIGINT,
+    updated_at BIGINT,
+    segment TEXT,
+    source_chat_id BIGINT,
+    message_ids TEXT,
+    button_text TEXT,
+    button_url TEXT,
+    total INTEGER,
+    paused INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_shards (
+    broadcast_id BIGINT NOT NULL,
+    shard INTEGER NOT NULL,
+    lo BIGINT,
+    hi BIGINT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until DOUBLE PRECISION,
+    cursor BIGINT,
+    done_above TEXT,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    retries INTEGER NOT NULL DEFAULT 0,
+    wait DOUBLE PRECISION NOT NULL DEFAULT 0,
+    rate DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (broadcast_id, shard)
+);
+CREATE INDEX IF NOT EXISTS idx_shards_open ON broadcast_shards(broadcast_id) WHERE status='pending';
+CREATE INDEX IF NOT EXISTS idx_jobs_running ON broadcast_jobs(status) WHERE status='running';
+
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    broadcast_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    latency_ms INTEGER,
+    sent_at DOUBLE PRECISION,
+    PRIMARY KEY (broadcast_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_schedules (
+    id BIGSERIAL PRIMARY KEY,
+    admin_id BIGINT NOT NULL,
+    source_chat_id BIGINT NOT NULL,
+    message_ids TEXT NOT NULL,
+    button_text TEXT,
+    button_url TEXT,
+    segment TEXT NOT NULL,
+    recurrence TEXT,
+    next_run_at BIGINT,
+    status TEXT NOT NULL DEFAULT 'active',
+    last_job_id BIGINT,
+    created_at BIGINT
+);
+CREATE INDEX IF NOT EXISTS idx_schedules_active ON broadcast_schedules(next_run_at) WHERE status='active';
+
+CREATE TABLE IF NOT EXISTS user_counters (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    total BIGINT NOT NULL,
+    blocked BIGINT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_joins (
+    day BIGINT PRIMARY KEY,
+    joined BIGINT NOT NULL
+);
+
+-- Statement-level triggers: one counter update per statement however many
+-- rows it touched (an ON CONFLICT upsert fires the INSERT one for new rows
+-- and the UPDATE one for existing rows).
+CREATE OR REPLACE FUNCTION users_count_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE user_counters SET total=user_counters.total+n.total, blocked=user_counters.blocked+n.blocked
+    FROM (SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE is_blocked=1) AS blocked FROM new_rows) n
+    WHERE id=1 AND n.total > 0;
+    INSERT INTO user_joins (day, joined)
+    SELECT created_at / 86400, COUNT(*) FROM new_rows WHERE created_at IS NOT NULL GROUP BY 1
+    ON CONFLICT (day) DO UPDATE SET joined=user_joins.joined+excluded.joined;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION users_count_update() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE user_counters SET blocked=blocked+d.delta
+    FROM (
+        SELECT COALESCE(SUM((n.is_blocked=1)::int - (o.is_blocked=1)::int), 0) AS delta
+        FROM new_rows n JOIN old_rows o USING (user_id)
+    ) d
+    WHERE id=1 AND d.delta <> 0;
+    -- created_at only changes on import (the earliest one wins)
+    INSERT INTO user_joins (day, joined)
+    SELECT day, SUM(n) FROM (
+        SELECT o.created_at / 86400 AS day, -1 AS n
+        FROM new_rows n JOIN old_rows o USING (user_id)
+        WHERE o.created_at IS NOT NULL AND n.created_at IS DISTINCT FROM o.created_at
+        UNION ALL
+        SELECT n.created_at / 86400, 1
+        FROM new_rows n JOIN old_rows o USING (user_id)
+        WHERE n.created_at IS NOT NULL AND n.created_at IS DISTINCT FROM o.created_at
+    ) d GROUP BY day
+    ON CONFLICT (day) DO UPDATE SET joined=user_joins.joined+excluded.joined;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION users_count_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE user_counters SET total=user_counters.total-o.total, blocked=user_counters.blocked-o.blocked
+    FROM (SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE is_blocked=1) AS blocked FROM old_rows) o
+    WHERE id=1 AND o.total > 0;
+    UPDATE user_joins SET joined=joined-o.n
+    FROM (SELECT created_at / 86400 AS day, COUNT(*) AS n FROM old_rows GROUP BY 1) o
+    WHERE user_joins.day=o.day;
+    RETURN NULL;
+END $$;
+
+DO $$ BEGIN
+    IF NOT EXISTS (SELECT FROM pg_trigger WHERE tgname='users_count_insert') THEN
+        CREATE TRIGGER users_count_insert AFTER INSERT ON users REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION users_count_insert();
+        CREATE TRIGGER users_count_update AFTER UPDATE ON users REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION users_count_update();
+        CREATE TRIGGER users_count_delete AFTER DELETE ON users REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION users_count_delete();
+    END IF;
+    -- first start with counters: count what is there, writers held off
+    IF NOT EXISTS (SELECT FROM user_counters) THEN
+        LOCK TABLE users IN SHARE MODE;
+        DELETE FROM user_joins;
+        INSERT INTO user_joins (day, joined)
+        SELECT created_at / 86400, COUNT(*) FROM users WHERE created_at IS NOT NULL GROUP BY 1;
+        INSERT INTO user_counters (id, total, blocked)
+        SELECT 1, COUNT(*), COUNT(*) FILTER (WHERE is_blocked=1) FROM users;
+    END IF;
+END $$;
+"""
+
+PG_NOW = "EXTRACT(EPOCH FROM now())::BIGINT"
+# leases are timed on the DB server's clock, shared by every worker host
+PG_CLOCK = "EXTRACT(EPOCH FROM clock_timestamp())::DOUBLE PRECISION"
+PG_LIVE_LEASES = (
+    f"SELECT COUNT(*) FROM broadcast_shards WHERE status='pending' AND owner IS NOT NULL AND lease_until > {PG_CLOCK}"
+)
+PG_LOCK_COUNTERS = "SELECT 1 FROM user_counters WHERE id=1 FOR UPDATE"
+# SUM(bigint) is numeric in Postgres; cast back so the stats are ints, not Decimal
+PG_USER_STATS_SQL = """
+SELECT total, blocked,
+    (SELECT COALESCE(SUM(joined), 0)::BIGINT FROM user_joins WHERE day=$1),
+    (SELECT COALESCE(SUM(joined), 0)::BIGINT FROM user_joins WHERE day>$2)
+FROM user_counters WHERE id=1
+"""
+USER_COLUMNS = ("user_id", "username", "first_name", "last_name", "created_at", "source_chat_id", "last_active_at")
+DELIVERY_COLUMNS = ("broadcast_id", "user_id", "status", "error", "latency_ms", "sent_at")
+
+
+# asyncpg pool shared by any number of bot processes. Big batches go through
+# COPY into a temp table and one INSERT ... ON CONFLICT from it; small ones
+# through executemany (pipelined by asyncpg).
+class PostgresStorage(Storage):
+    def __init__(self, dsn: str = DATABASE_URL, min_size: int = PG_POOL_MIN, max_size: int = PG_POOL_MAX):
+        self.dsn = dsn
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self._pool = None
+
+    async def open(self) -> None:
+        if self._pool is not None:
+            return
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError("STORAGE=postgres needs asyncpg (pip install asyncpg).") from None
+        if not self.dsn:
+            raise RuntimeError("DATABASE_URL is missing (required for STORAGE=postgres).")
+        self._pool = await asyncpg.create_pool(
+            self.dsn, min_size=self.min_size, max_size=self.max_size, statement_cache_size=DB_STATEMENT_CACHE
+        )
+
+    async def close(self) -> None:
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await pool.close()
+
+    @asynccontextmanager
+    async def read(self):
+        if self._pool is None:
+            raise RuntimeError("Database is not open")
+        waited = time.perf_counter()
+        async with self._pool.acquire() as conn:
+            started = time.perf_counter()
+            DB_WAIT_SECONDS.observe(started - waited, "read")
+            try:
+                yield conn
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - started, "read")
+
+    @asynccontextmanager
+    async def write(self):
+        # statements of one block form one transaction
+        if self._pool is None:
+            raise RuntimeError("Database is not open")
+        waited = time.perf_counter()
+        async with self._pool.acquire() as conn:
+            started = time.perf_counter()
+            DB_WAIT_SECONDS.observe(started - waited, "write")
+            try:
+                async with conn.transaction():
+                    yield conn
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - started, "write")
+
+    async def fetchone(self, sql: str, *params) -> Optional[tuple]:
+        async with self.read() as conn:
+            row = await conn.fetchrow(sql, *params)
+            return tuple(row) if row is not None else None
+
+    async def fetchall(self, sql: str, *params) -> List[tuple]:
+        async with self.read() as conn:
+            return [tuple(r) for r in await conn.fetch(sql, *params)]
+
+    async def execute(self, sql: str, *params) -> str:
+        async with self.write() as conn:
+            return await conn.execute(sql, *params)
+
+    @staticmethod
+    async def _copy_upsert(conn, table: str, columns: Tuple[str, ...], rows: List[Tuple], upsert_sql: str) -> None:
+        # upsert_sql reads from the temp table "incoming"
+        await conn.execute(f"CREATE TEMP TABLE incoming (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        await conn.copy_records_to_table("incoming", records=rows, columns=columns)
+        await conn.execute(upsert_sql)
+
+    async def init(self) -> None:
+        await self.open()
+        async with self.write() as conn:
+            # replicas starting together: one of them creates the schema
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('bot_schema'))")
+            await conn.execute(PG_SCHEMA)
+            await conn.execute(
+                "INSERT INTO channels (chat_id, text, button_text, button_url) VALUES ($1, $2, $3, $4) "
+                "ON CONFLICT DO NOTHING",
+                TEMPLATE_CHAT_ID, WELCOME_DEFAULT_TEXT, WELCOME_DEFAULT_BUTTON_TEXT, WELCOME_DEFAULT_BUTTON_URL,
+            )
+
+    async def write_users(self, upserts: List[Tuple], blocked: List[Tuple[int, int]]) -> None:
+        async with self.write() as conn:
+            # the counters row first: every users writer takes the same locks
+            # in the same order (the triggers would take it after the rows)
+            await conn.execute(PG_LOCK_COUNTERS)
+            if len(upserts) >= PG_COPY_MIN_ROWS:
+                columns = ", ".join(USER_COLUMNS)
+                await self._copy_upsert(conn, "users", USER_COLUMNS, upserts, f"""
+                    INSERT INTO users ({columns}) SELECT {columns} FROM incoming
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username=excluded.username,
+                        first_name=excluded.first_name,
+                        last_name=excluded.last_name,
+                        source_chat_id=COALESCE(users.source_chat_id, excluded.source_chat_id),
+                        last_active_at=excluded.last_active_at
+                """)
+            elif upserts:
+                await conn.executemany(pg_placeholders(UPSERT_USER_SQL), upserts)
+            if blocked:
+                # all flags in one statement
+                await conn.execute(
+                    "UPDATE users SET is_blocked=v.flag FROM unnest($1::int[], $2::bigint[]) AS v(flag, id) "
+                    "WHERE users.user_id=v.id",
+                    [v for v, _ in blocked], [uid for _, uid in blocked],
+                )
+
+    async def user_stats(self, day: int) -> Tuple[int, int, int, int]:
+        return await self.fetchone(PG_USER_STATS_SQL, day, day - 7)
+
+    async def user_stats_rebuild(self, day: int) -> Tuple[Tuple[int, int, int, int], Tuple[int, int, int, int]]:
+        async with self.write() as conn:
+            await conn.execute(PG_LOCK_COUNTERS)
+            await conn.execute("LOCK TABLE users IN SHARE MODE")
+            before = tuple(await conn.fetchrow(PG_USER_STATS_SQL, day, day - 7))
+            await conn.execute("""
+                DELETE FROM user_joins;
+                INSERT INTO user_joins (day, joined)
+                SELECT created_at / 86400, COUNT(*) FROM users WHERE created_at IS NOT NULL GROUP BY 1;
+                UPDATE user_counters SET total=n.total, blocked=n.blocked
+                FROM (SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE is_blocked=1) AS blocked FROM users) n
+                WHERE id=1;
+            """)
+            after = tuple(await conn.fetchrow(PG_USER_STATS_SQL, day, day - 7))
+        return before, after
+
+    async def users_dump(self, batch: int) -> AsyncIterator[List[tuple]]:
+        # server-side cursors live inside a transaction
+        async with self.read() as conn, conn.transaction(readonly=True):
+            cur = await conn.cursor(f"SELECT {', '.join(USER_EXPORT_COLUMNS)} FROM users ORDER BY user_id")
+            while rows := await cur.fetch(batch):
+                yield [tuple(r) for r in rows]
+
+    async def users_import(self, rows: List[Tuple]) -> None:
+        columns = ", ".join(USER_EXPORT_COLUMNS)
+        async with self.write() as conn:
+            await conn.execute(PG_LOCK_COUNTERS)
+            await self._copy_upsert(conn, "users", USER_EXPORT_COLUMNS, rows, f"""
+                INSERT INTO users ({columns}) SELECT {columns} FROM incoming
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username=excluded.username,
+                    first_name=excluded.first_name,
+                    last_name=excluded.last_name,
+                    created_at=LEAST(users.created_at, excluded.created_at),
+                    source_chat_id=COALESCE(users.source_chat_id, excluded.source_chat_id),
+                    last_active_at=GREATEST(users.last_active_at, excluded.last_active_at),
+                    is_blocked=excluded.is_blocked
+            """)
+
+    async def target_page(
+        self, segment: "Segment", after: Optional[int], limit: int, upto: Optional[int] = None
+    ) -> List[int]:
+        where, params = segment.where(after, upto)
+        rows = await self.fetchall(
+            pg_placeholders(f"SELECT user_id FROM users WHERE is_blocked=0{where} ORDER BY user_id LIMIT ?"),
+            *params, limit,
+        )
+        return [uid for (uid,) in rows]
+
+    async def target_count(self, segment: "Segment", after: Optional[int] = None, upto: Optional[int] = None) -> int:
+        where, params = segment.where(after, upto)
+        (n,) = await self.fetchone(pg_placeholders(f"SELECT COUNT(*) FROM users WHERE is_blocked=0{where}"), *params)
+        return n
+
+    async def target_nth(self, segment: "Segment", after: Optional[int], offset: int) -> Optional[int]:
+        where, params = segment.where(after)
+        row = await self.fetchone(
+            pg_placeholders(f"SELECT user_id FROM users WHERE is_blocked=0{where} ORDER BY user_id LIMIT 1 OFFSET ?"),
+            *params, offset,
+        )
+        return row[0] if row else None
+
+    async def target_sources(self) -> List[Tuple[int, int]]:
+        return await self.fetchall(
+            "SELECT source_chat_id, COUNT(*) FROM users WHERE is_blocked=0 AND source_chat_id IS NOT NULL "
+            "GROUP BY source_chat_id ORDER BY 2 DESC"
+        )
+
+    async def get_enabled(self) -> bool:
+        (v,) = await self.fetchone("SELECT is_enabled FROM settings WHERE id=1")
+        return bool(v)
+
+    async def set_enabled(self, enabled: bool) -> None:
+        await self.execute("UPDATE settings SET is_enabled=$1 WHERE id=1", 1 if enabled else 0)
+
+    async def sweep_cursor_load(self) -> Optional[int]:
+        (v,) = await self.fetchone("SELECT sweep_cursor FROM settings WHERE id=1")
+        return v
+
+    async def sweep_cursor_save(self, cursor: Optional[int]) -> None:
+        await self.execute("UPDATE settings SET sweep_cursor=$1 WHERE id=1", cursor)
+
+    async def channels_load(self) -> List[tuple]:
+        return await self.fetchall(f"SELECT {CHANNEL_COLUMNS} FROM channels")
+
+    async def channel_load(self, chat_id: int) -> Optional[tuple]:
+        return await self.fetchone(f"SELECT {CHANNEL_COLUMNS} FROM channels WHERE chat_id=$1", chat_id)
+
+    async def channel_insert(self, chat_id: int, title: Optional[str], template_id: int) -> bool:
+        status = await self.execute(
+            "INSERT INTO channels (chat_id, title, is_enabled, media_type, media_file_id, text, button_text, "
+            "button_url) SELECT $1, $2, 1, media_type, media_file_id, text, button_text, button_url "
+            "FROM channels WHERE chat_id=$3 ON CONFLICT DO NOTHING",
+            chat_id, title, template_id,
+        )
+        return status == "INSERT 0 1"
+
+    async def channel_update(self, chat_id: int, values: Dict[str, Any]) -> None:
+        columns = ", ".join(f"{k}=${i}" for i, k in enumerate(values, 2))
+        await self.execute(f"UPDATE channels SET {columns} WHERE chat_id=$1", chat_id, *values.values())
+
+    async def admin_state_save(self, admin_id: int, state: Optional[str], data: Optional[str]) -> None:
+        if state is None and data is None:
+            await self.execute("DELETE FROM admin_state WHERE admin_id=$1", admin_id)
+        else:
+            await self.execute(
+                "INSERT INTO admin_state (admin_id, state, data) VALUES ($1, $2, $3) "
+                "ON CONFLICT (admin_id) DO UPDATE SET state=excluded.state, data=excluded.data",
+                admin_id, state, data,
+            )
+
+    async def admin_state_load(self) -> List[Tuple[int, Optional[str], Optional[str]]]:
+        return await self.fetchall("SELECT admin_id, state, data FROM admin_state")
+
+    async def broadcast_job_insert(self, values: Tuple, shards: List[Tuple[Optional[int], Optional[int]]]) -> int:
+        async with self.write() as conn:
+            job_id = await conn.fetchval(
+                "INSERT INTO broadcast_jobs (admin_id, payload_type, payload_file_id, payload_caption, "
+                "source_chat_id, message_ids, button_text, button_url, segment, total, status, created_at, updated_at) "
+                f"VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, 'running', {PG_NOW}, {PG_NOW}) RETURNING id",
+                *values,
+            )
+            await conn.executemany(
+                "INSERT INTO broadcast_shards (broadcast_id, shard, lo, hi, cursor) VALUES ($1, $2, $3, $4, $5)",
+                [(job_id, i, lo, hi, lo) for i, (lo, hi) in enumerate(shards)],
+            )
+            return job_id
+
+    async def broadcast_job_update(self, job_id: int, values: Dict[str, Any]) -> None:
+        columns = ", ".join(f"{k}=${i}" for i, k in enumerate(values, 2))
+        await self.execute(
+            f"UPDATE broadcast_jobs SET {columns}, updated_at={PG_NOW} WHERE id=$1", job_id, *values.values()
+        )
+
+    async def broadcast_job_adopt(self, job_id: int) -> None:
+        await self.execute(
+            "INSERT INTO broadcast_shards (broadcast_id, shard, cursor, done_above, sent, failed) "
+            "SELECT id, 0, cursor, done_above, sent, failed FROM broadcast_jobs WHERE id=$1 ON CONFLICT DO NOTHING",
+            job_id,
+        )
+
+    async def broadcast_jobs_running(self) -> List[tuple]:
+        return await self.fetchall(
+            f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE status='running' ORDER BY id"
+        )
+
+    async def broadcast_job_last(self) -> Optional[tuple]:
+        return await self.fetchone(f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs ORDER BY id DESC LIMIT 1")
+
+    async def broadcast_progress(self, job_id: int) -> Tuple[int, int, int, float, float]:
+        return await self.fetchone(
+            "SELECT COALESCE(SUM(sent), 0)::BIGINT, COALESCE(SUM(failed), 0)::BIGINT, "
+            "COALESCE(SUM(retries), 0)::BIGINT, COALESCE(SUM(wait), 0), "
+            f"COALESCE(SUM(rate) FILTER (WHERE owner IS NOT NULL AND lease_until > {PG_CLOCK}), 0) "
+            "FROM broadcast_shards WHERE broadcast_id=$1",
+            job_id,
+        )
+
+    async def broadcast_shard_lease(self, owner: str, ttl: float) -> Optional[Tuple[tuple, tuple, int]]:
+        returning = ", ".join(f"s.{c}" for c in SHARD_COLUMNS.split(", "))
+        async with self.write() as conn:
+            # SKIP LOCKED: workers polling at the same moment take different shards
+            shard = await conn.fetchrow(f"""
+                WITH picked AS (
+                    SELECT broadcast_id, shard FROM broadcast_shards
+                    WHERE status='pending' AND (owner IS NULL OR lease_until < {PG_CLOCK})
+                      AND broadcast_id IN (SELECT id FROM broadcast_jobs WHERE status='running')
+                    ORDER BY broadcast_id, shard LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE broadcast_shards s SET owner=$1, lease_until={PG_CLOCK} + $2
+                FROM picked WHERE s.broadcast_id=picked.broadcast_id AND s.shard=picked.shard
+                RETURNING {returning}
+            """, owner, float(ttl))
+            if shard is None:
+                return None
+            job = await conn.fetchrow(f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE id=$1", shard[0])
+            return tuple(job), tuple(shard), await conn.fetchval(PG_LIVE_LEASES)
+
+    async def broadcast_shard_save(
+        self, job_id: int, shard: int, owner: str, values: Tuple, ttl: Optional[float], deliveries: List[Tuple] = ()
+    ) -> Optional[Tuple[str, bool, int]]:
+        async with self.write() as conn:
+            # sends that happened are logged even if the lease is gone
+            upsert = (
+                "ON CONFLICT (broadcast_id, user_id) DO UPDATE SET status=excluded.status, "
+                "error=excluded.error, latency_ms=excluded.latency_ms, sent_at=excluded.sent_at"
+            )
+            columns = ", ".join(DELIVERY_COLUMNS)
+            if len(deliveries) >= PG_COPY_MIN_ROWS:
+                await self._copy_upsert(
+                    conn, "broadcast_deliveries", DELIVERY_COLUMNS, deliveries,
+                    f"INSERT INTO broadcast_deliveries ({columns}) SELECT {columns} FROM incoming {upsert}",
+                )
+            elif deliveries:
+                await conn.executemany(
+                    f"INSERT INTO broadcast_deliveries ({columns}) VALUES ($1, $2, $3, $4, $5, $6) {upsert}",
+                    deliveries,
+                )
+            lease = f"owner=$9, lease_until={PG_CLOCK} + $10" if ttl is not None else "owner=NULL, lease_until=NULL"
+            params = (owner, float(ttl)) if ttl is not None else ()
+            status = await conn.execute(
+                "UPDATE broadcast_shards SET status=$1, cursor=$2, done_above=$3, sent=$4, failed=$5, retries=$6, "
+                f"wait=$7, rate=$8, {lease} WHERE broadcast_id=${len(params) + 9} AND shard=${len(params) + 10} "
+                f"AND owner=${len(params) + 11}",
+                *values, *params, job_id, shard, owner,
+            )
+            if status != "UPDATE 1":
+                return None
+            job_status, paused = await conn.fetchrow(
+                "UPDATE broadcast_jobs j SET sent=t.sent, failed=t.failed, "
+                f"updated_at={PG_NOW} FROM (SELECT SUM(sent) AS sent, SUM(failed) AS failed "
+                "FROM broadcast_shards WHERE broadcast_id=$1) t WHERE j.id=$1 RETURNING j.status, j.paused",
+                job_id,
+            )
+            return job_status, bool(paused), await conn.fetchval(PG_LIVE_LEASES)
+
+    async def broadcast_job_finish(self, job_id: int) -> bool:
+        status = await self.execute(
+            f"UPDATE broadcast_jobs SET status='done', updated_at={PG_NOW} WHERE id=$1 AND status='running' "
+            "AND NOT EXISTS (SELECT 1 FROM broadcast_shards WHERE broadcast_id=$1 AND status!='done')",
+            job_id,
+        )
+        return status == "UPDATE 1"
+
+    async def broadcast_delivery_report(self, broadcast_id: int) -> "DeliveryReport":
+        async with self.read() as conn:
+            outcomes = [tuple(r) for r in await conn.fetch("""
+                SELECT status, COALESCE(error, ''), COUNT(*) FROM broadcast_deliveries
+                WHERE broadcast_id=$1 GROUP BY 1, 2 ORDER BY 3 DESC
+            """, broadcast_id)]
+            # percentile_disc is the nearest-rank percentile
+            p50, p95, p99, first, last = await conn.fetchrow("""
+                SELECT
+                    percentile_disc(0.50) WITHIN GROUP (ORDER BY latency_ms),
+                    percentile_disc(0.95) WITHIN GROUP (ORDER BY latency_ms),
+                    percentile_disc(0.99) WITHIN GROUP (ORDER BY latency_ms),
+                    MIN(sent_at), MAX(sent_at)
+                FROM broadcast_deliveries WHERE broadcast_id=$1 AND status='sent'
+            """, broadcast_id)
+            bucket = max(10, int(((last or 0) - (first or 0)) / 12) + 1)
+            timeline = [tuple(r) for r in await conn.fetch("""
+                SELECT (floor(sent_at / $1) * $1)::BIGINT, COUNT(*) FROM broadcast_deliveries
+                WHERE broadcast_id=$2 AND status='sent' GROUP BY 1 ORDER BY 1
+            """, float(bucket), broadcast_id)]
+        return DeliveryReport(outcomes, p50, p95, p99, bucket, timeline)
+
+    async def schedule_insert(self, values: Tuple) -> int:
+        async with self.write() as conn:
+            return await conn.fetchval(
+                "INSERT INTO broadcast_schedules (admin_id, source_chat_id, message_ids, button_text, button_url, "
+                f"segment, recurrence, next_run_at, created_at) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, {PG_NOW}) "
+                "RETURNING id",
+                *values,
+            )
+
+    async def schedule_load(self, schedule_id: int) -> Optional[tuple]:
+        return await self.fetchone(f"SELECT {SCHEDULE_COLUMNS} FROM broadcast_schedules WHERE id=$1", schedule_id)
+
+    async def schedules_active(self) -> List[tuple]:
+        return await self.fetchall(
+            f"SELECT {SCHEDULE_COLUMNS} FROM broadcast_schedules WHERE status='active' ORDER BY next_run_at"
+        )
+
+    async def schedule_claim(self, schedule_id: int, run_at: int, next_run_at: Optional[int]) -> bool:
+        status = await self.execute(
+            "UPDATE broadcast_schedules SET next_run_at=$1, status=CASE WHEN $1::BIGINT IS NULL THEN 'done' ELSE status END "
+            "WHERE id=$2 AND status='active' AND next_run_at=$3",
+            next_run_at, schedule_id, run_at,
+        )
+        return status == "UPDATE 1"
+
+    async def schedule_update(self, schedule_id: int, values: Dict[str, Any]) -> None:
+        columns = ", ".join(f"{k}=${i}" for i, k in enumerate(values, 2))
+        await self.execute(f"UPDATE broadcast_schedules SET {columns} WHERE id=$1", schedule_id, *values.values())
+
+
+def create_storage() -> Storage:
+    if STORAGE == "sqlite":
+        return SqliteStorage(DB_PATH)
+    if STORAGE in ("postgres", "postgresql"):
+        return PostgresStorage(DATABASE_URL)
+    raise RuntimeError(f"Unknown STORAGE={STORAGE!r} (expected sqlite or postgres).")
+
+
+DB = create_storage()
+
+
+async def db_init():
+    await DB.init()
+
+
+# Write-behind buffer for the hot user writes (upserts + blocked flags).
+# Duplicates per user_id are merged; a batch is flushed in one transaction
+# once it reaches WRITE_BATCH_SIZE or every WRITE_FLUSH_INTERVAL seconds.
+class UserWriteBuffer:
+    def __init__(self, batch_size: int = WRITE_BATCH_SIZE, interval: float = WRITE_FLUSH_INTERVAL):
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._upserts: Dict[int, Tuple] = {}
+        self._blocked: Dict[int, int] = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._upserts) + len(self._blocked)
+
+    def add_user(self, user, source_chat_id: Optional[int] = None) -> None:
+        prev = self._upserts.get(user.id)
+        now = int(time.time())
+        created_at = prev[4] if prev else now
+        if prev and prev[5] is not None:
+            source_chat_id = prev[5]
+        self._upserts[user.id] = (
+            user.id, user.username, user.first_name, user.last_name, created_at, source_chat_id, now
+        )
+        self._maybe_wakeup()
+
+    def add_blocked(self, user_id: int, blocked: bool) -> None:
+        self._blocked[user_id] = 1 if blocked else 0
+        self._maybe_wakeup()
+
+    def _maybe_wakeup(self) -> None:
+        if len(self) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._upserts and not self._blocked:
+                return
+            upserts, self._upserts = self._upserts, {}
+            blocked, self._blocked = self._blocked, {}
+            try:
+                await DB.write_users(list(upserts.values()), [(v, uid) for uid, v in blocked.items()])
+            except BaseException:
+                # put the batch back without clobbering anything newer
+                for uid, row in upserts.items():
+                    self._upserts.setdefault(uid, row)
+                for uid, v in blocked.items():
+                    self._blocked.setdefault(uid, v)
+                raise
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Write-behind flush failed")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+WRITES = UserWriteBuffer()
+
+
+_MISS = object()
+
+
+# Process-level cache for the singleton settings row (global enabled flag).
+class SettingsCache:
+    def __init__(self, ttl: float = SETTINGS_CACHE_TTL):
+        self.ttl = ttl
+        self._values: Dict[str, Tuple[float, object]] = {}
+
+    def get(self, key: str):
+        entry = self._values.get(key)
+        if entry is not None and (self.ttl <= 0 or time.monotonic() - entry[0] < self.ttl):
+            CACHE_HITS.inc(key)
+            return entry[1]
+        CACHE_MISSES.inc(key)
+        return _MISS
+
+    def put(self, key: str, value) -> None:
+        self._values[key] = (time.monotonic(), value)
+
+    def invalidate(self, *keys: str) -> None:
+        for key in keys:
+            self._values.pop(key, None)
+
+
+SETTINGS = SettingsCache()
+
+
+async def get_enabled() -> bool:
+    cached = SETTINGS.get("enabled")
+    if cached is not _MISS:
+        return cached
+    enabled = await DB.get_enabled()
+    SETTINGS.put("enabled", enabled)
+    return enabled
+
+
+async def set_enabled(enabled: bool) -> None:
+    await DB.set_enabled(enabled)
+    SETTINGS.invalidate("enabled")
+
+
+async def upsert_user(user, source_chat_id: Optional[int] = None) -> None:
+    WRITES.add_user(user, source_chat_id)
+
+
+async def mark_blocked(user_id: int, blocked: bool = True) -> None:
+    # buffered: flags go out with the next batch of user writes
+    WRITES.add_blocked(user_id, blocked)
+
+
+# Errors meaning the chat won't take messages from us until the user comes
+# back: every 403 (blocked, kicked, deactivated, can't initiate) and these 400s
+GONE_CHAT_ERRORS = ("chat not found", "user is deactivated")
+
+
+def is_chat_gone(e: Exception) -> bool:
+    if isinstance(e, TelegramForbiddenError):
+        return True
+    return isinstance(e, TelegramBadRequest) and any(s in e.message.lower() for s in GONE_CHAT_ERRORS)
+
+
+@dataclass
+class WelcomeConfig:
+    media_type: Optional[str]
+    media_file_id: Optional[str]
+    text: str
+    button_text: str
+    button_url: str
+    # built on the first send; an edit reloads the config, and with it this
+    _markup: Optional[InlineKeyboardMarkup] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def markup(self) -> InlineKeyboardMarkup:
+        if self._markup is None:
+            CACHE_MISSES.inc("welcome_markup")
+            self._markup = InlineKeyboardMarkup(
+                inline_keyboard=[[InlineKeyboardButton(text=self.button_text, url=self.button_url)]]
+            )
+        else:
+            CACHE_HITS.inc("welcome_markup")
+        return self._markup
+
+
+TEMPLATE_CHAT_ID = 0
+
+
+@dataclass
+class ChannelConfig:
+    chat_id: int
+    title: Optional[str]
+    enabled: bool
+    welcome: WelcomeConfig
+
+    @property
+    def name(self) -> str:
+        if self.chat_id == TEMPLATE_CHAT_ID:
+            return "Шаблон для новых каналов"
+        return f"{self.title or 'Канал'} ({self.chat_id})"
+
+
+CHANNEL_COLUMNS = "chat_id, title, is_enabled, media_type, media_file_id, text, button_text, button_url"
+
+
+def channel_from_row(r: tuple) -> ChannelConfig:
+    return ChannelConfig(
+        chat_id=r[0],
+        title=r[1],
+        enabled=bool(r[2]),
+        welcome=WelcomeConfig(
+            media_type=r[3],
+            media_file_id=r[4],
+            text=r[5] or "",
+            button_text=r[6] or WELCOME_DEFAULT_BUTTON_TEXT,
+            button_url=r[7] or WELCOME_DEFAULT_BUTTON_URL,
+        ),
+    )
+
+
+# chat_id -> ChannelConfig for every channel, read on each join request.
+# Loaded once; an edit re-reads just that row. With SETTINGS_CACHE_TTL set
+# (several processes on one DB) the whole map is reloaded when it expires.
+class ChannelRegistry:
+    def __init__(self, ttl: float = SETTINGS_CACHE_TTL):
+        self.ttl = ttl
+        self._channels: Dict[int, ChannelConfig] = {}
+        self._loaded_at: Optional[float] = None
+        self._load_lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        rows = await DB.channels_load()
+        self._channels = {r[0]: channel_from_row(r) for r in rows}
+        self._loaded_at = time.monotonic()
+
+    def _stale(self) -> bool:
+        return self._loaded_at is None or (self.ttl > 0 and time.monotonic() - self._loaded_at >= self.ttl)
+
+    async def _fresh(self) -> Dict[int, ChannelConfig]:
+        if self._stale():
+            # one reload for everyone who noticed at the same time
+            async with self._load_lock:
+                if self._stale():
+                    await self.load()
+        return self._channels
+
+    async def get(self, chat_id: int) -> Optional[ChannelConfig]:
+        # a miss is a lookup that needed a reload or found no channel
+        stale = self._stale()
+        channel = (await self._fresh()).get(chat_id)
+        (CACHE_MISSES if stale or channel is None else CACHE_HITS).inc("channels")
+        return channel
+
+    async def all(self) -> List[ChannelConfig]:
+        return sorted((await self._fresh()).values(), key=lambda c: c.chat_id)
+
+    async def refresh(self, chat_id: int) -> None:
+        row = await DB.channel_load(chat_id)
+        if row is None:
+            self._channels.pop(chat_id, None)
+        else:
+            self._channels[chat_id] = channel_from_row(row)
+
+    async def register(self, chat_id: int, title: Optional[str] = None) -> ChannelConfig:
+        # A new channel starts as a copy of the template. It goes into the map
+        # before the INSERT, so the rest of the first burst of join requests
+        # from it never waits on the DB. Held under the load lock: a TTL
+        # reload must not swap in a snapshot read before the INSERT landed.
+        async with self._load_lock:
+            channel = self._channels.get(chat_id)
+            if channel is not None:
+                return channel
+            template = self._channels.get(TEMPLATE_CHAT_ID)
+            if template is not None:
+                channel = self._channels[chat_id] = ChannelConfig(chat_id, title, True, template.welcome)
+            try:
+                inserted = await DB.channel_insert(chat_id, title, TEMPLATE_CHAT_ID)
+            except BaseException:
+                self._channels.pop(chat_id, None)
+                raise
+            if not inserted or channel is None:
+                # the row already existed (another process) or the map had no template
+                await self.refresh(chat_id)
+                channel = self._channels.get(chat_id, channel)
+            return channel
+
+
+CHANNELS = ChannelRegistry()
+
+
+async def get_channel(chat_id: int) -> ChannelConfig:
+    return await CHANNELS.get(chat_id) or await CHANNELS.register(chat_id)
+
+
+async def get_welcome(chat_id: int = TEMPLATE_CHAT_ID) -> WelcomeConfig:
+    return (await get_channel(chat_id)).welcome
+
+
+async def update_channel(chat_id: int, **values) -> None:
+    # values: channels column -> new value
+    await get_channel(chat_id)
+    await DB.channel_update(chat_id, values)
+    await CHANNELS.refresh(chat_id)
+
+
+async def set_welcome_text(chat_id: int, text: str) -> None:
+    await update_channel(chat_id, text=text)
+
+
+async def set_welcome_button(chat_id: int, btn_text: str, btn_url: str) -> None:
+    await update_channel(chat_id, button_text=btn_text, button_url=btn_url)
+
+
+async def set_welcome_media(chat_id: int, media_type: Optional[str], media_file_id: Optional[str]) -> None:
+    await update_channel(chat_id, media_type=media_type, media_file_id=media_file_id)
+
+
+async def set_channel_enabled(chat_id: int, enabled: bool) -> None:
+    await update_channel(chat_id, is_enabled=1 if enabled else 0)
+
+
+def utc_day(ts: Optional[float] = None) -> int:
+    return int(time.time() if ts is None else ts) // 86400
+
+
+# (total, blocked, joined today, joined in the last 7 days), O(1) off the counters
+async def get_stats() -> Tuple[int, int, int, int]:
+    await WRITES.flush()
+    return await DB.user_stats(utc_day())
+
+
+async def rebuild_stats() -> Tuple[Tuple[int, int, int, int], Tuple[int, int, int, int]]:
+    await WRITES.flush()
+    return await DB.user_stats_rebuild(utc_day())
+
+
+# A broadcast audience on top of "not blocked". Ranges are unix seconds,
+# [since, until); relative picks ("last 7 days") are fixed when chosen, so a
+# resumed broadcast keeps the same audience.
+@dataclass(frozen=True)
+class Segment:
+    kind: str = "all"  # all | joined | source | active
+    since: Optional[int] = None
+    until: Optional[int] = None
+    chat_id: Optional[int] = None
+
+    def where(self, after: Optional[int] = None, upto: Optional[int] = None) -> Tuple[str, Tuple]:
+        # optionally limited to the user_id range after < user_id <= upto
+        sql, params = "", ()
+        if self.kind == "source":
+            sql, params = " AND source_chat_id=?", (self.chat_id,)
+        column = {"joined": "created_at", "active": "last_active_at"}.get(self.kind)
+        if column is not None and self.since is not None:
+            sql, params = sql + f" AND {column}>=?", params + (self.since,)
+        if column is not None and self.until is not None:
+            sql, params = sql + f" AND {column}<?", params + (self.until,)
+        if after is not None:
+            sql, params = sql + " AND user_id>?", params + (after,)
+        if upto is not None:
+            sql, params = sql + " AND user_id<=?", params + (upto,)
+        return sql, params
+
+    def describe(self) -> str:
+        if self.kind == "source":
+            return f"пришли из канала {self.chat_id}"
+        if self.kind in ("joined", "active"):
+            day = lambda ts: time.strftime("%d.%m.%Y", time.localtime(ts))
+            span = f"с {day(self.since)}" if self.since is not None else ""
+            if self.until is not None:
+                span += f" по {day(self.until - 1)}"
+            return ("вступили " if self.kind == "joined" else "активны ") + span.strip()
+        return "все пользователи"
+
+    def to_json(self) -> str:
+        return json.dumps({k: v for k, v in vars(self).items() if v is not None})
+
+    @classmethod
+    def from_json(cls, raw: Optional[str]) -> "Segment":
+        return cls(**json.loads(raw)) if raw else cls()
+
+
+async def iter_broadcast_targets(
+    after: Optional[int] = None,
+    batch_size: int = BROADCAST_PAGE_SIZE,
+    segment: Segment = Segment(),
+    upto: Optional[int] = None,
+) -> AsyncIterator[int]:
+    # keyset paging: each page is a short read, memory stays at one page
+    await WRITES.flush()
+    last_id = after
+    while True:
+        page = await DB.target_page(segment, last_id, batch_size, upto)
+        for uid in page:
+            yield uid
+        if len(page) < batch_size:
+            return
+        last_id = page[-1]
+
+
+async def count_broadcast_targets(after: Optional[int] = None, segment: Segment = Segment()) -> int:
+    await WRITES.flush()
+    return await DB.target_count(segment, after)
+
+
+async def broadcast_sources() -> List[Tuple[int, int]]:
+    # (channel id, reachable users) for the segment picker
+    return await DB.target_sources()
+
+
+async def admin_state_save(admin_id: int, state: Optional[str], data: Dict[str, Any]) -> None:
+    await DB.admin_state_save(admin_id, state, json.dumps(data) if data else None)
+
+
+async def admin_state_load() -> List[Tuple[int, Optional[str], Dict[str, Any]]]:
+    rows = await DB.admin_state_load()
+    return [(r[0], r[1], json.loads(r[2]) if r[2] else {}) for r in rows]
+
+
+# aiogram FSM storage: state/data live in a dict, loaded once at startup.
+# Writes go through to admin_state only when a value actually changes, and
+# only for private-chat keys (the table is keyed by admin id); other keys
+# are kept in memory.
+class AdminStateStorage(BaseStorage):
+    def __init__(self):
+        self._records: Dict[StorageKey, Tuple[Optional[str], Dict[str, Any]]] = {}
+
+    async def load(self, bot_id: int) -> None:
+        for admin_id, state, data in await admin_state_load():
+            # states saved before the FSM had no group prefix
+            if state and ":" not in state:
+                state = f"AdminStates:{state}"
+            self._records[StorageKey(bot_id=bot_id, chat_id=admin_id, user_id=admin_id)] = (state, data)
+
+    @staticmethod
+    def _persistent(key: StorageKey) -> bool:
+        return (
+            key.chat_id == key.user_id
+            and key.thread_id is None
+            and key.business_connection_id is None
+            and key.destiny == "default"
+        )
+
+    async def _save(self, key: StorageKey) -> None:
+        state, data = self._records[key]
+        if state is None and not data:
+            del self._records[key]
+        if self._persistent(key):
+            await admin_state_save(key.user_id, state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        old_state, data = self._records.get(key, (None, {}))
+        if state == old_state:
+            return
+        self._records[key] = (state, data)
+        await self._save(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._records.get(key, (None, {}))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        state, old_data = self._records.get(key, (None, {}))
+        if data == old_data:
+            return
+        self._records[key] = (state, data.copy())
+        await self._save(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._records.get(key, (None, {}))[1].copy()
+
+    async def close(self) -> None:
+        pass
+
+
+STATES = AdminStateStorage()
+
+
+@dataclass
+class BroadcastJob:
+    id: int
+    admin_id: int
+    payload_type: str
+    payload_file_id: Optional[str]
+    payload_caption: str
+    status: str = "running"
+    cursor: Optional[int] = None
+    done_above: List[int] = field(default_factory=list)
+    sent: int = 0
+    failed: int = 0
+    source_chat_id: Optional[int] = None
+    message_ids: List[int] = field(default_factory=list)
+    button_text: Optional[str] = None
+    button_url: Optional[str] = None
+    segment: Segment = field(default_factory=Segment)
+    total: Optional[int] = None
+    paused: bool = False
+
+
+# Part of a job: targets lo < user_id <= hi (None = unbounded), worked by
+# whichever process holds its lease, with its own checkpoint and counters.
+@dataclass
+class BroadcastShard:
+    job_id: int
+    shard: int
+    lo: Optional[int] = None
+    hi: Optional[int] = None
+    cursor: Optional[int] = None
+    done_above: List[int] = field(default_factory=list)
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    wait: float = 0.0
+
+
+SHARD_COLUMNS = "broadcast_id, shard, lo, hi, cursor, done_above, sent, failed, retries, wait"
+
+
+def broadcast_shard_from_row(r: tuple) -> BroadcastShard:
+    return BroadcastShard(
+        job_id=r[0],
+        shard=r[1],
+        lo=r[2],
+        hi=r[3],
+        cursor=r[4],
+        done_above=json.loads(r[5]) if r[5] else [],
+        sent=r[6],
+        failed=r[7],
+        retries=r[8],
+        wait=r[9],
+    )
+
+
+async def broadcast_shard_ranges(segment: Segment, total: int, shards: int) -> List[Tuple[Optional[int], Optional[int]]]:
+    # equal-sized user_id ranges: each boundary is found by skipping `per`
+    # targets past the previous one in the segment's index
+    per = max(1, -(-total // max(1, shards)))
+    ranges: List[Tuple[Optional[int], Optional[int]]] = []
+    lo = None
+    for _ in range(shards - 1):
+        hi = await DB.target_nth(segment, lo, per - 1)
+        if hi is None:
+            break
+        ranges.append((lo, hi))
+        lo = hi
+    # the last one is open-ended: users joining mid-broadcast are still reached
+    ranges.append((lo, None))
+    return ranges
+
+
+async def broadcast_job_create(
+    admin_id: int,
+    payload_type: str,
+    payload_file_id: Optional[str],
+    payload_caption: str,
+    source_chat_id: Optional[int] = None,
+    message_ids: List[int] = (),
+    button: Optional[Tuple[str, str]] = None,
+    segment: Segment = Segment(),
+    total: Optional[int] = None,
+    shards: int = BROADCAST_SHARDS,
+) -> BroadcastJob:
+    button_text, button_url = button or (None, None)
+    if total is None:
+        total = await count_broadcast_targets(segment=segment)
+    ranges = await broadcast_shard_ranges(segment, total, shards)
+    job_id = await DB.broadcast_job_insert((
+        admin_id, payload_type, payload_file_id, payload_caption,
+        source_chat_id, json.dumps(list(message_ids)), button_text, button_url, segment.to_json(), total,
+    ), ranges)
+    return BroadcastJob(
+        job_id, admin_id, payload_type, payload_file_id, payload_caption,
+        source_chat_id=source_chat_id, message_ids=list(message_ids), button_text=button_text, button_url=button_url,
+        segment=segment, total=total,
+    )
+
+
+async def broadcast_job_update(job_id: int, **values) -> None:
+    # values: broadcast_jobs column -> new value
+    await DB.broadcast_job_update(job_id, values)
+
+
+BROADCAST_JOB_COLUMNS = (
+    "id, admin_id, payload_type, payload_file_id, payload_caption, status, cursor, done_above, sent, failed, "
+    "source_chat_id, message_ids, button_text, button_url, segment, total, paused"
+)
+
+
+def broadcast_job_from_row(r: tuple) -> BroadcastJob:
+    return BroadcastJob(
+        id=r[0],
+        admin_id=r[1],
+        payload_type=r[2],
+        payload_file_id=r[3],
+        payload_caption=r[4] or "",
+        status=r[5],
+        cursor=r[6],
+        done_above=json.loads(r[7]) if r[7] else [],
+        sent=r[8],
+        failed=r[9],
+        source_chat_id=r[10],
+        message_ids=json.loads(r[11]) if r[11] else [],
+        button_text=r[12],
+        button_url=r[13],
+        segment=Segment.from_json(r[14]),
+        total=r[15],
+        paused=bool(r[16]),
+    )
+
+
+async def broadcast_jobs_running() -> List[BroadcastJob]:
+    return [broadcast_job_from_row(r) for r in await DB.broadcast_jobs_running()]
+
+
+async def broadcast_job_active() -> Optional[BroadcastJob]:
+    # one broadcast at a time, whichever process started it
+    jobs = await broadcast_jobs_running()
+    return jobs[-1] if jobs else None
+
+
+async def broadcast_jobs_adopt() -> None:
+    # jobs from before sharding: one shard carrying the job's checkpoint
+    for job in await broadcast_jobs_running():
+        if job.total is None:
+            remaining = await count_broadcast_targets(after=job.cursor, segment=job.segment) - len(job.done_above)
+            await DB.broadcast_job_adopt(job.id)
+            await broadcast_job_update(job.id, total=job.sent + job.failed + max(0, remaining))
+
+
+async def broadcast_job_last() -> Optional[BroadcastJob]:
+    row = await DB.broadcast_job_last()
+    return broadcast_job_from_row(row) if row else None
+
+
+@dataclass
+class DeliveryReport:
+    outcomes: List[Tuple[str, str, int]]  # (status, error class, count)
+    p50: Optional[int]
+    p95: Optional[int]
+    p99: Optional[int]
+    bucket: int  # seconds per timeline row
+    timeline: List[Tuple[float, int]]  # (bucket start, messages sent)
+
+
+async def broadcast_delivery_report(broadcast_id: int) -> DeliveryReport:
+    return await DB.broadcast_delivery_report(broadcast_id)
+
+
+def cron_field(raw: str, lo: int, hi: int) -> FrozenSet[int]:
+    # "*", "5", "1-5", "*/15", "10-40/10", and comma lists of those
+    values = set()
+    for part in raw.split(","):
+        span, _, step = part.partition("/")
+        step_n = int(step) if step else 1
+        if span == "*":
+            a, b = lo, hi
+        elif "-" in span:
+            a, b = (int(x) for x in span.split("-", 1))
+        else:
+            a = int(span)
+            b = hi if step else a
+        if not lo <= a <= b <= hi or step_n < 1:
+            raise ValueError(f"bad cron field {part!r}")
+        values.update(range(a, b + 1, step_n))
+    return frozenset(values)
+
+
+# Five-field cron: minute hour day-of-month month day-of-week (0-7, 0 and 7 =
+# Sunday), in SCHEDULE_TZ. As in cron, when both day fields are restricted a
+# day matching either one fires.
+@dataclass(frozen=True)
+class Cron:
+    minutes: FrozenSet[int]
+    hours: FrozenSet[int]
+    days: FrozenSet[int]
+    months: FrozenSet[int]
+    weekdays: FrozenSet[int]
+    any_day: bool
+    any_weekday: bool
+
+    @classmethod
+    def parse(cls, expr: str) -> "Cron":
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError("cron needs 5 fields")
+        minute, hour, day, month, weekday = fields
+        weekdays = cron_field(weekday, 0, 7)
+        return cls(
+            cron_field(minute, 0, 59), cron_field(hour, 0, 23), cron_field(day, 1, 31), cron_field(month, 1, 12),
+            frozenset(d % 7 for d in weekdays), day == "*", weekday == "*",
+        )
+
+    def day_matches(self, t: datetime) -> bool:
+        in_days = t.day in self.days
+        in_weekdays = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, ts: float) -> int:
+        # walk days, then hours and minutes within a matching day
+        t = datetime.fromtimestamp(ts, SCHEDULE_TZ).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(366 * 8):
+            if t.month in self.months and self.day_matches(t):
+                for hour in sorted(h for h in self.hours if h >= t.hour):
+                    first = t.minute if hour == t.hour else 0
+                    for minute in sorted(m for m in self.minutes if m >= first):
+                        return int(t.replace(hour=hour, minute=minute).timestamp())
+            t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+        raise ValueError("cron never fires")
+
+
+def format_when(ts: int) -> str:
+    return datetime.fromtimestamp(ts, SCHEDULE_TZ).strftime("%d.%m.%Y %H:%M")
+
+
+def parse_when(raw: str) -> Optional[Tuple[int, Optional[str]]]:
+    # "25.12.2026 10:00" once, or a cron expression -> (first run, recurrence)
+    txt = " ".join(raw.split())
+    try:
+        t = datetime.strptime(txt, "%d.%m.%Y %H:%M").replace(tzinfo=SCHEDULE_TZ)
+        return (int(t.timestamp()), None) if t.timestamp() > time.time() else None
+    except ValueError:
+        pass
+    try:
+        return Cron.parse(txt).next_after(time.time()), txt
+    except ValueError:
+        return None
+
+
+@dataclass
+class BroadcastSchedule:
+    id: int
+    admin_id: int
+    source_chat_id: int
+    message_ids: List[int]
+    button_text: Optional[str]
+    button_url: Optional[str]
+    segment: str  # as the admin typed it; parse_segment() at every run
+    recurrence: Optional[str]  # cron expression, None = once
+    next_run_at: Optional[int]
+    status: str  # active | done | cancelled
+    last_job_id: Optional[int]
+
+
+SCHEDULE_COLUMNS = (
+    "id, admin_id, source_chat_id, message_ids, button_text, button_url, segment, recurrence, "
+    "next_run_at, status, last_job_id"
+)
+
+
+def broadcast_schedule_from_row(r: tuple) -> BroadcastSchedule:
+    return BroadcastSchedule(
+        id=r[0], admin_id=r[1], source_chat_id=r[2], message_ids=json.loads(r[3]), button_text=r[4],
+        button_url=r[5], segment=r[6], recurrence=r[7], next_run_at=r[8], status=r[9], last_job_id=r[10],
+    )
+
+
+async def broadcast_schedules_active() -> List[BroadcastSchedule]:
+    return [broadcast_schedule_from_row(r) for r in await DB.schedules_active()]
+
+
+# =========================
+# Users import / export
+# =========================
+# JSONL: one {"user_id": ..., ...} object per line. CSV: a header row of
+# USER_EXPORT_COLUMNS names (any order, missing = empty), empty field = NULL.
+# Both directions stream: memory holds one chunk of rows whatever the file size.
+USER_TEXT_COLUMNS = {"username", "first_name", "last_name"}
+IMPORT_ERRORS_LOGGED = 10
+# progress(rows done, rows skipped)
+ImportProgress = Optional[Callable[[int, int], Awaitable[None]]]
+
+
+def users_file_format(path: str, fmt: Optional[str] = None) -> str:
+    fmt = (fmt or os.path.splitext(path)[1].lstrip(".")).lower()
+    if fmt not in ("csv", "jsonl"):
+        raise ValueError(f"unknown users file format {fmt!r}: use .csv or .jsonl")
+    return fmt
+
+
+def user_import_row(record: Any) -> Tuple:
+    # JSONL lines come in as text, CSV rows as dicts
+    if isinstance(record, str):
+        record = json.loads(record)
+    if not isinstance(record, dict):
+        raise ValueError("not an object")
+    row = []
+    for column in USER_EXPORT_COLUMNS:
+        value = record.get(column)
+        if value == "":
+            value = None
+        if value is not None and column not in USER_TEXT_COLUMNS:
+            value = int(value)
+        row.append(value)
+    if row[0] is None:
+        raise ValueError("user_id is missing")
+    if row[-1] is None:
+        row[-1] = 0
+    return tuple(row)
+
+
+async def export_users(path: str, fmt: Optional[str] = None, progress: ImportProgress = None) -> int:
+    fmt = users_file_format(path, fmt)
+    await WRITES.flush()
+    exported = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer is not None:
+            writer.writerow(USER_EXPORT_COLUMNS)
+        async for rows in DB.users_dump(EXPORT_BATCH_ROWS):
+            if writer is not None:
+                writer.writerows(["" if v is None else v for v in row] for row in rows)
+            else:
+                f.writelines(
+                    json.dumps(dict(zip(USER_EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows
+                )
+            exported += len(rows)
+            if progress is not None:
+                await progress(exported, 0)
+    return exported
+
+
+# Chunks of chunk_rows go to DB.users_import, one transaction each; the next
+# chunk is parsed while the previous one is being written. Bad records are
+# skipped and counted. Returns (rows imported, records skipped).
+async def import_users(
+    path: str, fmt: Optional[str] = None, progress: ImportProgress = None, chunk_rows: int = IMPORT_CHUNK_ROWS
+) -> Tuple[int, int]:
+    fmt = users_file_format(path, fmt)
+    await WRITES.flush()
+    imported = skipped = 0
+    # user_id -> row: a chunk never upserts the same user twice (Postgres refuses that)
+    chunk: Dict[int, Tuple] = {}
+    pending: Optional[asyncio.Task] = None
+
+    async def written() -> None:
+        nonlocal pending, imported
+        if pending is not None:
+            task, pending = pending, None
+            imported += await task
+            if progress is not None:
+                await progress(imported, skipped)
+
+    async def write(rows: List[Tuple]) -> int:
+        await DB.users_import(rows)
+        return len(rows)
+
+    try:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            records = csv.DictReader(f) if fmt == "csv" else (line for line in f if line.strip())
+            for n, record in enumerate(records, 1):
+                try:
+                    row = user_import_row(record)
+                except (ValueError, TypeError) as e:
+                    skipped += 1
+                    if skipped <= IMPORT_ERRORS_LOGGED:
+                        logging.warning("Import %s: record %s skipped: %s", path, n, e)
+                    continue
+                chunk[row[0]] = row
+                if len(chunk) >= chunk_rows:
+                    await written()
+                    pending = asyncio.create_task(write(list(chunk.values())))
+                    chunk = {}
+                elif n % 1000 == 0:
+                    # parsing is CPU work; let updates through in a running bot
+                    await asyncio.sleep(0)
+        await written()
+        if chunk:
+            pending = asyncio.create_task(write(list(chunk.values())))
+            await written()
+    finally:
+        if pending is not None:
+            # an error above: let the chunk in flight finish, keep the first error
+            await asyncio.gather(pending, return_exceptions=True)
+    return imported, skipped
+
+
+# =========================
+# UI (Reply keyboards only)
+# =========================
+async def kb_admin_main() -> ReplyKeyboardMarkup:
+    enabled = await get_enabled()
+    toggle_label = "🟢 Бот включен" if enabled else "🔴 Бот выключен"
+    job = BROADCASTS.active
+    pause_label = "▶️ Продолжить" if job is not None and job.paused else "⏸ Пауза"
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text=toggle_label)],
+            [KeyboardButton(text="📌 Приветствие"), KeyboardButton(text="📊 Статистика")],
+            [KeyboardButton(text="📣 Рассылка"), KeyboardButton(text="⛔ Стоп рассылка")],
+            [KeyboardButton(text="📶 Прогресс"), KeyboardButton(text=pause_label)],
+            [KeyboardButton(text="🗓 Запланировать"), KeyboardButton(text="🗓 Расписание")],
+            [KeyboardButton(text="📈 Отчёт рассылки"), KeyboardButton(text="❌ Отмена")],
+        ],
+        resize_keyboard=True,
+        is_persistent=True,
+    )
+
+
+def kb_broadcast_segments(sources: List[Tuple[int, int]]) -> ReplyKeyboardMarkup:
+    rows = [
+        [KeyboardButton(text="👥 Все")],
+        [KeyboardButton(text="🆕 Новые за 7 дней"), KeyboardButton(text="🆕 Новые за 30 дней")],
+        [KeyboardButton(text="🔥 Активные за 7 дней"), KeyboardButton(text="🔥 Активные за 30 дней")],
+    ]
+    rows += [[KeyboardButton(text=f"📡 {chat_id} ({n})")] for chat_id, n in sources[:5]]
+    rows.append([KeyboardButton(text="❌ Отмена")])
+    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, is_persistent=True)
+
+
+def kb_channels(channels: List[ChannelConfig]) -> ReplyKeyboardMarkup:
+    rows = [
+        [KeyboardButton(text=("" if c.enabled else "⏸ ") + ("🧩 " if c.chat_id == TEMPLATE_CHAT_ID else "📡 ") + c.name)]
+        for c in channels
+    ]
+    rows.append([KeyboardButton(text="❌ Отмена")])
+    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, is_persistent=True)
+
+
+def kb_welcome_menu() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="✏️ Текст приветствия"), KeyboardButton(text="🖼/🎥 Медиа")],
+            [KeyboardButton(text="🔘 Кнопка"), KeyboardButton(text="🗑 Удалить медиа")],
+            [KeyboardButton(text="👀 Предпросмотр"), KeyboardButton(text="⬅️ Назад")],
+            [KeyboardButton(text="🔁 Вкл/выкл канал"), KeyboardButton(text="📡 Сменить канал")],
+            [KeyboardButton(text="❌ Отмена")],
+        ],
+        resize_keyboard=True,
+        is_persistent=True,
+    )
+
+
+async def format_broadcast_progress() -> str:
+    # job-wide: from memory when only we are sending, else summed over the
+    # shards of every worker process
+    job = BROADCASTS.active
+    if job is None:
+        return "Сейчас рассылка не идёт."
+    local = BROADCASTS.progress()
+    if local is not None:
+        sent, failed, rate = local
+    else:
+        sent, failed, _, _, rate = await DB.broadcast_progress(job.id)
+    done = sent + failed
+    total = max(job.total or 0, done)
+    pct = 100 * done / total if total else 100
+    eta = (total - done) / rate if rate > 0 else None
+    eta_text = "—" if eta is None else time.strftime("%H:%M:%S", time.gmtime(eta))
+    state = "⏸ на паузе" if job.paused else "идёт"
+    return (
+        f"📶 Рассылка #{job.id} ({state})\n"
+        f"Отправлено: <b>{sent}</b>, ошибок: <b>{failed}</b>\n"
+        f"Обработано: {done} из {total} ({pct:.0f}%)\n"
+        f"Скорость: {rate:.1f} сообщ./с\n"
+        f"Осталось: ~{eta_text}"
+    )
+
+
+def format_delivery_report(job: BroadcastJob, report: DeliveryReport) -> str:
+    lines = [
+        f"📈 Рассылка #{job.id} ({job.status})",
+        f"Отправлено: <b>{job.sent}</b>, ошибок: <b>{job.failed}</b>",
+    ]
+    if not report.outcomes:
+        lines.append("\nЖурнал доставки пуст.")
+        return "\n".join(lines)
+
+    lines.append("\nИтоги:")
+    for status, error, count in report.outcomes:
+        lines.append(f"• {status}{' / ' + error if error else ''}: {count}")
+
+    if report.p50 is not None:
+        lines.append(f"\nЗадержка отправки: p50 {report.p50} мс · p95 {report.p95} мс · p99 {report.p99} мс")
+
+    if report.timeline:
+        lines.append(f"\nСкорость (по {report.bucket} с):")
+        for start, count in report.timeline:
+            lines.append(f"{time.strftime('%H:%M:%S', time.localtime(start))} — {count} ({count / report.bucket:.1f}/с)")
+    return "\n".join(lines)
+
+
+async def show_admin_panel(message: Message):
+    await message.answer("Админ-панель 👇", reply_markup=await kb_admin_main())
+
+
+async def show_welcome_panel(message: Message, channel: ChannelConfig):
+    if channel.chat_id == TEMPLATE_CHAT_ID:
+        status = "копируется в каждый новый канал"
+    else:
+        status = "🟢 заявки обрабатываются" if channel.enabled else "🔴 заявки не обрабатываются"
+    await message.answer(
+        f"Настройки приветствия 👇\n<b>{channel.name}</b>: {status}", reply_markup=kb_welcome_menu()
+    )
+
+
+# =========================
+# Core: send welcome
+# =========================
+async def send_welcome(bot: Bot, chat_id: int, cfg: WelcomeConfig) -> None:
+    kb = cfg.markup
+
+    if cfg.media_type == "photo" and cfg.media_file_id:
+        await bot.send_photo(chat_id, photo=cfg.media_file_id, caption=cfg.text, reply_markup=kb)
+        return
+
+    if cfg.media_type == "video" and cfg.media_file_id:
+        await bot.send_video(chat_id, video=cfg.media_file_id, caption=cfg.text, reply_markup=kb)
+        return
+
+    await bot.send_message(chat_id, cfg.text, reply_markup=kb)
+
+
+# =========================
+# Broadcast
+# =========================
+# Async token bucket: `rate` tokens per second, at most `burst` saved up.
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = max(0.001, rate)
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> float:
+        # stop handing out tokens for `seconds`; returns how much the pause grew
+        now = time.monotonic()
+        until = now + seconds
+        if until <= self._paused_until:
+            return 0.0
+        added = until - max(now, self._paused_until)
+        self._paused_until = until
+        # no saved-up burst right after a flood-wait
+        self._tokens = 0.0
+        self._updated = until
+        return added
+
+    def is_paused(self) -> bool:
+        return time.monotonic() < self._paused_until
+
+    async def acquire(self) -> None:
+        # waiters queue up on the lock, so tokens are handed out in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Token bucket whose rate follows AIMD: halved on every flood-wait, then
+# raised by `step` * max_rate msg/s per second of successful sends up to
+# `max_rate`. The step scales with max_rate, so a fast bot recovers as
+# quickly as a slow one.
+class AdaptiveTokenBucket(TokenBucket):
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = BROADCAST_MIN_RPS, step: float = BROADCAST_RATE_STEP):
+        super().__init__(rate, burst)
+        self.max_rate = self.rate
+        self.min_rate = min(min_rate, self.max_rate)
+        self.step = step
+
+    def on_success(self) -> None:
+        # `rate` successes per second, so each adds step*max_rate/rate
+        self.rate = min(self.max_rate, self.rate + self.step * self.max_rate / self.rate)
+
+    def on_retry_after(self, retry_after: float) -> float:
+        # one flood-wait usually hits several workers at once: decrease only once per pause
+        if not self.is_paused():
+            self.rate = max(self.min_rate, self.rate / 2)
+        return self.pause(retry_after)
+
+    def set_max_rate(self, rate: float) -> None:
+        # our share of a budget split with other processes; AIMD climbs back up when it grows
+        self.max_rate = max(0.001, rate)
+        self.min_rate = min(self.min_rate, self.max_rate)
+        self.rate = min(self.rate, self.max_rate)
+
+
+@dataclass
+class BroadcastStats:
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    paused: float = 0.0
+
+
+# Checkpoint cursor over targets handed out in ascending user_id order.
+# `value` is the low watermark: every target <= value is finished. Workers
+# finish out of order, so finished ids past the watermark are kept too.
+class BroadcastCursor:
+    def __init__(self, value: Optional[int] = None, done_above: Optional[List[int]] = None):
+        self.value = value
+        self.skip = set(done_above or ())  # finished before a restart
+        self._order: Deque[int] = deque()
+        self._done: set = set()
+
+    def dispatch(self, uid: int) -> bool:
+        # returns False for targets that were already finished before a restart
+        self._order.append(uid)
+        if uid in self.skip:
+            self.skip.discard(uid)
+            self.finish(uid)
+            return False
+        return True
+
+    def finish(self, uid: int) -> None:
+        self._done.add(uid)
+        while self._order and self._order[0] in self._done:
+            self.value = self._order.popleft()
+            self._done.discard(self.value)
+
+    def done_above(self) -> List[int]:
+        return sorted(self._done | self.skip)
+
+
+@dataclass
+class BroadcastRun:
+    job: BroadcastJob
+    shard: BroadcastShard
+    bucket: AdaptiveTokenBucket
+    cursor: BroadcastCursor
+    stats: BroadcastStats
+    targets: "asyncio.Queue[Optional[int]]"
+    retry: Deque[Tuple[int, int]] = field(default_factory=deque)
+    deliveries: List[Tuple] = field(default_factory=list)
+    lost: bool = False  # another worker took the shard over
+
+    def record(self, uid: int, status: str, error: Optional[str], started: float) -> None:
+        if BROADCAST_DELIVERY_LOG:
+            latency_ms = int((time.perf_counter() - started) * 1000)
+            self.deliveries.append((self.job.id, uid, status, error, latency_ms, time.time()))
+
+
+# Owns the broadcast shard this process is working on: its task, stop/pause
+# signals and local send rate. Job-wide state (stop, pause, progress) lives
+# in the DB and reaches here at each checkpoint.
+class BroadcastController:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.run: Optional[BroadcastRun] = None
+        # The running job (whichever process started it) and its pause flag,
+        # for the admin UI without a DB read. Set at launch and lease, kept
+        # up by our checkpoints and the admin's stop/pause; an idle worker
+        # re-reads it every BROADCAST_POLL_INTERVAL.
+        self.active: Optional[BroadcastJob] = None
+        # live leases on the job, ours included, as of our last checkpoint
+        self.leases = 0
+        self._started_at = 0.0
+        self._done_at_start = 0
+        # sent/failed of the job's other shards when we leased ours
+        self._others = (0, 0)
+        self._stop = asyncio.Event()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+    @property
+    def is_running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resumed.is_set()
+
+    def start(self, coro) -> asyncio.Task:
+        self.task = asyncio.create_task(coro)
+        return self.task
+
+    def begin(self, run: BroadcastRun) -> None:
+        self.run = run
+        self.active = run.job
+        self._started_at = time.monotonic()
+        self._done_at_start = run.stats.sent + run.stats.failed
+        self._others = (run.job.sent - run.shard.sent, run.job.failed - run.shard.failed)
+        self._stop.clear()
+        self._resumed.set()
+
+    def end(self) -> None:
+        self.run = None
+        self._resumed.set()
+
+    def stop(self) -> bool:
+        if not self.is_running:
+            return False
+        self._stop.set()
+        self._resumed.set()
+        return True
+
+    def pause(self) -> bool:
+        if self.run is None:
+            return False
+        self._resumed.clear()
+        return True
+
+    def resume(self) -> bool:
+        if self.run is None:
+            return False
+        self._resumed.set()
+        return True
+
+    async def wait_resumed(self) -> None:
+        await self._resumed.wait()
+
+    async def wait_stopped(self) -> None:
+        await self._stop.wait()
+
+    async def wait_done(self) -> None:
+        if self.task is not None:
+            await asyncio.wait({self.task})
+
+    def rate(self) -> float:
+        # msg/s of this shard since this process took it
+        if self.run is None:
+            return 0.0
+        elapsed = time.monotonic() - self._started_at
+        done = self.run.stats.sent + self.run.stats.failed - self._done_at_start
+        return done / elapsed if elapsed > 0 else 0.0
+
+    def progress(self) -> Optional[Tuple[int, int, float]]:
+        # job-wide (sent, failed, msg/s) from memory while ours is the only
+        # live lease; None = other processes are sending too, ask the DB
+        if self.run is None or self.leases > 1:
+            return None
+        stats = self.run.stats
+        return self._others[0] + stats.sent, self._others[1] + stats.failed, self.rate()
+
+    async def shutdown(self) -> None:
+        # cancelled shards checkpoint and release their lease, to be picked up again
+        if self.is_running:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+BROADCASTS = BroadcastController()
+
+
+BroadcastSend = Callable[[int], Awaitable[Any]]
+
+
+def broadcast_request(job: BroadcastJob) -> TelegramMethod:
+    # chat_id is a placeholder, broadcast_sender swaps in the recipient
+    if job.payload_type == "copy":
+        if len(job.message_ids) > 1:
+            # Bot API: copyMessages takes no reply_markup
+            return CopyMessages(chat_id=0, from_chat_id=job.source_chat_id, message_ids=job.message_ids)
+        markup = None
+        if job.button_text and job.button_url:
+            markup = InlineKeyboardMarkup(
+                inline_keyboard=[[InlineKeyboardButton(text=job.button_text, url=job.button_url)]]
+            )
+        return CopyMessage(
+            chat_id=0, from_chat_id=job.source_chat_id, message_id=job.message_ids[0], reply_markup=markup
+        )
+    # jobs created before copy support
+    if job.payload_type == "photo":
+        return SendPhoto(chat_id=0, photo=job.payload_file_id, caption=job.payload_caption)
+    if job.payload_type == "video":
+        return SendVideo(chat_id=0, video=job.payload_file_id, caption=job.payload_caption)
+    return SendMessage(chat_id=0, text=job.payload_caption)
+
+
+def broadcast_sender(bot: Bot, job: BroadcastJob) -> BroadcastSend:
+    # the request is built (and validated) once per run; a send is a shallow
+    # copy with another chat_id
+    copy = broadcast_request(job).model_copy
+
+    async def send(uid: int):
+        return await bot(copy(update={"chat_id": uid}))
+
+    return send
+
+
+# Albums arrive as one message per item. The first item's handler waits
+# MEDIA_GROUP_DELAY for the rest and gets all ids; the others get None.
+class MediaGroupCollector:
+    def __init__(self, delay: float = MEDIA_GROUP_DELAY):
+        self.delay = delay
+        self._groups: Dict[str, List[int]] = {}
+
+    async def collect(self, message: Message) -> Optional[List[int]]:
+        group = self._groups.get(message.media_group_id)
+        if group is not None:
+            group.append(message.message_id)
+            return None
+        group = self._groups[message.media_group_id] = [message.message_id]
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            del self._groups[message.media_group_id]
+        return sorted(group)
+
+
+MEDIA_GROUPS = MediaGroupCollector()
+
+
+async def broadcast_checkpoint(
+    run: BroadcastRun, status: str = "pending", release: bool = False
+) -> Optional[Tuple[str, bool, int]]:
+    # shard checkpoint + lease renewal + the delivery rows it covers, one
+    # transaction; returns the job's (status, paused, live leases), None if
+    # the lease is gone
+    shard, stats = run.shard, run.stats
+    values = (
+        status, run.cursor.value, json.dumps(run.cursor.done_above()),
+        stats.sent, stats.failed, stats.retries, stats.paused, BROADCASTS.rate(),
+    )
+    deliveries, run.deliveries = run.deliveries, []
+    try:
+        return await DB.broadcast_shard_save(
+            shard.job_id, shard.shard, WORKER_ID, values, None if release else BROADCAST_LEASE_TTL, deliveries
+        )
+    except BaseException:
+        run.deliveries[:0] = deliveries
+        raise
+
+
+def broadcast_budget(run: BroadcastRun, leases: int) -> None:
+    # BROADCAST_RPS is per bot token: every live lease gets an equal share
+    BROADCASTS.leases = leases
+    run.bucket.set_max_rate(BROADCAST_RPS / max(1, leases))
+
+
+async def broadcast_checkpointer(run: BroadcastRun) -> None:
+    # one UPDATE per interval covers every send finished in between; the
+    # answer carries what other processes did to the job
+    while True:
+        await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+        try:
+            state = await broadcast_checkpoint(run)
+        except Exception:
+            logging.exception("Failed to checkpoint broadcast #%s", run.job.id)
+            continue
+        if state is None:
+            logging.warning("Lost the lease on broadcast #%s shard %s", run.job.id, run.shard.shard)
+            run.lost = True
+            BROADCASTS.stop()
+            return
+        status, paused, leases = state
+        if status != "running":
+            BROADCASTS.active = None
+            BROADCASTS.stop()
+            return
+        run.job.paused = paused
+        if paused and not BROADCASTS.paused:
+            BROADCASTS.pause()
+        elif not paused and BROADCASTS.paused:
+            BROADCASTS.resume()
+        broadcast_budget(run, leases)
+
+
+async def broadcast_feed(run: BroadcastRun) -> None:
+    try:
+        targets = iter_broadcast_targets(after=run.shard.cursor, segment=run.job.segment, upto=run.shard.hi)
+        async for uid in targets:
+            if run.cursor.dispatch(uid):
+                await run.targets.put(uid)
+    except Exception:
+        # release the workers, run_broadcast re-raises when it awaits us
+        await run.targets.put(None)
+        raise
+    await run.targets.put(None)
+
+
+async def broadcast_worker(send: BroadcastSend, run: BroadcastRun):
+    stats, bucket, retry = run.stats, run.bucket, run.retry
+    # welcomes and handler replies take the send slots first
+    SEND_PRIORITY.set(SEND_BROADCAST)
+    # workers share one queue, so every target is taken exactly once;
+    # users hit by a flood-wait go to `retry` and are picked up first
+    while not BROADCASTS.stopping:
+        await BROADCASTS.wait_resumed()
+        if retry:
+            uid, attempt = retry.popleft()
+        else:
+            uid, attempt = await run.targets.get(), 0
+            if uid is None:
+                # end of targets: leave the marker for the other workers
+                run.targets.put_nowait(None)
+                return
+        await bucket.acquire()
+        started = time.perf_counter()
+        try:
+            await send(uid)
+            BROADCAST_SEND_SECONDS.observe(time.perf_counter() - started)
+            stats.sent += 1
+            BROADCAST_SENT.inc()
+            bucket.on_success()
+            run.record(uid, "sent", None, started)
+        except TelegramRetryAfter as e:
+            stats.paused += bucket.on_retry_after(e.retry_after)
+            if attempt < BROADCAST_MAX_RETRIES:
+                stats.retries += 1
+                BROADCAST_RETRIES.inc()
+                retry.append((uid, attempt + 1))
+                continue
+            stats.failed += 1
+            BROADCAST_FAILED.inc(type(e).__name__)
+            run.record(uid, "failed", type(e).__name__, started)
+        except Exception as e:
+            stats.failed += 1
+            BROADCAST_FAILED.inc(type(e).__name__)
+            run.record(uid, "failed", type(e).__name__, started)
+            if is_chat_gone(e):
+                await mark_blocked(uid, True)
+        run.cursor.finish(uid)
+
+
+def format_broadcast_totals(sent: int, failed: int, retries: int, wait: float) -> str:
+    return f"Отправлено: {sent}\nОшибок: {failed}\nПовторов (429): {retries}\nПауза: {wait:.0f} с"
+
+
+async def run_broadcast(bot: Bot, job: BroadcastJob, shard: BroadcastShard, leases: int = 1):
+    # Works one leased shard. Finished -> marked done, and whoever finishes
+    # the last shard of the job sends the admin the job-wide report. Stopped,
+    # cancelled (shutdown) or failed -> the lease is released with the
+    # checkpoint, so the rest can be picked up again.
+    run = BroadcastRun(
+        job=job,
+        shard=shard,
+        bucket=AdaptiveTokenBucket(BROADCAST_RPS, BROADCAST_BURST),
+        cursor=BroadcastCursor(shard.cursor, shard.done_above),
+        stats=BroadcastStats(sent=shard.sent, failed=shard.failed, retries=shard.retries, paused=shard.wait),
+        targets=asyncio.Queue(maxsize=BROADCAST_PAGE_SIZE),
+    )
+    broadcast_budget(run, leases)
+    BROADCASTS.begin(run)
+    if job.paused:
+        BROADCASTS.pause()
+    status = "pending"
+    try:
+        feeder = asyncio.create_task(broadcast_feed(run))
+        checkpointer = asyncio.create_task(broadcast_checkpointer(run))
+        send = broadcast_sender(bot, job)
+        workers = [asyncio.create_task(broadcast_worker(send, run)) for _ in range(max(1, BROADCAST_WORKERS))]
+        finished = asyncio.gather(*workers)
+        stop = asyncio.create_task(BROADCASTS.wait_stopped())
+        try:
+            # stop takes effect at once, even mid flood-wait: in-flight sends are cancelled
+            await asyncio.wait({finished, stop}, return_when=asyncio.FIRST_COMPLETED)
+            if not BROADCASTS.stopping:
+                await finished
+                await feeder
+                status = "done"
+        finally:
+            for task in (feeder, checkpointer, stop, *workers):
+                task.cancel()
+            await asyncio.gather(finished, return_exceptions=True)
+
+    except Exception:
+        logging.exception("Broadcast crashed")
+        BROADCASTS.active = None
+        try:
+            await broadcast_job_update(job.id, status="failed")
+            await bot.send_message(job.admin_id, "⚠️ Рассылка упала с ошибкой. Смотрите консоль.")
+        except Exception:
+            pass
+    finally:
+        BROADCASTS.end()
+        if not run.lost:
+            try:
+                await broadcast_checkpoint(run, status, release=True)
+            except Exception:
+                logging.exception("Failed to checkpoint broadcast #%s", job.id)
+
+    try:
+        if status == "done" and await DB.broadcast_job_finish(job.id):
+            BROADCASTS.active = None
+            totals = await DB.broadcast_progress(job.id)
+            await bot.send_message(job.admin_id, f"✅ Рассылка завершена.\n{format_broadcast_totals(*totals[:4])}")
+    except Exception:
+        logging.exception("Failed to finish broadcast #%s", job.id)
+
+
+# Every process (polling, webhook replica, BOT_MODE=worker) runs one of these:
+# it leases a shard of any running job, works it through run_broadcast and
+# looks for the next. Idle, it polls every BROADCAST_POLL_INTERVAL; a launch
+# in this process wakes it at once.
+class BroadcastWorker:
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(bot))
+
+    def wakeup(self) -> None:
+        self._wakeup.set()
+
+    async def _run(self, bot: Bot) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                lease = await DB.broadcast_shard_lease(WORKER_ID, BROADCAST_LEASE_TTL)
+            except Exception:
+                logging.exception("Failed to lease a broadcast shard")
+                lease = None
+            if lease is None:
+                # nothing for us: a job may still run (or have ended) elsewhere
+                try:
+                    BROADCASTS.active = await broadcast_job_active()
+                except Exception:
+                    logging.exception("Failed to look up the running broadcast")
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), BROADCAST_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_row, shard_row, leases = lease
+            job, shard = broadcast_job_from_row(job_row), broadcast_shard_from_row(shard_row)
+            if shard.sent or shard.failed:
+                # released at a restart, or its worker died: continue from the checkpoint
+                logging.info("Resuming broadcast #%s shard %s", job.id, shard.shard)
+                try:
+                    await bot.send_message(
+                        job.admin_id,
+                        f"♻️ Продолжаю рассылку #{job.id} после перезапуска.\nУже отправлено: {job.sent}",
+                    )
+                except Exception:
+                    pass
+            BROADCASTS.start(run_broadcast(bot, job, shard, leases))
+            await BROADCASTS.wait_done()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await BROADCASTS.shutdown()
+
+
+BROADCAST_WORKER = BroadcastWorker()
+
+
+async def broadcast_enqueue(
+    admin_id: int, source_chat_id: int, message_ids: List[int], button: Optional[Tuple[str, str]],
+    segment: Segment, total: int,
+) -> BroadcastJob:
+    # the admin's own chat is the source: users get a copy, media is not re-uploaded
+    job = await broadcast_job_create(
+        admin_id, "copy", None, "",
+        source_chat_id=source_chat_id, message_ids=message_ids, button=button, segment=segment, total=total,
+    )
+    BROADCASTS.active = job
+    BROADCAST_WORKER.wakeup()
+    return job
+
+
+# Starts scheduled broadcasts through broadcast_enqueue(). Due times sit in one
+# heap and the loop sleeps until the earliest (or until add() wakes it), so
+# nothing polls the table. Every process runs one; schedule_claim() makes sure
+# a run starts once. A schedule cancelled or moved meanwhile is skipped when
+# its stale heap entry comes up.
+class BroadcastScheduler:
+    def __init__(self):
+        self._heap: List[Tuple[int, int, int]] = []  # (wake at, schedule id, run it is due for)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def add(self, schedule_id: int, run_at: int) -> None:
+        heapq.heappush(self._heap, (run_at, schedule_id, run_at))
+        self._wakeup.set()
+
+    async def _load(self) -> None:
+        self._heap = [(s.next_run_at, s.id, s.next_run_at) for s in await broadcast_schedules_active()]
+        heapq.heapify(self._heap)
+
+    async def _run(self, bot: Bot) -> None:
+        resync_at = 0.0
+        while True:
+            try:
+                now = time.time()
+                if now >= resync_at:
+                    await self._load()
+                    resync_at = now + SCHEDULE_RESYNC_INTERVAL
+                timeout = resync_at - now
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+                if timeout > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                _, schedule_id, run_at = heapq.heappop(self._heap)
+                await self._fire(bot, schedule_id, run_at)
+            except Exception:
+                logging.exception("Broadcast scheduler failed")
+                await asyncio.sleep(SCHEDULE_RETRY)
+
+    async def _fire(self, bot: Bot, schedule_id: int, run_at: int) -> None:
+        row = await DB.schedule_load(schedule_id)
+        schedule = broadcast_schedule_from_row(row) if row else None
+        if schedule is None or schedule.status != "active" or schedule.next_run_at != run_at:
+            return
+        if await broadcast_job_active() is not None:
+            # one broadcast at a time: this run waits for the current one
+            heapq.heappush(self._heap, (int(time.time()) + SCHEDULE_RETRY, schedule_id, run_at))
+            return
+        # runs missed while the bot was down collapse into this one
+        next_run_at = Cron.parse(schedule.recurrence).next_after(max(run_at, time.time())) if schedule.recurrence else None
+        if not await DB.schedule_claim(schedule_id, run_at, next_run_at):
+            return
+        if next_run_at is not None:
+            self.add(schedule_id, next_run_at)
+
+        segment = parse_segment(schedule.segment) or Segment()
+        total = await count_broadcast_targets(segment=segment)
+        if total == 0:
+            text = f"🗓 Расписание #{schedule_id}: в сегменте «{segment.describe()}» нет пользователей, пропускаю."
+        else:
+            button = (schedule.button_text, schedule.button_url) if schedule.button_text else None
+            job = await broadcast_enqueue(
+                schedule.admin_id, schedule.source_chat_id, schedule.message_ids, button, segment, total
+            )
+            await DB.schedule_update(schedule_id, {"last_job_id": job.id})
+            text = (
+                f"🗓 Запускаю запланированную рассылку #{job.id} (расписание #{schedule_id}).\n"
+                f"Сегмент: {segment.describe()}\nПользователей: {total}"
+            )
+        if next_run_at is not None:
+            text += f"\nСледующий запуск: {format_when(next_run_at)}"
+        try:
+            await bot.send_message(schedule.admin_id, text)
+        except Exception:
+            logging.exception("Failed to notify admin %s about schedule #%s", schedule.admin_id, schedule_id)
+
+
+SCHEDULER = BroadcastScheduler()
+
+
+# Background liveness sweep (LIVENESS_SWEEP_INTERVAL > 0): probes the
+# broadcast targets in user_id order at LIVENESS_RPS and flags gone chats.
+# Broadcasts and join requests come first: the sweep waits while either has
+# work. The cursor is saved after every page, so a restart carries on.
+class LivenessSweep:
+    def __init__(self, interval: float = LIVENESS_SWEEP_INTERVAL, rps: float = LIVENESS_RPS):
+        self.interval = interval
+        self.bucket = TokenBucket(rps, 1)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot) -> None:
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @staticmethod
+    def busy() -> bool:
+        return BROADCASTS.is_running or JOINS.depth > 0
+
+    async def probe(self, bot: Bot, uid: int) -> None:
+        try:
+            await bot.send_chat_action(uid, "typing")
+            LIVENESS_CHECKED.inc("alive")
+        except TelegramRetryAfter as e:
+            # this one is skipped until the next pass
+            self.bucket.pause(e.retry_after)
+            LIVENESS_CHECKED.inc("flood")
+        except Exception as e:
+            if is_chat_gone(e):
+                await mark_blocked(uid, True)
+                LIVENESS_CHECKED.inc("gone")
+            else:
+                LIVENESS_CHECKED.inc("error")
+
+    async def _run(self, bot: Bot) -> None:
+        SEND_PRIORITY.set(SEND_SWEEP)
+        cursor, loaded = None, False
+        while True:
+            try:
+                # inside the retry loop: a DB hiccup at startup must not end the sweep
+                if not loaded:
+                    cursor, loaded = await DB.sweep_cursor_load(), True
+                # a job running in another process counts too
+                if self.busy() or await broadcast_job_active() is not None:
+                    await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+                    continue
+                page = await DB.target_page(Segment(), cursor, LIVENESS_PAGE_SIZE)
+                if not page:
+                    logging.info("Liveness sweep pass done")
+                    cursor = None
+                    await DB.sweep_cursor_save(None)
+                    await asyncio.sleep(self.interval)
+                    continue
+                for uid in page:
+                    await self.bucket.acquire()
+                    if self.busy():
+                        break
+                    await self.probe(bot, uid)
+                    cursor = uid
+                await DB.sweep_cursor_save(cursor)
+            except Exception:
+                logging.exception("Liveness sweep failed")
+                await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
+
+SWEEP = LivenessSweep()
+
+
+# =========================
+# Outbound sends
+# =========================
+# Send slots are handed out by priority; the priority belongs to the task that
+# sends. Join and broadcast workers and the sweep set it once when they start,
+# update handlers (admin replies, /start) run with the default.
+SEND_INTERACTIVE, SEND_WELCOME, SEND_BROADCAST, SEND_SWEEP = range(4)
+SEND_QUEUES = ("interactive", "welcome", "broadcast", "sweep")
+SEND_PRIORITY: ContextVar[int] = ContextVar("send_priority", default=SEND_INTERACTIVE)
+
+
+# One gate for every message the bot sends. It sits in the Bot session as a
+# request middleware, so bot.send_*, bot(CopyMessage(...)) and message.answer
+# all pass through it; other API calls (getUpdates, approve, …) go straight on.
+# A message first waits out its chat's spacing (an admin's own replies skip
+# it), then queues for the bot-wide rate. Each slot goes to the highest-priority message waiting at that moment,
+# so a welcome never sits behind a broadcast's backlog.
+class OutboundSender:
+    def __init__(
+        self,
+        rps: float = SEND_RPS,
+        burst: int = SEND_BURST,
+        chat_rps: float = SEND_CHAT_RPS,
+        chat_burst: int = SEND_CHAT_BURST,
+    ):
+        self.bucket = TokenBucket(rps, burst)
+        self.chat_interval = 1 / max(0.001, chat_rps)
+        self.chat_tolerance = (max(1, chat_burst) - 1) * self.chat_interval
+        # chat_id -> when its next message is due (GCRA); a past time means
+        # the chat has its full burst again
+        self._chats: Dict[Any, float] = {}
+        # (priority, seq, future) of messages waiting for the bot-wide rate
+        self._waiting: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._depth = [0] * len(SEND_QUEUES)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot) -> None:
+        bot.session.middleware(self.middleware)
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # whatever still waits is let through unthrottled rather than hung
+        for _, _, future in self._waiting:
+            if not future.done():
+                future.set_result(None)
+        self._waiting.clear()
+
+    async def middleware(self, make_request, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or self._task is None or not method.__api_method__.startswith(("send", "copy", "forward")):
+            return await make_request(bot, method)
+        priority = SEND_PRIORITY.get()
+        queue = SEND_QUEUES[priority]
+        started = time.perf_counter()
+        await self.acquire(chat_id, priority)
+        SEND_WAIT_SECONDS.observe(time.perf_counter() - started, queue)
+        try:
+            return await make_request(bot, method)
+        finally:
+            SEND_SECONDS.observe(time.perf_counter() - started, queue)
+
+    async def acquire(self, chat_id, priority: int = SEND_INTERACTIVE) -> None:
+        # an admin's own replies skip the per-chat spacing: the broadcast
+        # start/report messages to that chat must not delay them
+        if not (priority == SEND_INTERACTIVE and chat_id in ADMIN_IDS):
+            await self._chat_slot(chat_id)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, self._seq, future))
+        self._seq += 1
+        self._set_depth(priority, 1)
+        self._wakeup.set()
+        try:
+            # a cancelled waiter stays in the heap; the dispatcher skips it
+            await future
+        finally:
+            self._set_depth(priority, -1)
+
+    def _set_depth(self, priority: int, delta: int) -> None:
+        self._depth[priority] += delta
+        SEND_QUEUE_DEPTH.set(self._depth[priority], SEND_QUEUES[priority])
+
+    async def _chat_slot(self, chat_id) -> None:
+        now = time.monotonic()
+        due = max(now, self._chats.get(chat_id, now))
+        self._chats[chat_id] = due + self.chat_interval
+        if len(self._chats) > SEND_CHAT_STATE_MAX:
+            self._chats = {c: t for c, t in self._chats.items() if t > now}
+        delay = due - self.chat_tolerance - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _dispatch(self) -> None:
+        token = False
+        while True:
+            # waiters that gave up (cancelled) are dropped before a token is spent
+            while self._waiting and self._waiting[0][2].done():
+                heapq.heappop(self._waiting)
+            if not self._waiting:
+                # a token taken for a waiter that has gone is kept for the next one
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if not token:
+                await self.bucket.acquire()
+                token = True
+                # look again: whoever is first now gets the slot, including a
+                # welcome that queued up while we waited for the token
+                continue
+            _, _, future = heapq.heappop(self._waiting)
+            future.set_result(None)
+            token = False
+
+
+SENDS = OutboundSender()
+
+
+# =========================
+# Join requests
+# =========================
+@dataclass
+class JoinTask:
+    chat_id: int
+    user: object
+    user_chat_id: int
+    queued_at: float
+    approved: bool = False
+
+
+# Join requests go through a bounded queue drained by JOIN_WORKERS workers
+# that share the welcome rate limiter (and the approve one). The update handler only enqueues; when the
+# queue is full it waits there (backpressure) instead of stalling polling.
+class JoinRequestQueue:
+    def __init__(
+        self,
+        workers: int = JOIN_WORKERS,
+        maxsize: int = JOIN_QUEUE_SIZE,
+        rps: float = JOIN_RPS,
+        burst: int = JOIN_BURST,
+        approve_rps: float = JOIN_APPROVE_RPS,
+    ):
+        self.workers_count = max(1, workers)
+        self.queue: "asyncio.Queue[JoinTask]" = asyncio.Queue(maxsize=maxsize)
+        self.bucket = TokenBucket(rps, burst)
+        self.approve_bucket = TokenBucket(approve_rps, burst)
+        self.processed = 0
+        self.failed = 0
+        # seconds from enqueue to done
+        self.lag_last = 0.0
+        self.lag_avg = 0.0
+        self.lag_max = 0.0
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def submit(self, event: ChatJoinRequest) -> None:
+        task = JoinTask(event.chat.id, event.from_user, event.user_chat_id, time.monotonic())
+        try:
+            self.queue.put_nowait(task)
+        except asyncio.QueueFull:
+            await self.queue.put(task)
+
+    def start(self, bot: Bot) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(bot)) for _ in range(self.workers_count)]
+
+    async def stop(self, timeout: float = JOIN_DRAIN_TIMEOUT) -> None:
+        if self._workers and self.depth:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("%d join requests left unprocessed at shutdown", self.depth)
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self, bot: Bot) -> None:
+        SEND_PRIORITY.set(SEND_WELCOME)
+        while True:
+            task = await self.queue.get()
+            try:
+                for attempt in range(BROADCAST_MAX_RETRIES + 1):
+                    try:
+                        await self.process(bot, task)
+                        break
+                    except TelegramRetryAfter as e:
+                        # the pause holds back every worker on that call, then this one retries
+                        bucket = self.approve_bucket if AUTO_APPROVE and not task.approved else self.bucket
+                        bucket.pause(e.retry_after)
+                else:
+                    self.failed += 1
+            except Exception:
+                self.failed += 1
+                logging.exception("Join request for %s failed", task.user_chat_id)
+            finally:
+                self.queue.task_done()
+
+    async def process(self, bot: Bot, task: JoinTask) -> None:
+        if AUTO_APPROVE and not task.approved:
+            await self.approve_bucket.acquire()
+            try:
+                await bot.approve_chat_join_request(chat_id=task.chat_id, user_id=task.user.id)
+            except TelegramRetryAfter:
+                raise
+            except Exception as e:
+                # already a member / request gone: still greet them
+                logging.warning("Approve %s in %s failed: %s", task.user.id, task.chat_id, e)
+            task.approved = True
+
+        await upsert_user(task.user, task.chat_id)
+        cfg = await get_welcome(task.chat_id)
+
+        await self.bucket.acquire()
+        try:
+            await send_welcome(bot, task.user_chat_id, cfg)
+        except TelegramRetryAfter:
+            raise
+        except Exception as e:
+            if is_chat_gone(e):
+                await mark_blocked(task.user.id, True)
+            else:
+                logging.warning("Welcome to %s failed: %s", task.user.id, e)
+        else:
+            # delivered, so reachable again even if flagged before
+            await mark_blocked(task.user.id, False)
+
+        self.processed += 1
+        self.lag_last = time.monotonic() - task.queued_at
+        self.lag_max = max(self.lag_max, self.lag_last)
+        self.lag_avg = self.lag_last if self.processed == 1 else 0.9 * self.lag_avg + 0.1 * self.lag_last
+
+
+JOINS = JoinRequestQueue()
+
+
+# =========================
+# Error handler (anti-crash)
 # =========================
-# MAIN
-# =========================
+async def on_error(event: ErrorEvent):
+    logging.exception("Unhandled error: %s", event.exception)
+    return True
+
+
+# =========================
+# Lifecycle
+# =========================
+async def on_shutdown():
+    await JOINS.stop()
+    await SWEEP.stop()
+    await SCHEDULER.stop()
+    await BROADCAST_WORKER.stop()
+    await SENDS.stop()
+    await WRITES.stop()
+    await DB.close()
+
+
+# =========================
+# Handlers
+# =========================
+class AdminStates(StatesGroup):
+    welcome_wait_channel = State()
+    welcome_wait_text = State()
+    welcome_wait_media = State()
+    welcome_wait_button = State()
+    broadcast_wait_segment = State()
+    broadcast_wait_message = State()
+    broadcast_wait_button = State()
+    broadcast_wait_when = State()
+    schedule_wait_cancel = State()
+    users_wait_file = State()
+
+
+async def cmd_start(message: Message):
+    # store user anyway; writing to us means we can write back
+    try:
+        await upsert_user(message.from_user)
+        await mark_blocked(message.from_user.id, False)
+    except Exception:
+        pass
+
+    # users -> silence
+    if not is_admin(message.from_user.id):
+        return
+
+    await show_admin_panel(message)
+
+
+async def cmd_admin(message: Message, state: FSMContext):
+    # registered on admin_router, which only lets admins through
+    await state.clear()
+    await show_admin_panel(message)
+
+
+async def on_join_request(event: ChatJoinRequest, bot: Bot):
+    # if disabled -> do nothing
+    if not await get_enabled():
+        return
+
+    if CHANNEL_IDS and event.chat.id not in CHANNEL_IDS:
+        return
+
+    channel = await CHANNELS.get(event.chat.id) or await CHANNELS.register(event.chat.id, event.chat.title)
+    if not channel.enabled:
+        return
+
+    # approve / upsert / welcome happen in the JOINS worker pool
+    await JOINS.submit(event)
+
+
+# =========================
+# Admin router
+# =========================
+# Every admin handler takes (message, bot, state). Buttons and typed aliases
+# resolve with one dict lookup, the FSM state with another, both in a
+# single filter in front of a single handler.
+AdminHandler = Callable[[Message, Bot, FSMContext], Awaitable[Any]]
+
+
+async def admin_toggle_enabled(message: Message, bot: Bot, state: FSMContext):
+    cur = await get_enabled()
+    await set_enabled(not cur)
+    await state.clear()
+    status = "🟢 Включил" if not cur else "🔴 Выключил"
+    return await message.answer(f"{status}.", reply_markup=await kb_admin_main())
+
+
+async def admin_cancel(message: Message, bot: Bot, state: FSMContext):
+    await state.clear()
+    return await message.answer("Ок, отменено.", reply_markup=await kb_admin_main())
+
+
+async def admin_broadcast_stop(message: Message, bot: Bot, state: FSMContext):
+    job = BROADCASTS.active
+    if job is None:
+        return await message.answer("Сейчас рассылка не идёт.", reply_markup=await kb_admin_main())
+    await broadcast_job_update(job.id, status="stopped")
+    BROADCASTS.active = None
+    # our own shard stops now, other processes at their next checkpoint
+    if BROADCASTS.stop():
+        await BROADCASTS.wait_done()
+    totals = await DB.broadcast_progress(job.id)
+    return await message.answer(
+        f"⛔ Рассылка остановлена.\n{format_broadcast_totals(*totals[:4])}", reply_markup=await kb_admin_main()
+    )
+
+
+async def admin_broadcast_progress(message: Message, bot: Bot, state: FSMContext):
+    return await message.answer(await format_broadcast_progress(), reply_markup=await kb_admin_main())
+
+
+async def admin_broadcast_pause(message: Message, bot: Bot, state: FSMContext):
+    job = BROADCASTS.active
+    if job is None:
+        return await message.answer("Сейчас рассылка не идёт.", reply_markup=await kb_admin_main())
+    paused = not job.paused
+    await broadcast_job_update(job.id, paused=1 if paused else 0)
+    job.paused = paused
+    if paused:
+        BROADCASTS.pause()
+    else:
+        BROADCASTS.resume()
+    status = "⏸ Рассылка на паузе." if paused else "▶️ Рассылка продолжается."
+    return await message.answer(status, reply_markup=await kb_admin_main())
+
+
+async def admin_selected_channel(state: FSMContext) -> ChannelConfig:
+    # the channel picked in the welcome menu; kept in FSM data between edits
+    return await get_channel((await state.get_data()).get("welcome_chat_id", TEMPLATE_CHAT_ID))
+
+
+async def admin_welcome_menu(message: Message, bot: Bot, state: FSMContext):
+    await state.clear()
+    channels = [c for c in await CHANNELS.all() if c.chat_id != TEMPLATE_CHAT_ID]
+    if len(channels) == 1:
+        await state.update_data(welcome_chat_id=channels[0].chat_id)
+        return await show_welcome_panel(message, channels[0])
+    return await admin_channel_pick(message, bot, state)
+
+
+async def admin_channel_pick(message: Message, bot: Bot, state: FSMContext):
+    await state.set_state(AdminStates.welcome_wait_channel)
+    return await message.answer(
+        "Какой канал настраиваем? Выберите кнопкой или пришлите id канала.\n"
+        "Шаблон копируется в каждый новый канал при первой заявке.",
+        reply_markup=kb_channels(await CHANNELS.all()),
+    )
+
+
+async def admin_on_welcome_channel(message: Message, bot: Bot, state: FSMContext):
+    raw = (message.text or "").strip()
+    if raw.endswith("Шаблон для новых каналов"):
+        chat_id = TEMPLATE_CHAT_ID
+    else:
+        # "📡 Title (-100123)" from the keyboard, or a bare id
+        m = re.search(r"\(?(-?\d{5,})\)?$", raw)
+        if not m:
+            return await message.answer("Не понял канал. Выберите кнопку или пришлите id канала.")
+        chat_id = int(m.group(1))
+        if CHANNEL_IDS and chat_id not in CHANNEL_IDS:
+            return await message.answer("Этот канал не обслуживается (см. CHANNEL_IDS).")
+    await state.set_state(None)
+    await state.update_data(welcome_chat_id=chat_id)
+    return await show_welcome_panel(message, await get_channel(chat_id))
+
+
+async def admin_channel_toggle(message: Message, bot: Bot, state: FSMContext):
+    channel = await admin_selected_channel(state)
+    if channel.chat_id == TEMPLATE_CHAT_ID:
+        return await message.answer("Шаблон не включается и не выключается — выберите канал.")
+    await set_channel_enabled(channel.chat_id, not channel.enabled)
+    await state.set_state(None)
+    return await show_welcome_panel(message, await get_channel(channel.chat_id))
+
+
+async def admin_back(message: Message, bot: Bot, state: FSMContext):
+    await state.clear()
+    return await show_admin_panel(message)
+
+
+async def admin_stats(message: Message, bot: Bot, state: FSMContext):
+    await state.clear()
+    total, blocked, today, week = await get_stats()
+    enabled = await get_enabled()
+    st = "🟢 Включен" if enabled else "🔴 Выключен"
+    channels = [c for c in await CHANNELS.all() if c.chat_id != TEMPLATE_CHAT_ID]
+    return await message.answer(
+        f"📊 Статистика\n\n"
+        f"Статус: <b>{st}</b>\n"
+        f"Всего пользователей: <b>{total}</b>\n"
+        f"Недоступны: <b>{blocked}</b>\n"
+        f"Доступны: <b>{max(0, total - blocked)}</b>\n"
+        f"Новые: сегодня <b>{today}</b>, за 7 дней <b>{week}</b> (дни по UTC)\n"
+        f"Каналы: {len(channels)} (заявки принимаются в {sum(c.enabled for c in channels)})\n\n"
+        f"Заявки: в очереди {JOINS.depth}, обработано {JOINS.processed}, "
+        f"задержка ~{JOINS.lag_avg:.1f} с (макс. {JOINS.lag_max:.1f} с)\n"
+        f"Кэш настроек: {sum(CACHE_HITS.values.values()):.0f} попаданий / {sum(CACHE_MISSES.values.values()):.0f} промахов\n\n"
+        f"Сверить счётчики с таблицей: /recount\n"
+        f"Пользователи в файл: /export, /export_csv; из файла: /import",
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def admin_stats_rebuild(message: Message, bot: Bot, state: FSMContext):
+    # full scan of users with writes held off; the counters are replaced either way
+    await state.clear()
+    await message.answer("⏳ Пересчитываю статистику…")
+    before, after = await rebuild_stats()
+    names = ("Всего", "Недоступны", "Новые сегодня", "Новые за 7 дней")
+    drift = [f"{name}: {old} → {new}" for name, old, new in zip(names, before, after) if old != new]
+    return await message.answer(
+        "✅ Счётчики сходились с таблицей." if not drift
+        else "⚠️ Счётчики расходились, исправлено:\n" + "\n".join(drift),
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def admin_broadcast_report(message: Message, bot: Bot, state: FSMContext):
+    await state.clear()
+    job = await broadcast_job_last()
+    if job is None:
+        return await message.answer("Рассылок ещё не было.", reply_markup=await kb_admin_main())
+    return await message.answer(
+        format_delivery_report(job, await broadcast_delivery_report(job.id)),
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def admin_broadcast_start(message: Message, bot: Bot, state: FSMContext):
+    if BROADCASTS.active is not None:
+        return await message.answer(
+            "⏳ Рассылка уже идёт. Дождитесь завершения или нажмите ⛔ Стоп рассылка.",
+            reply_markup=await kb_admin_main(),
+        )
+    await state.clear()
+    return await broadcast_ask_segment(message, state)
+
+
+async def broadcast_ask_segment(message: Message, state: FSMContext):
+    await state.set_state(AdminStates.broadcast_wait_segment)
+    return await message.answer(
+        "📣 Кому отправить?\n"
+        "— кнопкой ниже\n"
+        "— вступившие за период: 01.05.2024-31.05.2024\n"
+        "— пришедшие из канала: id канала, например -1001234567890\n\nОтмена: ❌ Отмена",
+        reply_markup=kb_broadcast_segments(await broadcast_sources()),
+    )
+
+
+async def admin_welcome_text(message: Message, bot: Bot, state: FSMContext):
+    await state.set_state(AdminStates.welcome_wait_text)
+    return await message.answer("Пришлите новый текст приветствия (можно HTML).", reply_markup=kb_welcome_menu())
+
+
+async def admin_welcome_media(message: Message, bot: Bot, state: FSMContext):
+    await state.set_state(AdminStates.welcome_wait_media)
+    return await message.answer("Пришлите ОДНО: фото или видео для приветствия.", reply_markup=kb_welcome_menu())
+
+
+async def admin_welcome_button(message: Message, bot: Bot, state: FSMContext):
+    await state.set_state(AdminStates.welcome_wait_button)
+    return await message.answer(
+        "Пришлите кнопку в формате:\n\n<b>Текст</b> | <b>https://ссылка</b>\n\nПример:\nПравила | https://t.me/yourchannel/123",
+        reply_markup=kb_welcome_menu(),
+    )
+
+
+async def admin_welcome_media_delete(message: Message, bot: Bot, state: FSMContext):
+    channel = await admin_selected_channel(state)
+    await set_welcome_media(channel.chat_id, None, None)
+    await state.set_state(None)
+    return await message.answer(f"✅ Медиа удалено ({channel.name}).", reply_markup=kb_welcome_menu())
+
+
+async def admin_welcome_preview(message: Message, bot: Bot, state: FSMContext):
+    channel = await admin_selected_channel(state)
+    cfg = channel.welcome
+    await state.set_state(None)
+    await message.answer(f"Предпросмотр для {channel.name} (как увидит пользователь):", reply_markup=kb_welcome_menu())
+    try:
+        await send_welcome(bot, message.from_user.id, cfg)
+    except Exception:
+        await message.answer("Не удалось отправить предпросмотр.")
+
+
+async def admin_on_welcome_text(message: Message, bot: Bot, state: FSMContext):
+    text_value = (message.html_text or message.text or "").strip()
+    if not text_value:
+        return await message.answer("Текст пустой. Пришлите ещё раз или нажмите ❌ Отмена.")
+    channel = await admin_selected_channel(state)
+    await set_welcome_text(channel.chat_id, text_value)
+    await state.set_state(None)
+    return await message.answer(f"✅ Текст сохранён ({channel.name}).", reply_markup=kb_welcome_menu())
+
+
+def parse_button(raw: str) -> Optional[Tuple[str, str]]:
+    # "Text | https://url"
+    m = re.match(r"^(.*?)\s*\|\s*(https?://\S+)\s*$", raw.strip())
+    return (m.group(1).strip(), m.group(2).strip()) if m else None
+
+
+async def admin_on_welcome_button(message: Message, bot: Bot, state: FSMContext):
+    button = parse_button(message.text or "")
+    if not button:
+        return await message.answer("Формат неверный. Пример:\nПравила | https://t.me/yourchannel/123")
+    btn_text, btn_url = button
+    channel = await admin_selected_channel(state)
+    await set_welcome_button(channel.chat_id, btn_text, btn_url)
+    await state.set_state(None)
+    return await message.answer(f"✅ Кнопка обновлена ({channel.name}).", reply_markup=kb_welcome_menu())
+
+
+async def admin_on_welcome_media(message: Message, bot: Bot, state: FSMContext):
+    channel = await admin_selected_channel(state)
+    if message.photo:
+        file_id = message.photo[-1].file_id
+        await set_welcome_media(channel.chat_id, "photo", file_id)
+        await state.set_state(None)
+        return await message.answer(f"✅ Фото сохранено ({channel.name}).", reply_markup=kb_welcome_menu())
+    if message.video:
+        file_id = message.video.file_id
+        await set_welcome_media(channel.chat_id, "video", file_id)
+        await state.set_state(None)
+        return await message.answer(f"✅ Видео сохранено ({channel.name}).", reply_markup=kb_welcome_menu())
+    return await message.answer("Нужно прислать фото или видео. Или нажмите ❌ Отмена.")
+
+
+def admin_progress(status: Message, label: str, interval: float = 3.0) -> ImportProgress:
+    # edits the status message, at most once per `interval` seconds
+    last = time.monotonic()
+
+    async def update(done: int, skipped: int) -> None:
+        nonlocal last
+        if time.monotonic() - last < interval:
+            return
+        last = time.monotonic()
+        try:
+            await status.edit_text(f"{label}: {done}" + (f", пропущено {skipped}" if skipped else ""))
+        except TelegramBadRequest:
+            pass
+
+    return update
+
+
+async def admin_users_export(message: Message, bot: Bot, state: FSMContext):
+    await state.clear()
+    fmt = "csv" if message.text.strip().lower().endswith("csv") else "jsonl"
+    status = await message.answer("⏳ Выгружаю пользователей…")
+    path = os.path.join(tempfile.gettempdir(), f"users-{int(time.time())}.{fmt}")
+    exported = await export_users(path, fmt, admin_progress(status, "⏳ Выгружено"))
+    size = os.path.getsize(path)
+    if size > TELEGRAM_UPLOAD_LIMIT:
+        return await message.answer(
+            f"Файл {size / 2**20:.0f} МБ больше лимита Telegram, он остался на сервере: <code>{path}</code>",
+            reply_markup=await kb_admin_main(),
+        )
+    try:
+        return await message.answer_document(
+            FSInputFile(path), caption=f"✅ Пользователей: {exported}", reply_markup=await kb_admin_main()
+        )
+    finally:
+        os.remove(path)
+
+
+async def admin_users_import(message: Message, bot: Bot, state: FSMContext):
+    await state.set_state(AdminStates.users_wait_file)
+    return await message.answer(
+        "📥 Пришлите файл пользователей документом: .jsonl или .csv (как из /export, /export_csv).\n"
+        "Новые добавятся, существующие обновятся. До 20 МБ; больше — на сервере: "
+        "<code>python main.py import-users FILE</code>\n\nОтмена: ❌ Отмена",
+    )
+
+
+async def admin_on_users_file(message: Message, bot: Bot, state: FSMContext):
+    doc = message.document
+    if doc is None:
+        return await message.answer("Нужен файл .jsonl или .csv документом. Или нажмите ❌ Отмена.")
+    try:
+        fmt = users_file_format(doc.file_name or "")
+    except ValueError:
+        return await message.answer("Нужен файл с расширением .jsonl или .csv.")
+    if doc.file_size and doc.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+        return await message.answer(
+            "Файл больше 20 МБ, бот не может его скачать. Загрузите на сервере: "
+            "<code>python main.py import-users FILE</code>"
+        )
+    await state.clear()
+    status = await message.answer("⏳ Загружаю пользователей…")
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        await bot.download(doc, destination=path)
+        imported, skipped = await import_users(path, fmt, admin_progress(status, "⏳ Загружено"))
+    except Exception as e:
+        logging.exception("Users import failed")
+        return await message.answer(
+            f"❌ Импорт прервался: {type(e).__name__}. Пачки, записанные до ошибки, сохранены.",
+            reply_markup=await kb_admin_main(),
+        )
+    finally:
+        os.remove(path)
+    return await message.answer(
+        f"✅ Импортировано: <b>{imported}</b>" + (f", пропущено строк: <b>{skipped}</b>" if skipped else ""),
+        reply_markup=await kb_admin_main(),
+    )
+
+
+SEGMENT_PRESETS = {
+    "👥 все": ("all", 0),
+    "🆕 новые за 7 дней": ("joined", 7),
+    "🆕 новые за 30 дней": ("joined", 30),
+    "🔥 активные за 7 дней": ("active", 7),
+    "🔥 активные за 30 дней": ("active", 30),
+}
+
+
+def parse_segment(raw: str) -> Optional[Segment]:
+    txt = raw.strip().lower()
+    if txt in SEGMENT_PRESETS:
+        kind, days = SEGMENT_PRESETS[txt]
+        return Segment(kind, since=int(time.time()) - days * 86400) if days else Segment()
+    # "📡 -1001234567890 (42)" from the keyboard, or a bare chat id
+    m = re.match(r"^(?:📡\s*)?(-?\d{5,})(?:\s*\(\d+\))?$", txt)
+    if m:
+        return Segment("source", chat_id=int(m.group(1)))
+    m = re.match(r"^(\d{2}\.\d{2}\.\d{4})\s*[-–]\s*(\d{2}\.\d{2}\.\d{4})$", txt)
+    if m:
+        try:
+            since, last = (int(time.mktime(time.strptime(d, "%d.%m.%Y"))) for d in m.groups())
+        except ValueError:
+            return None
+        # the end date is inclusive
+        return Segment("joined", since=since, until=last + 86400) if since <= last else None
+    return None
+
+
+async def admin_on_broadcast_segment(message: Message, bot: Bot, state: FSMContext):
+    segment = parse_segment(message.text or "")
+    if segment is None:
+        return await message.answer("Не понял сегмент. Выберите кнопку или пришлите период / id канала.")
+    count = await count_broadcast_targets(segment=segment)
+    # a scheduled run counts its segment again when it fires, so it may be empty now
+    scheduled = (await state.get_data()).get("broadcast_when") is not None
+    if count == 0 and not scheduled:
+        return await message.answer(f"В сегменте «{segment.describe()}» нет пользователей, выберите другой.")
+    # the text too: a scheduled run parses it again, relative to its own time
+    await state.update_data(broadcast_segment=segment.to_json(), broadcast_segment_text=message.text)
+    await state.set_state(AdminStates.broadcast_wait_message)
+    note = " (пока никого, пересчитаю при запуске)" if count == 0 else ""
+    return await message.answer(
+        f"🎯 {segment.describe()}: {count} польз.{note}\n\n"
+        "📣 Пришлите сообщение для рассылки — любое: текст, фото, видео, документ, альбом.\n"
+        "Оно будет скопировано пользователям как есть.\n\nОтмена: ❌ Отмена",
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def admin_on_broadcast_message(message: Message, bot: Bot, state: FSMContext):
+    scheduled = (await state.get_data()).get("broadcast_when") is not None
+    if not scheduled and BROADCASTS.active is not None:
+        await state.clear()
+        return await message.answer(
+            "⏳ Рассылка уже идёт. Дождитесь завершения или нажмите ⛔ Стоп рассылка.",
+            reply_markup=await kb_admin_main(),
+        )
+
+    if message.media_group_id:
+        message_ids = await MEDIA_GROUPS.collect(message)
+        if message_ids is None:
+            # another item of an album, its first item's handler takes them all
+            return
+        # copyMessages can't attach a keyboard, so no button step for albums
+        return await broadcast_launch(message, bot, state, message_ids)
+
+    await state.update_data(broadcast_message_ids=[message.message_id])
+    await state.set_state(AdminStates.broadcast_wait_button)
+    return await message.answer(
+        "🔘 Добавить кнопку под сообщением?\nПришлите: Текст | https://ссылка\nИли «-» — без кнопки.",
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def admin_on_broadcast_button(message: Message, bot: Bot, state: FSMContext):
+    raw = (message.text or "").strip()
+    button = None
+    if raw != "-":
+        button = parse_button(raw)
+        if not button:
+            return await message.answer("Формат неверный. Пример:\nПодробнее | https://t.me/yourchannel/123\nИли «-».")
+    data = await state.get_data()
+    return await broadcast_launch(message, bot, state, data.get("broadcast_message_ids") or [], button)
+
+
+async def broadcast_launch(
+    message: Message, bot: Bot, state: FSMContext, message_ids: List[int], button: Optional[Tuple[str, str]] = None
+):
+    data = await state.get_data()
+    segment = Segment.from_json(data.get("broadcast_segment"))
+    await state.clear()
+    if data.get("broadcast_when") is not None:
+        return await broadcast_schedule(message, data, message_ids, button)
+    # checked in the DB right before creating a job: one may have started in
+    # another process since our worker last looked
+    active = await broadcast_job_active()
+    if active is not None:
+        BROADCASTS.active = active
+        return await message.answer(
+            "⏳ Рассылка уже идёт. Дождитесь завершения или нажмите ⛔ Стоп рассылка.",
+            reply_markup=await kb_admin_main(),
+        )
+    if not message_ids:
+        return await message.answer("Сообщение для рассылки потерялось, начните заново.", reply_markup=await kb_admin_main())
+
+    targets_count = await count_broadcast_targets(segment=segment)
+    if targets_count == 0:
+        return await message.answer("Нет пользователей для рассылки.", reply_markup=await kb_admin_main())
+
+    job = await broadcast_enqueue(message.from_user.id, message.chat.id, message_ids, button, segment, targets_count)
+    return await message.answer(
+        f"✅ Принято. Запускаю рассылку #{job.id} в фоне.\n"
+        f"Сегмент: {segment.describe()}\nПользователей: {targets_count}\n(Бот продолжит работать)",
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def broadcast_schedule(
+    message: Message, data: Dict[str, Any], message_ids: List[int], button: Optional[Tuple[str, str]]
+):
+    if not message_ids:
+        return await message.answer("Сообщение для рассылки потерялось, начните заново.", reply_markup=await kb_admin_main())
+    run_at, recurrence = data["broadcast_when"]
+    button_text, button_url = button or (None, None)
+    schedule_id = await DB.schedule_insert((
+        message.from_user.id, message.chat.id, json.dumps(message_ids), button_text, button_url,
+        data.get("broadcast_segment_text") or "👥 Все", recurrence, run_at,
+    ))
+    SCHEDULER.add(schedule_id, run_at)
+    segment = Segment.from_json(data.get("broadcast_segment"))
+    return await message.answer(
+        f"🗓 Запланировано, расписание #{schedule_id}.\n"
+        f"Сегмент: {segment.describe()}\n"
+        f"{'Повтор: <code>' + recurrence + '</code>' if recurrence else 'Один раз'}, "
+        f"первый запуск: {format_when(run_at)}\n\n"
+        "Не удаляйте это сообщение из чата: пользователи получат его копию.",
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def admin_broadcast_schedule(message: Message, bot: Bot, state: FSMContext):
+    await state.clear()
+    await state.set_state(AdminStates.broadcast_wait_when)
+    return await message.answer(
+        "🗓 Когда отправить?\n"
+        "— один раз: 25.12.2026 10:00\n"
+        "— по расписанию, cron (минута час день месяц день_недели):\n"
+        "  <code>0 10 * * 1</code> — по понедельникам в 10:00\n"
+        "  <code>30 18 * * *</code> — каждый день в 18:30\n"
+        f"Время: {SCHEDULE_TZ or 'сервера'}.\n\nОтмена: ❌ Отмена",
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def admin_on_broadcast_when(message: Message, bot: Bot, state: FSMContext):
+    when = parse_when(message.text or "")
+    if when is None:
+        return await message.answer("Не понял время. Пример: 25.12.2026 10:00 (в будущем) или 0 10 * * 1.")
+    await state.update_data(broadcast_when=list(when))
+    return await broadcast_ask_segment(message, state)
+
+
+async def admin_schedules(message: Message, bot: Bot, state: FSMContext):
+    await state.clear()
+    schedules = await broadcast_schedules_active()
+    if not schedules:
+        return await message.answer("Запланированных рассылок нет.", reply_markup=await kb_admin_main())
+    lines = [
+        f"#{s.id}: {format_when(s.next_run_at)}, "
+        f"{'<code>' + s.recurrence + '</code>' if s.recurrence else 'один раз'}, {s.segment}"
+        + (f", последняя — рассылка #{s.last_job_id}" if s.last_job_id else "")
+        for s in schedules
+    ]
+    await state.set_state(AdminStates.schedule_wait_cancel)
+    return await message.answer(
+        "🗓 Расписание:\n" + "\n".join(lines) + "\n\nЧтобы отменить, пришлите номер. Или ❌ Отмена.",
+        reply_markup=await kb_admin_main(),
+    )
+
+
+async def admin_on_schedule_cancel(message: Message, bot: Bot, state: FSMContext):
+    raw = (message.text or "").strip().lstrip("#")
+    row = await DB.schedule_load(int(raw)) if raw.isdigit() else None
+    if row is None or broadcast_schedule_from_row(row).status != "active":
+        return await message.answer("Нет такого активного расписания. Пришлите номер из списка или ❌ Отмена.")
+    await DB.schedule_update(int(raw), {"status": "cancelled"})
+    await state.clear()
+    return await message.answer(f"🗑 Расписание #{raw} отменено.", reply_markup=await kb_admin_main())
+
+
+# keys are stripped + lowercased message text
+ADMIN_BUTTONS: Dict[str, AdminHandler] = {
+    "🟢 бот включен": admin_toggle_enabled,
+    "🔴 бот выключен": admin_toggle_enabled,
+    "❌ отмена": admin_cancel,
+    "отмена": admin_cancel,
+    "/cancel": admin_cancel,
+    "⛔ стоп рассылка": admin_broadcast_stop,
+    "стоп рассылка": admin_broadcast_stop,
+    "stop": admin_broadcast_stop,
+    "📶 прогресс": admin_broadcast_progress,
+    "⏸ пауза": admin_broadcast_pause,
+    "▶️ продолжить": admin_broadcast_pause,
+    "📌 приветствие": admin_welcome_menu,
+    "приветствие": admin_welcome_menu,
+    "⬅️ назад": admin_back,
+    "назад": admin_back,
+    "📊 статистика": admin_stats,
+    "статистика": admin_stats,
+    "/recount": admin_stats_rebuild,
+    "/export": admin_users_export,
+    "/export_csv": admin_users_export,
+    "/import": admin_users_import,
+    "📈 отчёт рассылки": admin_broadcast_report,
+    "📣 рассылка": admin_broadcast_start,
+    "рассылка": admin_broadcast_start,
+    "🗓 запланировать": admin_broadcast_schedule,
+    "🗓 расписание": admin_schedules,
+    "✏️ текст приветствия": admin_welcome_text,
+    "🖼/🎥 медиа": admin_welcome_media,
+    "🔘 кнопка": admin_welcome_button,
+    "🗑 удалить медиа": admin_welcome_media_delete,
+    "👀 предпросмотр": admin_welcome_preview,
+    "🔁 вкл/выкл канал": admin_channel_toggle,
+    "📡 сменить канал": admin_channel_pick,
+}
+
+ADMIN_STATE_HANDLERS: Dict[str, AdminHandler] = {
+    AdminStates.welcome_wait_channel.state: admin_on_welcome_channel,
+    AdminStates.welcome_wait_text.state: admin_on_welcome_text,
+    AdminStates.welcome_wait_button.state: admin_on_welcome_button,
+    AdminStates.welcome_wait_media.state: admin_on_welcome_media,
+    AdminStates.broadcast_wait_segment.state: admin_on_broadcast_segment,
+    AdminStates.broadcast_wait_message.state: admin_on_broadcast_message,
+    AdminStates.broadcast_wait_button.state: admin_on_broadcast_button,
+    AdminStates.broadcast_wait_when.state: admin_on_broadcast_when,
+    AdminStates.schedule_wait_cancel.state: admin_on_schedule_cancel,
+    AdminStates.users_wait_file.state: admin_on_users_file,
+}
+
+
+# Filters are coroutines on purpose: aiogram runs plain-function filters, and
+# magic F filters with them, through asyncio.to_thread, which costs far more
+# than the check itself (see "F filters" in bench/bench_admin_routing.py).
+async def admin_private(message: Message) -> bool:
+    # router-level filter: everyone else is dropped before any admin code runs
+    return message.chat.type == "private" and message.from_user is not None and is_admin(message.from_user.id)
+
+
+async def admin_action(message: Message, raw_state: Optional[str] = None):
+    # buttons first: they work from any state (e.g. ❌ Отмена while waiting for input)
+    action = ADMIN_BUTTONS.get(message.text.strip().lower()) if message.text else None
+    if action is None and raw_state:
+        action = ADMIN_STATE_HANDLERS.get(raw_state)
+    return {"action": action} if action else False
+
+
+async def admin_dispatch(message: Message, bot: Bot, state: FSMContext, action: AdminHandler):
+    return await action(message, bot, state)
+
+
+admin_router = Router(name="admin")
+admin_router.message.filter(admin_private)
+admin_router.message.register(cmd_admin, Command("admin"))
+admin_router.message.register(admin_dispatch, admin_action)
+
+
+# =========================
+# Metrics endpoint
+# =========================
+# read at scrape time, so the hot paths don't have to keep them current
+METRICS.register(Gauge("bot_broadcast_running", "1 while this process works on a broadcast shard.", fn=lambda: BROADCASTS.is_running))
+METRICS.register(Gauge(
+    "bot_broadcast_rate", "Current broadcast send rate limit, msg/s.",
+    fn=lambda: BROADCASTS.run.bucket.rate if BROADCASTS.run else 0.0,
+))
+METRICS.register(Gauge("bot_join_queue_depth", "Join requests waiting for a worker.", fn=lambda: JOINS.depth))
+METRICS.register(Gauge("bot_join_lag_seconds", "Enqueue-to-done time of the last join request.", fn=lambda: JOINS.lag_last))
+METRICS.register(Gauge("bot_write_buffer_pending", "User writes buffered for the next flush.", fn=lambda: len(WRITES)))
+
+
+# outer middleware on Update: times filters + handler for every update
+async def metrics_middleware(handler, event: Update, data: Dict[str, Any]):
+    update_type = event.event_type
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.inc(update_type)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, update_type)
+
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.Response(
+        body=METRICS.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info("Metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+
+# =========================
+# Webhook mode
+# =========================
+# aiogram answers Telegram right away and handles the update in a background
+# task; on shutdown we wait for those tasks before the DB is closed. The bot
+# session stays open for the shutdown hooks and is closed by run_webhook.
+class DrainingRequestHandler(SimpleRequestHandler):
+    async def close(self) -> None:
+        pending = set(self._background_feed_update_tasks)
+        if pending:
+            logging.info("Draining %d in-flight updates", len(pending))
+            _, left = await asyncio.wait(pending, timeout=WEBHOOK_DRAIN_TIMEOUT)
+            if left:
+                logging.warning("%d updates still running after %.0fs, dropping them", len(left), WEBHOOK_DRAIN_TIMEOUT)
+
+
+async def on_webhook_startup(bot: Bot, dispatcher: Dispatcher):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    dp.startup.register(on_webhook_startup)
+
+    app = web.Application()
+    # registered first so its drain runs before the dispatcher shutdown hooks
+    DrainingRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info("Webhook listening on http://%s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop.wait()
+    finally:
+        # stops accepting connections, then runs the on_shutdown hooks
+        await runner.cleanup()
+        await bot.session.close()
+
+
+# BOT_MODE=worker: no updates, only broadcast shards. Run any number of these
+# next to the polling/webhook process, on the same STORAGE and BOT_TOKEN.
+async def run_worker(bot: Bot):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    logging.info("Broadcast worker %s started", WORKER_ID)
+    try:
+        await stop.wait()
+    finally:
+        await on_shutdown()
+        await bot.session.close()
+
+
+# =========================
+# MAIN
+# =========================
+def build_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=STATES)
+    dp.update.outer_middleware(metrics_middleware)
+    dp.errors.register(on_error)
+    dp.shutdown.register(on_shutdown)
+
+    dp.message.register(cmd_start, Command("start"))
+
+    dp.chat_join_request.register(on_join_request)
+
+    # Admin-only router (admins only, private chat)
+    dp.include_router(admin_router)
+    return dp
+
+
 async def main():
     logging.basicConfig(level=logging.INFO)
 
@@ -612,19 +4603,74 @@ async def main():
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
 
-    dp = Dispatcher()
-    dp.errors.register(on_error)
+    await DB.open()
+    WRITES.start()
+    await broadcast_jobs_adopt()
 
-    dp.message.register(cmd_start, Command("start"))
-    dp.message.register(cmd_admin, Command("admin"))
+    await STATES.load(bot.id)
+    # warm what every join request reads, before the first burst of updates
+    await CHANNELS.load()
+    await get_enabled()
+    for chat_id in CHANNEL_IDS - {c.chat_id for c in await CHANNELS.all()}:
+        await CHANNELS.register(chat_id)
+    dp = build_dispatcher()
+
+    SENDS.start(bot)
+    JOINS.start(bot)
+    BROADCAST_WORKER.start(bot)
+    SCHEDULER.start(bot)
+    SWEEP.start(bot)
+    metrics = await start_metrics_server()
+
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        elif BOT_MODE == "worker":
+            await run_worker(bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if metrics is not None:
+            await metrics.cleanup()
 
-    dp.chat_join_request.register(on_join_request)
 
-    # Admin-only router (admins only)
-    dp.message.register(admin_router)
+# Maintenance commands, run next to (or instead of) the bot on the same DB:
+#   python main.py export-users users.jsonl      (or .csv)
+#   python main.py import-users users.csv --chunk 100000
+async def cli(argv: List[str]) -> None:
+    ap = argparse.ArgumentParser(prog="main.py")
+    commands = ap.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export-users", help="stream every user to a .jsonl/.csv file")
+    export.add_argument("file")
+    export.add_argument("--format", choices=("jsonl", "csv"))
+    load = commands.add_parser("import-users", help="upsert users from a .jsonl/.csv file")
+    load.add_argument("file")
+    load.add_argument("--format", choices=("jsonl", "csv"))
+    load.add_argument("--chunk", type=int, default=IMPORT_CHUNK_ROWS, help="rows per transaction")
+    args = ap.parse_args(argv)
+    try:
+        users_file_format(args.file, args.format)
+    except ValueError as e:
+        ap.error(str(e))
+    logging.basicConfig(level=logging.INFO)
+
+    started = time.perf_counter()
+
+    async def progress(done: int, skipped: int) -> None:
+        rate = done / max(time.perf_counter() - started, 1e-9)
+        print(f"\r{done} rows ({rate:.0f}/s), {skipped} skipped", end="", file=sys.stderr, flush=True)
 
-    await dp.start_polling(bot)
+    await db_init()
+    await DB.open()
+    try:
+        if args.command == "export-users":
+            done, skipped = await export_users(args.file, args.format, progress), 0
+        else:
+            done, skipped = await import_users(args.file, args.format, progress, max(1, args.chunk))
+    finally:
+        await DB.close()
+    print(f"\n{args.command}: {done} rows, {skipped} skipped in {time.perf_counter() - started:.1f}s", file=sys.stderr)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(cli(sys.argv[1:]) if len(sys.argv) > 1 else main())
@@ -0,0 +1,125 @@
+# Broadcast send rate, checkpoint cursor and their settings, without a bot or a DB.
+#
+#   python -m pytest -q tests/test_broadcast.py
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+
+def clean_seconds(bucket: main.AdaptiveTokenBucket, seconds: int) -> list:
+    # the rate after each of `seconds` seconds spent sending at full speed
+    curve = []
+    for _ in range(seconds):
+        for _ in range(round(bucket.rate)):
+            bucket.on_success()
+        curve.append(bucket.rate)
+    return curve
+
+
+def test_flood_wait_halves_the_rate_once_per_pause():
+    bucket = main.AdaptiveTokenBucket(200, 5, min_rate=1, step=0.05)
+    assert bucket.on_retry_after(1) == pytest.approx(1, abs=0.05)
+    assert bucket.rate == 100
+    # the same flood-wait seen by another worker: pause may grow, rate may not drop again
+    bucket.on_retry_after(1)
+    assert bucket.rate == 100
+    assert bucket.is_paused()
+
+
+def test_rate_is_floored_at_min_rate():
+    bucket = main.AdaptiveTokenBucket(8, 1, min_rate=3, step=0.05)
+    for _ in range(5):
+        bucket.on_retry_after(0)  # a zero pause is over at once, so every 429 counts
+    assert bucket.rate == 3
+
+
+@pytest.mark.parametrize("max_rate", [30, 200, 1000])
+def test_recovery_takes_the_same_time_at_any_rate(max_rate):
+    bucket = main.AdaptiveTokenBucket(max_rate, 5, min_rate=1, step=0.05)
+    bucket.on_retry_after(0)
+    assert bucket.rate == max_rate / 2
+    curve = clean_seconds(bucket, 12)
+    # additive increase: max_rate/20 per clean second, back to full in ~10 s
+    for second, rate in enumerate(curve[:9], 1):
+        assert rate == pytest.approx(max_rate / 2 + second * max_rate / 20, rel=0.03)
+    assert curve[10] == max_rate
+    assert max(curve) == max_rate
+
+
+def test_step_follows_a_lowered_max_rate():
+    bucket = main.AdaptiveTokenBucket(200, 5, min_rate=1, step=0.05)
+    bucket.set_max_rate(40)
+    assert bucket.rate == 40
+    bucket.on_retry_after(0)
+    assert clean_seconds(bucket, 1)[0] == pytest.approx(22, rel=0.03)
+
+
+def test_cursor_watermark_waits_for_the_lowest_unfinished():
+    cursor = main.BroadcastCursor()
+    assert all(cursor.dispatch(uid) for uid in (10, 20, 30, 40, 50))
+    cursor.finish(30)
+    cursor.finish(50)
+    assert (cursor.value, cursor.done_above()) == (None, [30, 50])
+    cursor.finish(10)
+    assert (cursor.value, cursor.done_above()) == (10, [30, 50])
+    cursor.finish(20)
+    assert (cursor.value, cursor.done_above()) == (30, [50])
+    cursor.finish(40)
+    assert (cursor.value, cursor.done_above()) == (50, [])
+
+
+def test_cursor_resume_skips_what_was_finished_past_the_watermark():
+    # checkpointed as: everything <= 20 done, plus 40 and 60
+    cursor = main.BroadcastCursor(20, [40, 60])
+    assert cursor.done_above() == [40, 60]
+    sent = [uid for uid in (30, 40, 50, 60, 70) if cursor.dispatch(uid)]
+    assert sent == [30, 50, 70]
+    cursor.finish(30)
+    assert cursor.value == 40
+    cursor.finish(50)
+    assert (cursor.value, cursor.done_above()) == (60, [])
+    cursor.finish(70)
+    assert cursor.value == 70
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_cursor_restart_never_resends_a_finished_target(seed):
+    # workers finish in random order and the process dies at random points;
+    # each restart resumes from the last checkpoint (value, done_above)
+    rnd = random.Random(seed)
+    targets = list(range(1, 201))
+    value, done_above = None, []
+    finished = set()
+    while True:
+        cursor = main.BroadcastCursor(value, done_above)
+        pending = [uid for uid in targets if value is None or uid > value]
+        in_flight = [uid for uid in pending if cursor.dispatch(uid)]
+        assert not finished & set(in_flight)
+        rnd.shuffle(in_flight)
+        crash_at = rnd.randrange(len(in_flight) + 1) if in_flight else 0
+        for uid in in_flight[:crash_at]:
+            cursor.finish(uid)
+            finished.add(uid)
+        value, done_above = cursor.value, cursor.done_above()
+        if crash_at == len(in_flight):
+            break
+    assert finished == set(targets)
+    assert value == targets[-1] and done_above == []
+
+
+@pytest.mark.parametrize("interval, ttl, ok", [("0.5", "3", True), ("1", "3", False)])
+def test_checkpoint_interval_must_be_under_a_third_of_the_lease(interval, ttl, ok):
+    env = dict(os.environ, BROADCAST_CHECKPOINT_INTERVAL=interval, BROADCAST_LEASE_TTL=ttl)
+    result = subprocess.run([sys.executable, "-c", "import main"], cwd=ROOT, env=env, capture_output=True, text=True)
+    assert (result.returncode == 0) is ok
+    if not ok:
+        assert "BROADCAST_CHECKPOINT_INTERVAL" in result.stderr
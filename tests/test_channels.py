@@ -0,0 +1,116 @@
+# ChannelRegistry against a scripted in-memory channels table.
+#
+#   python -m pytest -q tests/test_channels.py
+import asyncio
+import os
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+CHAT = -1001
+
+
+class ChannelsTable:
+    # the channel methods of Storage; `during_insert` runs while the INSERT is in flight
+    def __init__(self):
+        self.rows = {main.TEMPLATE_CHAT_ID: (main.TEMPLATE_CHAT_ID, None, 1, None, None, "hi", "Go", "https://t.me")}
+        self.during_insert = None
+
+    async def channels_load(self):
+        return list(self.rows.values())
+
+    async def channel_load(self, chat_id):
+        return self.rows.get(chat_id)
+
+    async def channel_insert(self, chat_id, title, template_id):
+        if self.during_insert is not None:
+            await self.during_insert()
+        if chat_id in self.rows:
+            return False
+        self.rows[chat_id] = (chat_id, title) + self.rows[template_id][2:]
+        return True
+
+
+def test_register_survives_a_reload_during_the_insert(monkeypatch):
+    table = ChannelsTable()
+    monkeypatch.setattr(main, "DB", table)
+
+    async def go():
+        registry = main.ChannelRegistry(ttl=0.001)
+        await registry.load()
+        await asyncio.sleep(0.002)  # stale: the next get() reloads
+        reads = []
+
+        async def reload_meanwhile():
+            reads.append(asyncio.create_task(registry.get(CHAT)))
+            await asyncio.sleep(0.01)
+
+        table.during_insert = reload_meanwhile
+        channel = await registry.register(CHAT, "News")
+        assert channel.chat_id == CHAT
+        assert channel.welcome.text == "hi"
+        # the reload waited for the INSERT, so its snapshot has the row
+        assert (await reads[0]).chat_id == CHAT
+        assert (await registry.get(CHAT)).title == "News"
+
+    asyncio.run(go())
+
+
+def test_register_of_a_known_row_reads_it_back(monkeypatch):
+    table = ChannelsTable()
+    table.rows[CHAT] = (CHAT, "Old", 0, None, None, "own text", "Go", "https://t.me")
+    monkeypatch.setattr(main, "DB", table)
+
+    async def go():
+        registry = main.ChannelRegistry(ttl=0)
+        await registry.load()
+        registry._channels.pop(CHAT)  # another process inserted it after our load
+        channel = await registry.register(CHAT, "New")
+        assert (channel.title, channel.enabled, channel.welcome.text) == ("Old", False, "own text")
+
+    asyncio.run(go())
+
+
+def test_welcome_markup_is_built_once_and_rebuilt_after_an_edit(monkeypatch):
+    table = ChannelsTable()
+    monkeypatch.setattr(main, "DB", table)
+
+    def counted(counter):
+        return counter.values.get(("welcome_markup",), 0)
+
+    async def go():
+        registry = main.ChannelRegistry(ttl=0)
+        await registry.load()
+        welcome = (await registry.get(main.TEMPLATE_CHAT_ID)).welcome
+        misses, hits = counted(main.CACHE_MISSES), counted(main.CACHE_HITS)
+        markup = welcome.markup
+        assert welcome.markup is markup
+        assert (counted(main.CACHE_MISSES) - misses, counted(main.CACHE_HITS) - hits) == (1, 1)
+
+        table.rows[main.TEMPLATE_CHAT_ID] = table.rows[main.TEMPLATE_CHAT_ID][:6] + ("Read", "https://t.me/x")
+        await registry.refresh(main.TEMPLATE_CHAT_ID)
+        button = (await registry.get(main.TEMPLATE_CHAT_ID)).welcome.markup.inline_keyboard[0][0]
+        assert (button.text, button.url) == ("Read", "https://t.me/x")
+
+    asyncio.run(go())
+
+
+def test_channel_lookups_are_counted(monkeypatch):
+    monkeypatch.setattr(main, "DB", ChannelsTable())
+
+    def counted(counter):
+        return counter.values.get(("channels",), 0)
+
+    async def go():
+        registry = main.ChannelRegistry(ttl=0)
+        misses, hits = counted(main.CACHE_MISSES), counted(main.CACHE_HITS)
+        await registry.get(main.TEMPLATE_CHAT_ID)  # first load
+        await registry.get(main.TEMPLATE_CHAT_ID)
+        await registry.get(CHAT)  # unknown channel
+        assert (counted(main.CACHE_MISSES) - misses, counted(main.CACHE_HITS) - hits) == (2, 1)
+        assert "bot_cache_hits_total{cache=\"channels\"}" in main.METRICS.render()
+
+    asyncio.run(go())
@@ -0,0 +1,144 @@
+# Cron expressions, the "when" prompt and the segment step of scheduling.
+#
+#   python -m pytest -q tests/test_schedule.py
+#
+# Times are read in UTC here (SCHEDULE_TZ is patched), so runs are exact.
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def utc(monkeypatch):
+    monkeypatch.setattr(main, "SCHEDULE_TZ", timezone.utc)
+
+
+def ts(text: str) -> int:
+    return int(datetime.strptime(text, "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc).timestamp())
+
+
+def next_run(expr: str, after: str) -> str:
+    run = main.Cron.parse(expr).next_after(ts(after))
+    return datetime.fromtimestamp(run, timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+@pytest.mark.parametrize("raw, lo, hi, values", [
+    ("*", 0, 59, set(range(60))),
+    ("7", 0, 59, {7}),
+    ("1-5", 1, 31, {1, 2, 3, 4, 5}),
+    ("*/15", 0, 59, {0, 15, 30, 45}),
+    ("10-40/10", 0, 59, {10, 20, 30, 40}),
+    ("5/20", 0, 59, {5, 25, 45}),
+    ("1,3,10-12", 1, 31, {1, 3, 10, 11, 12}),
+    ("0-7", 0, 7, set(range(8))),
+])
+def test_cron_field_syntax(raw, lo, hi, values):
+    assert main.cron_field(raw, lo, hi) == values
+
+
+@pytest.mark.parametrize("expr", [
+    "60 * * * *",  # minute 0-59
+    "* 24 * * *",  # hour 0-23
+    "* * 0 * *",  # day 1-31
+    "* * 32 * *",
+    "* * * 13 *",  # month 1-12
+    "* * * * 8",  # weekday 0-7
+    "5-1 * * * *",  # reversed range
+    "*/0 * * * *",
+    "a * * * *",
+    "* * * *",  # four fields
+    "* * * * * *",
+])
+def test_cron_rejects_out_of_range_and_malformed(expr):
+    with pytest.raises(ValueError):
+        main.Cron.parse(expr)
+
+
+def test_cron_sunday_is_0_and_7():
+    assert main.Cron.parse("0 0 * * 7").weekdays == main.Cron.parse("0 0 * * 0").weekdays == {0}
+
+
+def test_next_after_is_strictly_later():
+    assert next_run("30 18 * * *", "2026-10-01 18:29") == "2026-10-01 18:30"
+    assert next_run("30 18 * * *", "2026-10-01 18:30") == "2026-10-02 18:30"
+    assert next_run("*/15 * * * *", "2026-10-01 23:50") == "2026-10-02 00:00"
+
+
+def test_next_after_rolls_over_months_and_years():
+    # April has no 31st
+    assert next_run("0 10 31 * *", "2026-04-15 00:00") == "2026-05-31 10:00"
+    assert next_run("0 0 1 * *", "2026-12-31 12:00") == "2027-01-01 00:00"
+    assert next_run("0 0 29 2 *", "2026-03-01 00:00") == "2028-02-29 00:00"
+
+
+def test_day_fields_or_when_both_restricted():
+    # the 13th or any Friday: 2026-10-01 is a Thursday, 2026-10-13 a Tuesday
+    assert next_run("0 9 13 * 5", "2026-10-01 00:00") == "2026-10-02 09:00"
+    assert next_run("0 9 13 * 5", "2026-10-10 00:00") == "2026-10-13 09:00"
+    # only one restricted: that one alone
+    assert next_run("0 9 13 * *", "2026-10-01 00:00") == "2026-10-13 09:00"
+    assert next_run("0 9 * * 5", "2026-10-03 00:00") == "2026-10-09 09:00"
+
+
+def test_cron_that_never_fires():
+    with pytest.raises(ValueError):
+        main.Cron.parse("0 0 31 2 *").next_after(ts("2026-01-01 00:00"))
+
+
+def test_parse_when():
+    assert main.parse_when("25.12.2099 10:00") == (ts("2099-12-25 10:00"), None)
+    assert main.parse_when("01.01.2001 10:00") is None  # in the past
+    assert main.parse_when("31.02.2099 10:00") is None
+    assert main.parse_when("tomorrow") is None
+    assert main.parse_when("61 * * * *") is None
+
+    before = time.time()
+    run_at, recurrence = main.parse_when(" 0  10 * *   1 ")
+    assert recurrence == "0 10 * * 1"
+    cron = main.Cron.parse(recurrence)
+    assert run_at in (cron.next_after(before), cron.next_after(time.time()))
+
+
+class FakeMessage:
+    def __init__(self, text: str):
+        self.text = text
+        self.answers = []
+
+    async def answer(self, text: str, **kwargs):
+        self.answers.append(text)
+
+
+@pytest.mark.parametrize("when, accepted", [(None, False), ([ts("2099-12-25 10:00"), "0 10 * * 1"], True)])
+def test_empty_segment_is_only_refused_for_an_immediate_send(monkeypatch, when, accepted):
+    async def no_targets(segment=None):
+        return 0
+
+    async def keyboard():
+        return None
+
+    monkeypatch.setattr(main, "count_broadcast_targets", no_targets)
+    monkeypatch.setattr(main, "kb_admin_main", keyboard)
+
+    async def go():
+        state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=1, user_id=1))
+        await state.set_state(main.AdminStates.broadcast_wait_segment)
+        await state.update_data(broadcast_when=when)
+        message = FakeMessage("👥 Все")
+        await main.admin_on_broadcast_segment(message, None, state)
+        expected = main.AdminStates.broadcast_wait_message if accepted else main.AdminStates.broadcast_wait_segment
+        assert await state.get_state() == expected.state
+        assert ("нет пользователей" in message.answers[0]) is not accepted
+
+    asyncio.run(go())
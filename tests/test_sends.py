@@ -0,0 +1,124 @@
+# OutboundSender: per-chat spacing, the admin exemption, send slots and priorities.
+#
+#   python -m pytest -q tests/test_sends.py
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+ADMIN = next(iter(main.ADMIN_IDS))
+USER = 500000001
+
+
+def run_with(sender: main.OutboundSender, check) -> None:
+    async def go():
+        bot = main.Bot("42:TEST")
+        sender.start(bot)
+        try:
+            await check()
+        finally:
+            await sender.stop()
+            await bot.session.close()
+
+    asyncio.run(go())
+
+
+def count_tokens(sender: main.OutboundSender) -> list:
+    # calls of the bot-wide bucket, i.e. send slots taken
+    taken = []
+    acquire = sender.bucket.acquire
+
+    async def counted():
+        await acquire()
+        taken.append(time.monotonic())
+
+    sender.bucket.acquire = counted
+    return taken
+
+
+async def timed(awaitable) -> float:
+    started = time.monotonic()
+    await awaitable
+    return time.monotonic() - started
+
+
+def test_same_chat_messages_are_spaced():
+    sender = main.OutboundSender(rps=1000, burst=100, chat_rps=10, chat_burst=1)
+
+    async def check():
+        waits = [await timed(sender.acquire(USER, main.SEND_WELCOME)) for _ in range(3)]
+        assert waits[0] < 0.05
+        assert all(w > 0.07 for w in waits[1:])
+
+    run_with(sender, check)
+
+
+def test_admin_reply_skips_the_admin_chats_spacing():
+    sender = main.OutboundSender(rps=1000, burst=100, chat_rps=1, chat_burst=1)
+
+    async def check():
+        # e.g. the broadcast start notice went to the admin chat just before
+        await sender.acquire(ADMIN, main.SEND_BROADCAST)
+        replies = [await timed(sender.acquire(ADMIN, main.SEND_INTERACTIVE)) for _ in range(3)]
+        assert max(replies) < 0.05
+        # only the admin's interactive sends are exempt
+        assert await timed(sender.acquire(ADMIN, main.SEND_BROADCAST)) > 0.5
+
+    run_with(sender, check)
+
+
+def test_cancelled_waiter_takes_no_token():
+    sender = main.OutboundSender(rps=1000, burst=100)
+    taken = count_tokens(sender)
+
+    async def check():
+        waiter = asyncio.create_task(sender.acquire(USER, main.SEND_BROADCAST))
+        await asyncio.sleep(0)  # queued in the heap
+        waiter.cancel()
+        await asyncio.sleep(0.05)
+        assert taken == []
+        await sender.acquire(USER + 1, main.SEND_WELCOME)
+        assert len(taken) == 1
+
+    run_with(sender, check)
+
+
+def test_token_taken_for_a_waiter_that_left_goes_to_the_next():
+    sender = main.OutboundSender(rps=10, burst=1)
+    taken = count_tokens(sender)
+
+    async def check():
+        await sender.acquire(USER, main.SEND_BROADCAST)  # the saved-up token
+        waiter = asyncio.create_task(sender.acquire(USER + 1, main.SEND_BROADCAST))
+        await asyncio.sleep(0.02)  # the dispatcher now waits ~0.1 s for a token
+        waiter.cancel()
+        await asyncio.sleep(0.15)
+        assert len(taken) == 2
+        # the token already in hand: no wait, no new one taken
+        assert await timed(sender.acquire(USER + 2, main.SEND_WELCOME)) < 0.02
+        assert len(taken) == 2
+
+    run_with(sender, check)
+
+
+def test_slots_go_by_priority():
+    # interactive (admin replies) > welcome > broadcast > sweep
+    sender = main.OutboundSender(rps=20, burst=1)
+    order = []
+
+    async def send(priority: int, chat_id: int):
+        await sender.acquire(chat_id, priority)
+        order.append(main.SEND_QUEUES[priority])
+
+    async def check():
+        await sender.acquire(USER, main.SEND_BROADCAST)  # empty the bucket
+        queued = [main.SEND_SWEEP, main.SEND_BROADCAST, main.SEND_WELCOME, main.SEND_INTERACTIVE]
+        await asyncio.gather(*(send(p, USER + 1 + i) for i, p in enumerate(queued)))
+        assert order == ["interactive", "welcome", "broadcast", "sweep"]
+
+    run_with(sender, check)
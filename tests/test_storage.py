@@ -0,0 +1,290 @@
+# One Storage contract, run against every backend.
+#
+#   python -m pytest -q tests
+#   DATABASE_URL=postgresql://user@localhost/bot_test python -m pytest -q tests
+#
+# SQLite gets a fresh file per test. Postgres runs when asyncpg is installed
+# and DATABASE_URL is set; each test gets its own freshly created schema
+# (storage_test) in that database, so existing tables are left alone.
+import asyncio
+import json
+import os
+import sys
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+PG_SCHEMA = "storage_test"
+DAY = 86400
+
+
+def pg_test_dsn(dsn: str) -> str:
+    # asyncpg passes unknown DSN parameters on as server settings
+    parts = urlsplit(dsn)
+    query = dict(parse_qsl(parts.query), search_path=PG_SCHEMA)
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+async def pg_reset(dsn: str) -> None:
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {PG_SCHEMA} CASCADE; CREATE SCHEMA {PG_SCHEMA}")
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def run(request, tmp_path):
+    # run(check): check(storage) on a freshly initialised, open backend
+    if request.param == "postgres":
+        pytest.importorskip("asyncpg")
+        if not os.getenv("DATABASE_URL"):
+            pytest.skip("DATABASE_URL is not set")
+
+    def runner(check):
+        async def go():
+            if request.param == "postgres":
+                await pg_reset(os.environ["DATABASE_URL"])
+                storage = main.PostgresStorage(pg_test_dsn(os.environ["DATABASE_URL"]), 1, 4)
+            else:
+                storage = main.SqliteStorage(str(tmp_path / "bot.db"))
+            await storage.init()
+            await storage.open()
+            try:
+                await check(storage)
+            finally:
+                await storage.close()
+
+        asyncio.run(go())
+
+    return runner
+
+
+def user(uid: int, created_at: int, source: int = None, last_active: int = None) -> tuple:
+    # an UPSERT_USER_SQL row
+    return (uid, f"user{uid}", "Name", None, created_at, source, last_active or created_at)
+
+
+def test_users_upsert_and_blocked(run):
+    async def check(db: main.Storage):
+        now = int(time.time())
+        today = now // DAY
+        await db.write_users([user(1, now, -100), user(2, now - 3 * DAY), user(3, now - 30 * DAY)], [])
+        # a user already seen keeps their first source; the flag lands on a new row in the same batch
+        await db.write_users([user(1, now, -200), user(4, now)], [(1, 2), (1, 4)])
+        assert await db.user_stats(today) == (4, 2, 2, 3)
+
+        await db.write_users([], [(0, 4)])
+        assert await db.user_stats(today) == (4, 1, 2, 3)
+        assert all(type(v) is int for v in await db.user_stats(today))
+
+        rows = [row async for batch in db.users_dump(10) for row in batch]
+        assert [(r[0], r[5], r[7]) for r in rows] == [(1, -100, 0), (2, None, 1), (3, None, 0), (4, None, 0)]
+
+        # a batch big enough for the COPY path, with flags in the same transaction
+        many = [user(uid, now) for uid in range(1000, 1000 + main.PG_COPY_MIN_ROWS)]
+        await db.write_users(many, [(1, uid) for uid in range(1000, 1010)])
+        assert await db.user_stats(today) == (4 + main.PG_COPY_MIN_ROWS, 11, 2 + main.PG_COPY_MIN_ROWS, 3 + main.PG_COPY_MIN_ROWS)
+
+        before, after = await db.user_stats_rebuild(today)
+        assert before == after
+
+    run(check)
+
+
+def test_targets(run):
+    async def check(db: main.Storage):
+        now = int(time.time())
+        await db.write_users(
+            [user(uid, now - (uid % 10) * DAY, -100 - uid % 2, now - (uid % 5) * DAY) for uid in range(1, 101)],
+            [(1, uid) for uid in range(1, 101, 7)],
+        )
+        blocked = set(range(1, 101, 7))
+        segments = {
+            main.Segment(): lambda uid: True,
+            main.Segment("source", chat_id=-101): lambda uid: uid % 2 == 1,
+            main.Segment("joined", since=now - 5 * DAY, until=now - DAY): lambda uid: 2 <= uid % 10 <= 5,
+            main.Segment("active", since=now - 2 * DAY): lambda uid: uid % 5 <= 2,
+        }
+        for segment, wanted in segments.items():
+            expected = [uid for uid in range(1, 101) if uid not in blocked and wanted(uid)]
+            assert await db.target_count(segment) == len(expected)
+            # keyset pages, and the same walk cut at an upper bound
+            got, after = [], None
+            while page := await db.target_page(segment, after, 7):
+                got += page
+                after = page[-1]
+            assert got == expected
+            assert await db.target_page(segment, None, 100, upto=50) == [uid for uid in expected if uid <= 50]
+            assert await db.target_nth(segment, expected[2], 3) == expected[6]
+        assert dict(await db.target_sources()) == {
+            -101: sum(1 for uid in range(1, 101, 2) if uid not in blocked),
+            -100: sum(1 for uid in range(2, 101, 2) if uid not in blocked),
+        }
+
+    run(check)
+
+
+def test_welcome_and_settings(run):
+    async def check(db: main.Storage):
+        template = await db.channel_load(main.TEMPLATE_CHAT_ID)
+        assert template is not None and template[5] == main.WELCOME_DEFAULT_TEXT
+
+        await db.channel_update(main.TEMPLATE_CHAT_ID, {"text": "Hi", "button_url": "https://t.me/x"})
+        assert await db.channel_insert(-100, "Channel", main.TEMPLATE_CHAT_ID)
+        assert not await db.channel_insert(-100, "Again", main.TEMPLATE_CHAT_ID)
+        await db.channel_update(-100, {"media_type": "photo", "media_file_id": "file"})
+        row = main.channel_from_row(await db.channel_load(-100))
+        welcome = row.welcome
+        assert (row.title, welcome.text, welcome.button_url, welcome.media_type, welcome.media_file_id) == (
+            "Channel", "Hi", "https://t.me/x", "photo", "file"
+        )
+        assert sorted(r[0] for r in await db.channels_load()) == [-100, main.TEMPLATE_CHAT_ID]
+        assert await db.channel_load(-999) is None
+
+        await db.set_enabled(False)
+        assert await db.get_enabled() is False
+        await db.set_enabled(True)
+        assert await db.get_enabled() is True
+
+        assert await db.sweep_cursor_load() is None
+        await db.sweep_cursor_save(12345)
+        assert await db.sweep_cursor_load() == 12345
+        await db.sweep_cursor_save(None)
+        assert await db.sweep_cursor_load() is None
+
+    run(check)
+
+
+def test_admin_state(run):
+    async def check(db: main.Storage):
+        await db.admin_state_save(1, "AdminStates:broadcast_wait_message", json.dumps({"segment": "{}"}))
+        await db.admin_state_save(2, None, "{}")
+        await db.admin_state_save(1, "AdminStates:broadcast_wait_button", "{}")
+        assert sorted(await db.admin_state_load()) == [(1, "AdminStates:broadcast_wait_button", "{}"), (2, None, "{}")]
+        await db.admin_state_save(2, None, None)
+        assert await db.admin_state_load() == [(1, "AdminStates:broadcast_wait_button", "{}")]
+
+    run(check)
+
+
+def test_broadcast_shards(run):
+    async def check(db: main.Storage):
+        values = (1, "copy", None, "", 1, json.dumps([10]), None, None, main.Segment().to_json(), 100)
+        job_id = await db.broadcast_job_insert(values, [(None, 50), (50, None)])
+        assert [r[0] for r in await db.broadcast_jobs_running()] == [job_id]
+
+        job, first, leases = await db.broadcast_shard_lease("a", 30)
+        assert main.broadcast_job_from_row(job).id == job_id and leases == 1
+        first = main.broadcast_shard_from_row(first)
+        assert (first.shard, first.lo, first.hi, first.cursor) == (0, None, 50, None)
+        _, second, leases = await db.broadcast_shard_lease("b", 30)
+        assert (second[1], second[4], leases) == (1, 50, 2)
+        assert await db.broadcast_shard_lease("c", 30) is None
+
+        # checkpoint with deliveries, then a pause seen by the next checkpoint
+        deliveries = [(job_id, uid, "sent", None, uid, time.time()) for uid in range(1, 21)]
+        state = await db.broadcast_shard_save(job_id, 0, "a", ("pending", 20, "[]", 20, 0, 1, 0.5, 10.0), 30, deliveries)
+        assert state == ("running", False, 2)
+        await db.broadcast_job_update(job_id, {"paused": 1})
+        state = await db.broadcast_shard_save(job_id, 1, "b", ("pending", 60, "[62]", 11, 1, 0, 0.0, 5.0), 30)
+        assert state == ("running", True, 2)
+        assert tuple(await db.broadcast_progress(job_id)) == (31, 1, 1, 0.5, 15.0)
+        assert await db.broadcast_shard_save(job_id, 0, "b", ("pending", 30, "[]", 0, 0, 0, 0.0, 0.0), 30) is None
+
+        # an expired lease is taken over from its checkpoint
+        await db.broadcast_shard_save(job_id, 1, "b", ("pending", 60, "[62]", 11, 1, 0, 0.0, 5.0), -1)
+        _, taken, _ = await db.broadcast_shard_lease("c", 30)
+        taken = main.broadcast_shard_from_row(taken)
+        assert (taken.shard, taken.cursor, taken.done_above, taken.sent) == (1, 60, [62], 11)
+
+        await db.broadcast_shard_save(job_id, 0, "a", ("done", 50, "[]", 45, 0, 1, 0.5, 0.0), None)
+        assert not await db.broadcast_job_finish(job_id)
+        await db.broadcast_shard_save(job_id, 1, "c", ("done", None, "[]", 50, 1, 0, 0.0, 0.0), None)
+        assert await db.broadcast_job_finish(job_id)
+        assert not await db.broadcast_job_finish(job_id)
+        last = main.broadcast_job_from_row(await db.broadcast_job_last())
+        assert (last.id, last.status, last.sent, last.failed, last.paused) == (job_id, "done", 95, 1, True)
+        assert await db.broadcast_jobs_running() == []
+
+    run(check)
+
+
+def test_sqlite_shard_lease_is_exclusive_across_connections(tmp_path):
+    # two processes on one file: only one of them may get the shard
+    async def go():
+        path = str(tmp_path / "bot.db")
+        first, second = main.SqliteStorage(path), main.SqliteStorage(path)
+        await first.init()
+        await first.open()
+        await second.open()
+        try:
+            values = (1, "copy", None, "", 1, "[10]", None, None, main.Segment().to_json(), 100)
+            for _ in range(20):
+                job_id = await first.broadcast_job_insert(values, [(None, None)])
+                leases = await asyncio.gather(first.broadcast_shard_lease("a", 30), second.broadcast_shard_lease("b", 30))
+                owners = [owner for owner, lease in zip("ab", leases) if lease is not None]
+                assert len(owners) == 1
+                db = first if owners == ["a"] else second
+                await db.broadcast_shard_save(job_id, 0, owners[0], ("done", None, "[]", 0, 0, 0, 0.0, 0.0), None)
+                assert await db.broadcast_job_finish(job_id)
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(go())
+
+
+def test_delivery_log(run):
+    async def check(db: main.Storage):
+        values = (1, "copy", None, "", 1, "[10]", None, None, main.Segment().to_json(), 100)
+        job_id = await db.broadcast_job_insert(values, [(None, None)])
+        await db.broadcast_shard_lease("a", 30)
+        t0 = 1_700_000_000.0
+        deliveries = [(job_id, uid, "sent", None, uid * 10, t0 + uid) for uid in range(1, 101)]
+        deliveries += [(job_id, uid, "failed", "TelegramForbiddenError", 5, t0) for uid in range(101, 111)]
+        await db.broadcast_shard_save(job_id, 0, "a", ("pending", 110, "[]", 100, 10, 0, 0.0, 0.0), 30, deliveries[:50])
+        # a repeated send (taken-over shard) replaces its row
+        await db.broadcast_shard_save(job_id, 0, "a", ("pending", 110, "[]", 100, 10, 0, 0.0, 0.0), 30, deliveries[40:])
+
+        report = await db.broadcast_delivery_report(job_id)
+        assert [tuple(r) for r in report.outcomes] == [("sent", "", 100), ("failed", "TelegramForbiddenError", 10)]
+        assert (report.p50, report.p95, report.p99) == (500, 950, 990)
+        assert report.bucket == 10
+        assert sum(n for _, n in report.timeline) == 100
+
+    run(check)
+
+
+def test_import_export(run):
+    async def check(db: main.Storage):
+        now = int(time.time())
+        await db.write_users([user(1, now - 10 * DAY, -100, now - DAY)], [])
+        # imported rows win, except the earliest created_at, the latest
+        # last_active_at and a source already set
+        await db.users_import([
+            (1, "renamed", "New", "Last", now - 20 * DAY, -200, now - 5 * DAY, 1),
+            (2, "fresh", "Fresh", None, None, None, None, 0),
+            (3, None, None, None, now - DAY, -300, now, 1),
+        ])
+        rows = [row async for batch in db.users_dump(2) for row in batch]
+        assert [tuple(r) for r in rows] == [
+            (1, "renamed", "New", "Last", now - 20 * DAY, -100, now - DAY, 1),
+            (2, "fresh", "Fresh", None, None, None, None, 0),
+            (3, None, None, None, now - DAY, -300, now, 1),
+        ]
+        assert await db.user_stats(now // DAY) == (3, 2, 0, 1)
+
+        # an export read back is a no-op
+        await db.users_import([tuple(r) for r in rows])
+        assert [tuple(r) for batch in [b async for b in db.users_dump(10)] for r in batch] == [tuple(r) for r in rows]
+
+    run(check)
@@ -0,0 +1,131 @@
+# Liveness sweep: gone-chat errors and resuming from the saved cursor.
+#
+#   python -m pytest -q tests/test_sweep.py
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from aiogram.exceptions import (  # noqa: E402
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.methods import SendMessage  # noqa: E402
+
+METHOD = SendMessage(chat_id=1, text="")
+
+
+@pytest.mark.parametrize("error, gone", [
+    (TelegramForbiddenError(METHOD, "Forbidden: bot was blocked by the user"), True),
+    (TelegramForbiddenError(METHOD, "Forbidden: user is deactivated"), True),
+    (TelegramForbiddenError(METHOD, "Forbidden: bot was kicked from the group chat"), True),
+    (TelegramBadRequest(METHOD, "Bad Request: chat not found"), True),
+    (TelegramBadRequest(METHOD, "Bad Request: USER IS DEACTIVATED"), True),
+    (TelegramBadRequest(METHOD, "Bad Request: message text is empty"), False),
+    (TelegramRetryAfter(METHOD, "Too Many Requests: retry after 5", 5), False),
+    (TelegramNetworkError(METHOD, "HTTP Client says - ServerDisconnectedError"), False),
+    (TelegramServerError(METHOD, "Internal Server Error"), False),
+    (asyncio.TimeoutError(), False),
+])
+def test_is_chat_gone(error, gone):
+    assert main.is_chat_gone(error) is gone
+
+
+class SweepDB:
+    # the sweep's part of Storage; each name in `fail` raises once
+    def __init__(self, users, cursor=None, fail=()):
+        self.users = users
+        self.cursor = cursor
+        self.fail = list(fail)
+        self.saved = []
+
+    def attempt(self, name: str) -> None:
+        if name in self.fail:
+            self.fail.remove(name)
+            raise ConnectionError(name)
+
+    async def sweep_cursor_load(self):
+        self.attempt("load")
+        return self.cursor
+
+    async def sweep_cursor_save(self, cursor):
+        self.attempt("save")
+        self.cursor = cursor
+        self.saved.append(cursor)
+
+    async def target_page(self, segment, after, limit, upto=None):
+        self.attempt("page")
+        return [uid for uid in self.users if after is None or uid > after][:limit]
+
+
+class ProbeBot:
+    def __init__(self, gone=()):
+        self.gone = set(gone)
+        self.probed = []
+
+    async def send_chat_action(self, chat_id, action):
+        self.probed.append(chat_id)
+        if chat_id in self.gone:
+            raise TelegramForbiddenError(METHOD, "Forbidden: bot was blocked by the user")
+
+
+@pytest.fixture
+def blocked(monkeypatch):
+    flagged = []
+
+    async def no_job():
+        return None
+
+    async def mark_blocked(user_id, blocked_=True):
+        flagged.append(user_id)
+
+    monkeypatch.setattr(main, "broadcast_job_active", no_job)
+    monkeypatch.setattr(main, "mark_blocked", mark_blocked)
+    monkeypatch.setattr(main, "BROADCAST_POLL_INTERVAL", 0.001)
+    monkeypatch.setattr(main, "LIVENESS_PAGE_SIZE", 3)
+    return flagged
+
+
+async def sweep_until(db: SweepDB, bot: ProbeBot, done) -> None:
+    sweep = main.LivenessSweep(interval=3600, rps=10000)
+    sweep.start(bot)
+    try:
+        for _ in range(2000):
+            if done():
+                return
+            await asyncio.sleep(0.001)
+        raise AssertionError(f"sweep stuck: probed {bot.probed}, saved {db.saved}")
+    finally:
+        await sweep.stop()
+
+
+@pytest.mark.parametrize("fail", [["load"], ["page"], ["save"], ["load", "page", "page", "save"]])
+def test_failed_attempt_resumes_from_the_saved_cursor(monkeypatch, blocked, fail):
+    # a previous process got through user 4
+    db = SweepDB(list(range(1, 11)), cursor=4, fail=fail)
+    bot = ProbeBot(gone={6, 9})
+    monkeypatch.setattr(main, "DB", db)
+    asyncio.run(sweep_until(db, bot, lambda: db.saved[-1:] == [None]))
+    # each user probed once: a failed save doesn't send the page out again
+    assert bot.probed == list(range(5, 11))
+    assert sorted(set(blocked)) == [6, 9]
+
+
+def test_restart_carries_on_after_the_last_saved_page(monkeypatch, blocked):
+    db = SweepDB(list(range(1, 11)))
+    monkeypatch.setattr(main, "DB", db)
+    first = ProbeBot()
+    # stopped once two pages are saved, wherever the third one got to
+    asyncio.run(sweep_until(db, first, lambda: len(db.saved) == 2))
+    assert db.cursor == 6
+    second = ProbeBot()
+    asyncio.run(sweep_until(db, second, lambda: db.saved[-1:] == [None]))
+    assert second.probed == [7, 8, 9, 10]